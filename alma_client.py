@@ -0,0 +1,243 @@
+"""
+Client for the Alma acquisitions API used by update_alma.py
+All calls share one requests Session whose connection pool is sized to
+the worker threads, so after the first call each thread reuses a
+keep-alive connection to the API host instead of a new TCP and TLS
+handshake. Concurrent calls run on a thread pool: they spend their time
+waiting on the network, so there is nothing to fork or pickle, and
+results are yielded as each call completes.
+Calls are spaced by a token bucket to stay under Alma's per second
+limit. A throttled (429), failed (5xx) or timed out call is retried
+after a jittered exponential backoff until its deadline, and raises
+IOError if it still fails, instead of returning a page that breaks the
+caller. A host that does not resolve or refuses connections raises
+IOError at once, as waiting will not fix it. Any other 4xx is Alma refusing the call, e.g. an
+unknown vendor, and raises AlmaRequestError at once.
+requests is only imported when a client is created.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+
+from timeit import default_timer
+from urllib import quote
+
+from check_processing import load_config
+
+API_URL = 'https://api-na.hosted.exlibrisgroup.com/almaws/v1/acq/'
+PAGE_SIZE = 100
+# the most Alma returns per page of a list call
+VENDOR_PAGE_SIZE = 100
+WORKERS = 20
+# Alma allows 25 calls a second per institution
+RATE = 25
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+DEADLINE = 120
+THROTTLED = 429
+
+
+class AlmaRequestError(IOError):
+    """Call Alma refused with a status that is not retried"""
+
+    def __init__(self, message, status):
+        IOError.__init__(self, message)
+        self.status = status
+
+
+class RateLimiter(object):
+    """Token bucket spacing calls from any number of threads"""
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate (float): Calls a second.
+            burst (float): Calls that may be made at once after an idle
+                spell (default: rate).
+        """
+        if rate <= 0:
+            raise ValueError('Invalid rate: %s' % rate)
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.stamp = default_timer()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Waits until a call may be made.
+
+        Returns:
+            float: Seconds waited.
+        """
+        with self.lock:
+            now = default_timer()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            # take the token now, waiting for it outside the lock
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def backoff_delay(attempt, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+    """Jittered exponential delay before retry attempt (1 for the first)"""
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def unreachable(exc):
+    """Whether a requests error is a connection that could not be made at
+    all, e.g. the host name does not resolve or the host refuses it"""
+    from requests.packages.urllib3.exceptions import NewConnectionError
+
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class AlmaClient(object):
+    """Alma API calls over one pooled keep-alive session"""
+
+    def __init__(self, api_key, workers=WORKERS, base_url=API_URL, rate=RATE,
+                 deadline=DEADLINE, backoff=BACKOFF):
+        """
+        Args:
+            api_key (str): Alma API key.
+            workers (int): Threads, and pooled connections, for concurrent calls.
+            base_url (str): Acquisitions API root.
+            rate (float): Calls a second, shared by the threads.
+            deadline (float): Seconds a call may take, retries included.
+            backoff (float): Base of the delays between retries, in seconds.
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.api_key = api_key
+        self.workers = workers
+        self.base_url = base_url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.pool = None
+        self.limiter = RateLimiter(rate)
+        self.deadline = deadline
+        self.backoff = backoff
+        self.errors = (requests.RequestException, ValueError)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+
+    def _count(self, retried):
+        """Counts a request, and whether it is a retry"""
+        with self.lock:
+            self.calls += 1
+            self.retries += retried
+
+    def get(self, path, **params):
+        """GETs path below the API root as JSON, retrying throttled and
+        failed requests until the deadline.
+
+        Returns:
+            dict: The decoded response.
+
+        Raises:
+            AlmaRequestError: The call failed with a 4xx other than 429.
+            IOError: The API host cannot be reached, or the call did not
+                succeed by the deadline.
+        """
+        params['apikey'] = self.api_key
+        params['format'] = 'json'
+        url = self.base_url + path
+        end = default_timer() + self.deadline
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            self._count(attempt > 0)
+            remaining = end - default_timer()
+            try:
+                req = self.session.get(url, params=params,
+                                       timeout=max(remaining, 0.001))
+                if req.status_code != THROTTLED and req.status_code < 500:
+                    req.raise_for_status()
+                    return json.loads(req.text)
+                error = "HTTP %d" % req.status_code
+            except self.errors as exc:
+                if getattr(exc, 'response', None) is not None:
+                    # a status that is not retried, e.g. 400 unknown vendor
+                    raise AlmaRequestError("Alma GET %s failed: %s" % (path, exc),
+                                           exc.response.status_code)
+                if unreachable(exc):
+                    raise IOError("Alma GET %s failed, cannot connect: %s"
+                                  % (path, exc))
+                error = str(exc) or exc.__class__.__name__
+            attempt += 1
+            delay = backoff_delay(attempt, self.backoff)
+            if default_timer() + delay >= end:
+                raise IOError("Alma GET %s failed after %d attempts: %s"
+                              % (path, attempt, error))
+            logging.debug("Alma GET %s: %s, retrying in %.2fs",
+                          path, error, delay)
+            time.sleep(delay)
+
+    def invoices(self, offset, query):
+        """A page of invoices matching query, starting at offset"""
+        return self.get('invoices/', q=query, limit=PAGE_SIZE, offset=offset)
+
+    def vendor(self, code):
+        """A vendor record"""
+        return self.get('vendors/%s' % quote(code))
+
+    def vendors(self, offset, limit=VENDOR_PAGE_SIZE):
+        """A page of all vendor records, starting at offset"""
+        return self.get('vendors', limit=limit, offset=offset)
+
+    def _workers(self):
+        """The worker thread pool, started on first use"""
+        if self.pool is None:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(self.workers)
+        return self.pool
+
+    def imap(self, func, items):
+        """Calls func on each item from the worker threads.
+
+        Returns:
+            iterator: Results in completion order.
+        """
+        return self._workers().imap_unordered(func, items)
+
+    def map_async(self, func, items):
+        """Calls func on each item from the worker threads, without waiting.
+
+        Returns:
+            AsyncResult: Its wait or get blocks until all calls are done.
+        """
+        return self._workers().map_async(func, items)
+
+    def close(self):
+        """Stops the worker threads and closes the pooled connections"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.session.close()
+
+
+_CLIENTS = dict()
+
+
+def default_client():
+    """AlmaClient with the api key and deadline of config.ini, shared by
+    the process"""
+    settings = load_config().alma
+    client = _CLIENTS.get(settings)
+    if client is None:
+        deadline = settings.deadline or DEADLINE
+        client = _CLIENTS[settings] = AlmaClient(settings.api_key,
+                                                 deadline=deadline)
+    return client
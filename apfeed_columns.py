@@ -0,0 +1,289 @@
+#!/usr/bin/env python2.7
+
+"""
+Bulk decode of archived apfeeds into columns for audit and analytics
+Every line Apfeed writes is LAYOUT.width characters, so with NumPy a
+feed is viewed as a 2-D byte array and each column is cut out of it at
+once; numeric fields and dates become int64 columns (amounts in signed
+cents, dates as YYYYMMDD, 0 when blank). Without NumPy the same columns are
+built line by line with the layout's struct. Decoded columns can be
+saved as a binary .npz file that reloads without decoding again.
+"""
+
+import argparse
+import csv
+import os
+import sys
+
+from array import array
+from collections import OrderedDict
+from itertools import izip
+
+from apfeed_layout import LAYOUT
+from apfeed_table import group_sum
+
+# numpy is optional, it decodes whole feeds at once
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Fields Apfeed fills in, the constant header and blank fields left out
+COLUMNS = [f for f in LAYOUT.fields if f.name and f.default is None]
+# Dates, decoded as YYYYMMDD integers like the 'd' fields
+DATES = ('vend_assign_inv_date', 'goods_received_dt', 'scheduled_pmt_dt')
+NUMERIC = set(f.name for f in COLUMNS if f.fmt == 'd' or f.name in DATES)
+
+
+def feed_body(data):
+    """The detail lines of a feed, without its header and trailer lines"""
+    start = data.find("\n") + 1 if data.startswith("**") else 0
+    end = data.rfind("\n**TRAILER")
+    body = data[start:end + 1] if end >= start else data[start:]
+    if body and not body.endswith("\n"):
+        body += "\n"
+    return body
+
+
+def fiscal_month(dates):
+    """Fiscal year and month (July is month 1) of YYYYMMDD dates as YYYYMM.
+
+    Args:
+        dates: An int or a numpy array of ints.
+    """
+    year = dates // 10000
+    month = dates // 100 % 100
+    return (year + (month >= 7)) * 100 + (month + 5) % 12 + 1
+
+
+def _decode_lines(body):
+    """Columns of the lines in body as arrays and lists, one line at a time"""
+    columns = OrderedDict(
+        (f.name, array('l') if f.name in NUMERIC else []) for f in COLUMNS
+    )
+    index = [(i, f.name) for i, f in enumerate(LAYOUT.fields)
+             if f.name in columns]
+    width = LAYOUT.width
+    for line in body.splitlines():
+        if len(line) < width:
+            line = line.ljust(width)
+        values = LAYOUT.struct.unpack_from(line)
+        for i, name in index:
+            value = values[i]
+            if name in NUMERIC:
+                value = int(value) if value.lstrip('-').isdigit() else 0
+            columns[name].append(value)
+    return columns
+
+
+def _decode_array(body):
+    """Columns of the lines in body as numpy arrays, or None if the lines
+    are not all LAYOUT.width long"""
+    stride = LAYOUT.width + 1
+    if len(body) % stride:
+        return None
+    rows = numpy.frombuffer(body, dtype=numpy.uint8).reshape(-1, stride)
+    if not (rows[:, -1] == ord("\n")).all():
+        return None
+    columns = OrderedDict()
+    for field in COLUMNS:
+        block = rows[:, LAYOUT.slices[field.name]]
+        if field.name in NUMERIC:
+            # Credits are written with a leading minus, e.g. -00000012000
+            negative = block[:, 0] == ord("-")
+            digits = block.astype(numpy.int64) - ord("0")
+            digits[negative, 0] = 0
+            powers = 10 ** numpy.arange(field.width - 1, -1, -1, dtype=numpy.int64)
+            values = digits.dot(powers)
+            values[negative] *= -1
+            values[~((digits >= 0) & (digits <= 9)).all(axis=1)] = 0
+        else:
+            values = numpy.ascontiguousarray(block).view(
+                'S%d' % field.width
+            ).ravel()
+        columns[field.name] = values
+    return columns
+
+
+def decode_feed(data, use_numpy=None):
+    """Decodes the detail lines of a feed into columns.
+
+    Args:
+        data (str): Contents of an apfeed.
+        use_numpy (bool): Decode with numpy (default: if installed).
+
+    Returns:
+        OrderedDict: Column name -> numpy array, or array / list without
+            numpy.
+
+    Raises:
+        ValueError: use_numpy is True but numpy is not installed.
+    """
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise ValueError('numpy requested but numpy is not installed')
+    body = feed_body(data)
+    if not use_numpy:
+        return _decode_lines(body)
+    columns = _decode_array(body)
+    if columns is None:
+        # Hand edited feed with short lines, decode line by line
+        lines = _decode_lines(body)
+        columns = OrderedDict()
+        for field in COLUMNS:
+            dtype = numpy.int64 if field.name in NUMERIC else 'S%d' % field.width
+            columns[field.name] = numpy.array(lines[field.name], dtype=dtype)
+    return columns
+
+
+def _array_totals(keys, values):
+    """group_sum of numpy columns: each key column is dictionary encoded,
+    the codes combined into one and the values summed per code"""
+    combined = numpy.zeros(len(values), dtype=numpy.int64)
+    for key in keys:
+        uniques, codes = numpy.unique(key, return_inverse=True)
+        combined = combined * len(uniques) + codes
+    _, first, groups = numpy.unique(combined, return_index=True,
+                                    return_inverse=True)
+    sums = numpy.zeros(len(first), dtype=numpy.int64)
+    numpy.add.at(sums, groups, values)
+    return dict(
+        (tuple(key[i].item() for key in keys), total)
+        for i, total in izip(first, sums.tolist())
+    )
+
+
+class FeedColumns(object):
+    """Decoded lines of many feeds, one column per apfeed field"""
+
+    def __init__(self, feeds, columns):
+        """
+        Args:
+            feeds (list): Feed names, indexed by the 'feed' column.
+            columns (OrderedDict): Column name -> values, all the same length.
+        """
+        self.feeds = feeds
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['feed'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def totals(self, *names):
+        """Sums pmt_amt in cents by the values of names.
+
+        'fiscal_month' can be used as a name, computed from
+        scheduled_pmt_dt.
+
+        Returns:
+            dict: Tuple of key values -> cents.
+        """
+        amounts = self.columns['pmt_amt']
+        keys = []
+        for name in names:
+            if name == 'fiscal_month':
+                dates = self.columns['scheduled_pmt_dt']
+                if numpy is not None and isinstance(dates, numpy.ndarray):
+                    keys.append(fiscal_month(dates))
+                else:
+                    keys.append([fiscal_month(d) for d in dates])
+            else:
+                keys.append(self.columns[name])
+        if numpy is not None and isinstance(amounts, numpy.ndarray):
+            return _array_totals(keys, amounts)
+        return dict(group_sum(izip(*keys), amounts))
+
+    def save(self, path):
+        """Saves the columns as a numpy .npz file.
+
+        Raises:
+            ValueError: numpy is not installed.
+        """
+        if numpy is None:
+            raise ValueError('Saving columns requires numpy')
+        arrays = dict((name, numpy.asarray(values))
+                      for name, values in self.columns.iteritems())
+        with open(path, 'wb') as npz_file:
+            numpy.savez(npz_file, _feeds=numpy.array(self.feeds), **arrays)
+
+
+def load_feeds(paths, use_numpy=None):
+    """Decodes feeds into one FeedColumns, with a 'feed' column of the
+    index in paths of the feed each line came from"""
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    parts = []
+    feed_col = []
+    for i, path in enumerate(paths):
+        with open(path, 'rb') as feed:
+            columns = decode_feed(feed.read(), use_numpy)
+        parts.append(columns)
+        rows = len(columns[COLUMNS[0].name])
+        feed_col.append(numpy.full(rows, i, dtype=numpy.int32) if use_numpy
+                        else array('l', [i]) * rows)
+    columns = OrderedDict()
+    for field in COLUMNS:
+        if use_numpy:
+            columns[field.name] = numpy.concatenate(
+                [part[field.name] for part in parts]
+            ) if parts else numpy.array([])
+        else:
+            values = array('l') if field.name in NUMERIC else []
+            for part in parts:
+                values.extend(part[field.name])
+            columns[field.name] = values
+    if use_numpy:
+        columns['feed'] = numpy.concatenate(feed_col) if feed_col else numpy.array([])
+    else:
+        columns['feed'] = array('l')
+        for part in feed_col:
+            columns['feed'].extend(part)
+    return FeedColumns([os.path.basename(p) for p in paths], columns)
+
+
+def load_columns(path):
+    """FeedColumns saved with FeedColumns.save"""
+    if numpy is None:
+        raise ValueError('Loading columns requires numpy')
+    saved = numpy.load(path)
+    columns = OrderedDict(
+        (name, saved[name]) for name in [f.name for f in COLUMNS] + ['feed']
+    )
+    return FeedColumns(list(saved['_feeds']), columns)
+
+
+# pylint: disable=C0103
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Decodes apfeeds into columns, for totals or to save as'
+        ' a binary columnar file'
+    )
+    parser.add_argument('feeds', nargs='*', help='Apfeed files')
+    parser.add_argument(
+        '-l', '--load',
+        help='Read columns saved with --output instead of decoding feeds'
+    )
+    parser.add_argument('-o', '--output', help='Save the columns as .npz')
+    parser.add_argument(
+        '--totals-by',
+        help='Print pmt_amt totals as csv by comma separated columns,'
+        ' e.g. account_nbr,fiscal_month'
+    )
+    args = parser.parse_args()
+
+    if args.load is not None:
+        table = load_columns(args.load)
+    else:
+        table = load_feeds(args.feeds)
+    print >> sys.stderr, "%d lines from %d feeds" % (len(table), len(table.feeds))
+    if args.output is not None:
+        table.save(args.output)
+    if args.totals_by is not None:
+        names = args.totals_by.split(",")
+        writer = csv.writer(sys.stdout)
+        writer.writerow(names + ['pmt_amt'])
+        for key, cents in sorted(table.totals(*names).iteritems()):
+            writer.writerow([str(v).strip() for v in key] + ["%.2f" % (cents / 100.0)])
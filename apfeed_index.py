@@ -0,0 +1,241 @@
+"""
+Index of the archived apfeeds for read_apfeed.py lookups
+Maps the org_doc_nbr, invoice number and vendor code of every archived
+apfeed line to its file and byte offset, so finding a line is an index
+probe and a seek instead of reading every feed in the archive. Stored in
+sqlite next to the feeds. upload_apfeed.py adds each feed as it is
+archived, and update catches up with anything added or changed by hand.
+Feeds in the compressed archive (block_archive.py) are indexed and read
+the same way, a line costing the decompression of one block.
+"""
+
+import glob
+import os
+import sqlite3
+
+from apfeed_layout import LAYOUT
+
+INDEX_NAME = "apfeed.index.sqlite"
+FEED_PATTERN = "apfeed.LG.*"
+
+SCHEMA = """
+    create table if not exists feeds (
+        name text primary key,
+        size integer,
+        mtime real,
+        first_org_doc_nbr integer,
+        last_org_doc_nbr integer
+    );
+    create table if not exists lines (
+        feed text,
+        offset integer,
+        org_doc_nbr integer,
+        inv_nbr text,
+        vend_code text
+    );
+    create index if not exists lines_feed on lines (feed);
+    create index if not exists lines_org_doc_nbr on lines (org_doc_nbr);
+    create index if not exists lines_inv_nbr on lines (inv_nbr);
+    create index if not exists lines_vend_code on lines (vend_code);
+"""
+
+
+def scan_lines(lines):
+    """Yields (offset, org_doc_nbr, inv_nbr, vend_code) of each apfeed line.
+
+    The header and trailer are skipped, as are lines whose org_doc_nbr is
+    not a number.
+
+    Args:
+        lines (iterable): Lines of a feed, with their newlines.
+    """
+    offset = 0
+    for line in lines:
+        if not line.startswith("**"):
+            org_doc_nbr = LAYOUT.get(line, 'org_doc_nbr')
+            if org_doc_nbr.isdigit():
+                yield (offset, int(org_doc_nbr),
+                       LAYOUT.get(line, 'vend_assign_inv_nbr').rstrip(),
+                       LAYOUT.get(line, 'vend_code').rstrip())
+        offset += len(line)
+
+
+def scan_feed(path):
+    """scan_lines of a feed file"""
+    with open(path, 'rb') as feed:
+        for entry in scan_lines(feed):
+            yield entry
+
+
+def scan_directory(directory, archive=None):
+    """Yields (path, offset, org_doc_nbr, inv_nbr, vend_code) of every line.
+
+    Reads all the feeds of a directory and of its compressed archive, for
+    lookups where no index can be kept.
+
+    Args:
+        directory (str): Directory of the archived apfeeds.
+        archive (BlockArchive): Compressed archive holding more feeds.
+    """
+    on_disk = set(os.path.basename(path) for path in
+                  glob.glob(os.path.join(directory, FEED_PATTERN)))
+    names = set(on_disk)
+    if archive is not None:
+        names.update(name for name, _, _ in archive.entries(FEED_PATTERN))
+    for name in sorted(names):
+        path = os.path.join(directory, name)
+        if name in on_disk:
+            entries = scan_feed(path)
+        else:
+            entries = scan_lines(archive.read(name).splitlines(True))
+        for entry in entries:
+            yield (path,) + entry
+
+
+class ApfeedIndex(object):
+    """Persistent index of the apfeeds in one archive directory"""
+
+    def __init__(self, directory, path=None, archive=None):
+        """
+        Args:
+            directory (str): Directory of the archived apfeeds.
+            path (str): sqlite file, created if missing
+                (default: <directory>/apfeed.index.sqlite).
+            archive (BlockArchive): Compressed archive holding more feeds.
+        """
+        self.directory = directory
+        self.archive = archive
+        if path is None:
+            path = os.path.join(directory, INDEX_NAME)
+        self.con = sqlite3.connect(path)
+        self.con.executescript(SCHEMA)
+
+    def add_feed(self, name):
+        """Indexes a feed, replacing what was indexed for it before.
+
+        Args:
+            name (str): File name of the feed in the directory.
+
+        Returns:
+            int: Number of lines indexed.
+        """
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path) or self.archive is None:
+            size, mtime = self._signature(path)
+            rows = [(name,) + entry for entry in scan_feed(path)]
+        else:
+            size, mtime = self.archive.stat(name)
+            lines = self.archive.read(name).splitlines(True)
+            rows = [(name,) + entry for entry in scan_lines(lines)]
+        nbrs = [row[2] for row in rows]
+        with self.con:
+            self._remove(name)
+            self.con.executemany("insert into lines values (?, ?, ?, ?, ?)",
+                                 rows)
+            self.con.execute(
+                "insert into feeds values (?, ?, ?, ?, ?)",
+                (name, size, mtime,
+                 min(nbrs) if nbrs else None, max(nbrs) if nbrs else None)
+            )
+        return len(rows)
+
+    @staticmethod
+    def _signature(path):
+        """(size, mtime) of a feed file"""
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+
+    def _remove(self, name):
+        """Drops a feed from the index, inside the caller's transaction"""
+        self.con.execute("delete from lines where feed = ?", (name,))
+        self.con.execute("delete from feeds where name = ?", (name,))
+
+    def update(self):
+        """Indexes new and changed feeds and drops the ones removed.
+
+        Only the size and mtime of feeds already indexed are checked, so an
+        update of an archive that did not change reads no feed.
+
+        Returns:
+            int: Number of feeds (re)indexed.
+        """
+        indexed = dict(
+            (name, (size, mtime)) for name, size, mtime in
+            self.con.execute("select name, size, mtime from feeds")
+        )
+        feeds = dict()
+        if self.archive is not None:
+            for name, size, added in self.archive.entries(FEED_PATTERN):
+                feeds[name] = (size, added)
+        for path in glob.glob(os.path.join(self.directory, FEED_PATTERN)):
+            feeds[os.path.basename(path)] = self._signature(path)
+        added = 0
+        for name, signature in feeds.iteritems():
+            if indexed.get(name) != signature:
+                self.add_feed(name)
+                added += 1
+        with self.con:
+            for name in set(indexed) - set(feeds):
+                self._remove(name)
+        return added
+
+    def _find(self, column, value):
+        """(path, offset) of the lines where column is value, in file order"""
+        return [
+            (os.path.join(self.directory, feed), offset) for feed, offset in
+            self.con.execute(
+                "select feed, offset from lines where %s = ?"
+                " order by feed, offset" % column, (value,)
+            )
+        ]
+
+    def find_org_doc(self, org_doc_nbr):
+        """(path, offset) of the lines of an org_doc_nbr"""
+        return self._find('org_doc_nbr', int(org_doc_nbr))
+
+    def find_invoice(self, inv_nbr):
+        """(path, offset) of the lines of a vendor invoice number"""
+        return self._find('inv_nbr', inv_nbr)
+
+    def find_vendor(self, vend_code):
+        """(path, offset) of the lines of a vendor code"""
+        return self._find('vend_code', vend_code)
+
+    def feeds_for_org_doc(self, org_doc_nbr):
+        """Feeds whose org_doc_nbr range covers org_doc_nbr, newest first"""
+        return [
+            os.path.join(self.directory, name) for (name,) in
+            self.con.execute(
+                "select name from feeds where first_org_doc_nbr <= ?"
+                " and last_org_doc_nbr >= ? order by name desc",
+                (int(org_doc_nbr), int(org_doc_nbr))
+            )
+        ]
+
+    def close(self):
+        """Closes the index"""
+        self.con.close()
+
+
+def read_lines(locations, archive=None):
+    """Reads the apfeed lines at (path, offset) locations, one open per file.
+
+    Args:
+        locations (list): (path, offset) as found by ApfeedIndex.
+        archive (BlockArchive): Where feeds missing from the directory are.
+    """
+    lines = []
+    feed = None
+    for path, offset in locations:
+        if archive is not None and not os.path.exists(path):
+            lines.append(archive.read_line(os.path.basename(path), offset))
+            continue
+        if feed is None or feed.name != path:
+            if feed is not None:
+                feed.close()
+            feed = open(path, 'rb')
+        feed.seek(offset)
+        lines.append(feed.readline())
+    if feed is not None:
+        feed.close()
+    return lines
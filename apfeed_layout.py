@@ -0,0 +1,130 @@
+"""
+Fixed-width layout of an apfeed record
+Shared by xml_to_apfeed.py (writing), read_apfeed.py and upload_apfeed.py
+(reading) so every tool agrees on the column positions.
+The layout is declared once as a list of fields and compiled to a
+% template for packing and a struct.Struct for unpacking, so a whole
+line is built or split with a single call.
+"""
+
+import struct
+
+from collections import namedtuple
+
+HEADER = "**HEADERLGGENERALLIBRARY %s"
+TRAILER = "**TRAILERGENERALLIBRARY %06d"
+
+# name: lower case KFS column name, None for unnamed filler
+# width: number of characters
+# fmt: 's' left justified and truncated text, 'd' zero padded integer
+# default: value written when not supplied, None if it must be supplied
+Field = namedtuple('Field', ['name', 'width', 'fmt', 'default'])
+
+
+def text(name, width, default=None):
+    """Left justified text field"""
+    return Field(name, width, 's', default)
+
+
+def number(name, width):
+    """Zero padded integer field"""
+    return Field(name, width, 'd', None)
+
+
+def blank(name, width):
+    """Field apfeed always leaves empty"""
+    return Field(name, width, 's', "")
+
+
+class Layout(object):
+    """Compiled fixed-width record layout"""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.width = sum(f.width for f in fields)
+        self.names = [f.name for f in fields if f.name]
+        self.slices = dict()
+
+        template = ""
+        start = 0
+        for field in fields:
+            end = start + field.width
+            if field.name:
+                self.slices[field.name] = slice(start, end)
+            if field.default is not None:
+                template += "%-*.*s" % (field.width, field.width, field.default)
+            elif field.fmt == 'd':
+                template += "%%(%s)0%dd" % (field.name, field.width)
+            else:
+                template += "%%(%s)-%d.%ds" % (field.name, field.width, field.width)
+            start = end
+        self.template = template
+        self.struct = struct.Struct("".join("%ds" % f.width for f in fields))
+        self.named = [i for i, f in enumerate(fields) if f.name]
+
+    def pack(self, values):
+        """
+        Formats a record from a dict of field values.
+        Fields with a default do not need to be in values.
+        """
+        return self.template % values
+
+    def unpack(self, line):
+        """
+        Splits a record into a dict of every named field.
+        Short lines are padded with spaces rather than rejected.
+        """
+        if len(line) < self.width:
+            line = line.ljust(self.width)
+        values = self.struct.unpack_from(line)
+        return dict((self.fields[i].name, values[i]) for i in self.named)
+
+    def get(self, line, name):
+        """Raw value of a single field"""
+        return line[self.slices[name]]
+
+
+LAYOUT = Layout([
+    text('header', 15, "GENERALLIBRARY "),
+    text('time', 14),
+    number('org_doc_nbr', 7),
+    text('emp_ind', 1),
+    text('vend_code', 10),
+    text('vend_assign_inv_nbr', 15),
+    text('vend_assign_inv_date', 8),
+    text('addr_select_vend_nbr', 14),
+    blank('pmt_remit_nm', 40),
+    blank('pmt_remit_line_1_addr', 40),
+    blank('pmt_remit_line_2_addr', 40),
+    blank('pmt_remit_line_3_addr', 40),
+    blank('pmt_remit_city_nm', 40),
+    blank('pmt_remit_st_cd', 2),
+    blank('pmt_remit_zip_cd', 11),
+    blank('pmt_remit_cntry_cd', 2),
+    blank('vend_st_res_ind', 1),
+    blank('inv_received_dt', 8),
+    text('goods_received_dt', 8),
+    text('org_shp_zip_cd', 11),
+    text('org_shp_state_cd', 2),
+    text('pmt_grp_cd', 1),
+    blank('inv_fob_cd', 2),
+    blank('disc_term_cd', 2),
+    blank(None, 1),
+    text('scheduled_pmt_dt', 8),
+    text('pmt_non_check_ind', 1),
+    text('attachment_req_ind', 1),
+    number('pmt_line_nbr', 5),
+    text('fin_coa_cd', 1),
+    blank(None, 1),
+    text('account_nbr', 7),
+    blank('sub_acct_nbr', 5),
+    text('fin_object_cd', 4),
+    blank('fin_sub_obj_cd', 3),
+    blank('project_cd', 10),
+    text('org_reference_id', 8),
+    text('pmt_tax_cd', 1),
+    number('pmt_amt', 12),
+    text('apply_disc_ind', 1),
+    text('eft_override_ind', 1),
+    blank('ap_pmt_purpose_desc', 120),
+])
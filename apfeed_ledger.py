@@ -0,0 +1,125 @@
+"""
+Ledger of what xml_to_apfeed.py has already converted
+Keeps the content hash of every converted XML file and the
+(invoice number, vendor code, line number) key of every invoice line,
+each tagged with the apfeed it went into, so reconverting the same
+export or an invoice repeated across overlapping exports is caught.
+Stored in sqlite; lookups are primary key index probes, so they stay
+fast with hundreds of thousands of historical invoices.
+Nothing is kept unless commit is called after the apfeed is written.
+"""
+
+import hashlib
+import sqlite3
+
+SCHEMA = """
+    create table if not exists files (
+        hash text primary key,
+        name text,
+        apfeed text
+    );
+    create table if not exists invoices (
+        invoice_number text,
+        vendor_code text,
+        line_number text,
+        apfeed text,
+        primary key (invoice_number, vendor_code, line_number)
+    );
+    create index if not exists files_apfeed on files (apfeed);
+    create index if not exists invoices_apfeed on invoices (apfeed);
+"""
+
+
+def file_hash(path, block_size=1 << 20):
+    """SHA-256 hex digest of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        block = fh.read(block_size)
+        while block:
+            digest.update(block)
+            block = fh.read(block_size)
+    return digest.hexdigest()
+
+
+class Ledger(object):
+    """Persistent record of converted files and invoice lines"""
+
+    def __init__(self, path, apfeed=None):
+        """
+        Args:
+            path (str): sqlite file, created if missing.
+            apfeed (str): Name of the apfeed new entries will be recorded for.
+        """
+        self.apfeed = apfeed
+        self.con = sqlite3.connect(path)
+        self.con.executescript(SCHEMA)
+
+    def add_file(self, digest, name):
+        """Records a file by content hash.
+
+        Returns:
+            str: Apfeed the same content was already converted into,
+                or None if it is new and has been recorded.
+        """
+        row = self.con.execute(
+            "select apfeed from files where hash = ?", (digest,)
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        self.con.execute("insert into files values (?, ?, ?)",
+                         (digest, name, self.apfeed))
+        return None
+
+    def add_invoice(self, invoice_number, vendor_code, line_numbers):
+        """Records the lines of an invoice.
+
+        Only lines converted into another apfeed count. An export can hold
+        a charge and its reversal under the same keys, so repeats within
+        the apfeed being built are allowed.
+
+        Returns:
+            str: Apfeed any of the lines was already converted into,
+                or None if all are new and have been recorded.
+        """
+        cur = self.con.cursor()
+        for line_number in line_numbers:
+            row = cur.execute(
+                "select apfeed from invoices where invoice_number = ?"
+                " and vendor_code = ? and line_number = ?",
+                (invoice_number, vendor_code, line_number)
+            ).fetchone()
+            if row is not None and row[0] != self.apfeed:
+                return row[0]
+        cur.executemany(
+            "insert or ignore into invoices values (?, ?, ?, ?)",
+            [(invoice_number, vendor_code, line_number, self.apfeed)
+             for line_number in line_numbers]
+        )
+        return None
+
+    def release(self, apfeed):
+        """Forgets everything recorded for an apfeed that was not uploaded.
+
+        Returns:
+            int: Number of files and invoice lines removed.
+        """
+        removed = self.con.execute(
+            "delete from files where apfeed = ?", (apfeed,)
+        ).rowcount
+        removed += self.con.execute(
+            "delete from invoices where apfeed = ?", (apfeed,)
+        ).rowcount
+        self.con.commit()
+        return removed
+
+    def commit(self):
+        """Keeps what was recorded, call once the apfeed is written"""
+        self.con.commit()
+
+    def rollback(self):
+        """Drops what was recorded since the last commit"""
+        self.con.rollback()
+
+    def close(self):
+        """Closes the ledger, dropping anything not committed"""
+        self.con.close()
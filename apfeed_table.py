@@ -0,0 +1,148 @@
+"""
+Columnar table of the invoices and invoice lines going into an apfeed
+xml_to_apfeed.py fills it as invoices are converted; the apfeed writer,
+validation and the csv reports all read from it.
+Each column is a typed array (or a list for free text), amounts are
+integer cents, and account numbers are dictionary encoded, so a line
+costs a few machine words instead of a dict or ElementTree per line.
+Use tax is worked out on each group's taxable cents and rounded to a
+whole cent half up, in decimal, so reports never round a binary float.
+"""
+
+from array import array
+from collections import defaultdict
+from decimal import ROUND_HALF_UP, Decimal
+from itertools import izip
+
+
+def group_sum(keys, values):
+    """Sums values by key in one pass over two parallel columns.
+
+    Returns:
+        dict: key -> sum of its values.
+    """
+    out = defaultdict(int)
+    for key, value in izip(keys, values):
+        out[key] += value
+    return out
+
+
+def use_tax(cents, tax_perc):
+    """Use tax in whole cents of an amount in cents, half a cent rounded up.
+
+    Args:
+        cents (int): Taxable amount in cents.
+        tax_perc (float): Use tax rate in percent.
+    """
+    tax = Decimal(cents) * Decimal(str(tax_perc)) / 100
+    return int(tax.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+class LineTable(object):
+    """Invoice and invoice line columns, one row per apfeed line"""
+
+    def __init__(self):
+        # Invoice columns, one row per invoice
+        self.org_doc_nbr = array('l')
+        self.inv_nbr = []
+        self.vend_code = []
+        self.addr_select_vend_nbr = []
+        self.inv_date = array('l')
+        self.goods_received_dt = []
+        self.attachment_req_ind = array('c')
+
+        # Line columns, one row per apfeed line
+        self.inv = array('l')
+        self.pmt_line_nbr = array('l')
+        self.account = array('l')
+        self.org_reference_id = []
+        self.pmt_tax_cd = array('c')
+        self.pmt_amt = array('l')
+
+        # Dictionary for the account column
+        self.accounts = []
+        self.account_codes = dict()
+
+    def __len__(self):
+        return len(self.inv)
+
+    def add_invoice(self, org_doc_nbr, inv_nbr, vend_code, addr_select_vend_nbr,
+                    inv_date, goods_received_dt, attachment_req_ind):
+        """Appends an invoice row.
+
+        Args:
+            inv_date (int): Invoice date as YYYYMMDD.
+
+        Returns:
+            int: Row index of the invoice.
+        """
+        self.org_doc_nbr.append(org_doc_nbr)
+        self.inv_nbr.append(inv_nbr)
+        self.vend_code.append(vend_code)
+        self.addr_select_vend_nbr.append(addr_select_vend_nbr)
+        self.inv_date.append(inv_date)
+        self.goods_received_dt.append(goods_received_dt)
+        self.attachment_req_ind.append(attachment_req_ind)
+        return len(self.inv_nbr) - 1
+
+    def add_line(self, inv, pmt_line_nbr, account_nbr, org_reference_id,
+                 pmt_tax_cd, pmt_amt):
+        """Appends a line row.
+
+        Args:
+            inv (int): Row index of the line's invoice.
+            pmt_amt (int): Amount in cents.
+
+        Returns:
+            int: Row index of the line.
+        """
+        code = self.account_codes.get(account_nbr)
+        if code is None:
+            code = self.account_codes[account_nbr] = len(self.accounts)
+            self.accounts.append(account_nbr)
+        self.inv.append(inv)
+        self.pmt_line_nbr.append(pmt_line_nbr)
+        self.account.append(code)
+        self.org_reference_id.append(org_reference_id)
+        self.pmt_tax_cd.append(pmt_tax_cd)
+        self.pmt_amt.append(pmt_amt)
+        return len(self.inv) - 1
+
+    def taxable_amt(self):
+        """Amount column with lines not subject to use tax zeroed"""
+        return array('l', (amt if tax != '0' else 0
+                           for amt, tax in izip(self.pmt_amt, self.pmt_tax_cd)))
+
+    def totals_by_account(self, tax_perc):
+        """Total and use tax cents per account number.
+
+        Args:
+            tax_perc (float): Use tax rate in percent.
+
+        Returns:
+            dict: account_nbr -> (total cents, use tax cents).
+        """
+        totals = group_sum(self.account, self.pmt_amt)
+        taxable = group_sum(self.account, self.taxable_amt())
+        return dict((self.accounts[code], (amt, use_tax(taxable[code], tax_perc)))
+                    for code, amt in totals.iteritems())
+
+    def totals_by_invoice(self, tax_perc):
+        """Total and use tax cents per invoice number.
+
+        Invoices that appear more than once share one total.
+
+        Args:
+            tax_perc (float): Use tax rate in percent.
+
+        Returns:
+            dict: inv_nbr -> (total cents, use tax cents).
+        """
+        totals = group_sum(self.inv, self.pmt_amt)
+        taxable = group_sum(self.inv, self.taxable_amt())
+        grouped = dict()
+        for inv, amt in totals.iteritems():
+            total, tax = grouped.get(self.inv_nbr[inv], (0, 0))
+            grouped[self.inv_nbr[inv]] = (total + amt, tax + taxable[inv])
+        return dict((inv_nbr, (total, use_tax(tax, tax_perc)))
+                    for inv_nbr, (total, tax) in grouped.iteritems())
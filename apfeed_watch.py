@@ -0,0 +1,222 @@
+"""
+Watch-folder loop for xml_to_apfeed.py --watch
+Keeps one warm process that converts Alma exports as soon as they are
+dropped in the staging directory, instead of a cold start per conversion.
+The staging and apfeed directories are watched with Linux inotify (through
+ctypes, no extra dependency); elsewhere they are polled. A file is
+converted once it has not changed for a settle time, so exports still
+being copied are left alone. Progress is published in a JSON status file
+the front end can read.
+"""
+
+import ctypes
+import ctypes.util
+import datetime
+import logging
+import os
+import select
+import time
+
+from metrics import write_json
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+
+class Inotify(object):
+    """Wakes up when files in the watched directories change"""
+
+    MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE)
+
+    def __init__(self, paths):
+        """
+        Args:
+            paths (list): Directories to watch.
+
+        Raises:
+            OSError: inotify is not available or a watch could not be added.
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        for path in paths:
+            if libc.inotify_add_watch(self.fd, path, self.MASK) < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, "inotify_add_watch failed", path)
+
+    def wait(self, timeout):
+        """Blocks until a change or timeout seconds.
+
+        Returns:
+            bool: True if something changed. The events themselves are
+                dropped, the caller rescans the directories.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        os.read(self.fd, 65536)
+        return True
+
+    def close(self):
+        """Stops watching"""
+        os.close(self.fd)
+
+
+class Poller(object):
+    """Stand in for Inotify where it is not available"""
+
+    def wait(self, timeout):
+        """Sleeps timeout seconds, the caller rescans the directories"""
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        """Nothing to release"""
+        pass
+
+
+def open_watcher(paths):
+    """Inotify for paths, or a Poller if inotify cannot be used"""
+    try:
+        return Inotify(paths)
+    except (OSError, TypeError) as err:
+        logging.warn("Polling for new xml files, inotify unavailable: %s", err)
+        return Poller()
+
+
+def scan_xmls(xml_dir, settle, now=None):
+    """Finds xml files in the staging directory.
+
+    Args:
+        xml_dir (str): Staging directory.
+        settle (float): Seconds a file must be unchanged to be ready.
+        now (float): Current time (default: time.time()).
+
+    Returns:
+        tuple: (ready, settling). ready is a sorted list of
+            (path, (size, mtime)) for files unchanged for settle seconds,
+            settling is True if other xml files are still being written.
+    """
+    if now is None:
+        now = time.time()
+    ready = []
+    settling = False
+    for name in sorted(os.listdir(xml_dir)):
+        if not name.endswith(".xml"):
+            continue
+        path = os.path.join(xml_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Moved away between listdir and stat
+            continue
+        if now - stat.st_mtime < settle:
+            settling = True
+        else:
+            ready.append((path, (stat.st_size, stat.st_mtime)))
+    return ready, settling
+
+
+def pending_apfeeds(apfeed_dir):
+    """Apfeeds waiting for upload, temporary files being written excluded"""
+    return sorted(name for name in os.listdir(apfeed_dir)
+                  if not name.startswith("."))
+
+
+class Status(object):
+    """JSON status file of the watch loop, rewritten on every change"""
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path (str): Status file, None to only keep the status in memory.
+        """
+        self.path = path
+        self.data = {'pid': os.getpid(), 'state': 'starting'}
+
+    def update(self, **fields):
+        """Sets fields and rewrites the status file"""
+        self.data.update(fields)
+        self.data['updated'] = datetime.datetime.now().strftime(
+            '%Y-%m-%dT%H:%M:%S'
+        )
+        if self.path is not None:
+            write_json(self.path, self.data)
+
+
+def watch(xml_dir, apfeed_dir, convert, status=None, settle=2.0, interval=60.0,
+          stop=None):
+    """Converts xml files as they arrive in xml_dir, until stopped.
+
+    All ready files are converted together into one apfeed, like a normal
+    run. While an apfeed is still in apfeed_dir waiting for upload nothing
+    is converted, since its org_doc_nbr range is only released by
+    upload_apfeed.py. A batch that fails is not retried until one of its
+    files changes.
+
+    Args:
+        xml_dir (str): Staging directory to watch.
+        apfeed_dir (str): Directory apfeeds are created in.
+        convert (callable): Called with a list of xml paths, returns the
+            result dict of xml_to_apfeed.convert.
+        status (Status): Where the state and last result are published.
+        settle (float): Seconds a file must be unchanged to be converted.
+        interval (float): Longest wait between rescans.
+        stop (callable): Returns True when the loop should end, checked
+            after every wake up (default: run until interrupted).
+    """
+    if status is None:
+        status = Status()
+    watcher = open_watcher([xml_dir, apfeed_dir])
+    failed = dict()
+    status.update(state='idle', xml_dir=xml_dir, apfeed_dir=apfeed_dir)
+    logging.info("Watching %s", xml_dir)
+    try:
+        while stop is None or not stop():
+            ready, settling = scan_xmls(xml_dir, settle)
+            present = set(path for path, _ in ready)
+            for path in list(failed):
+                if path not in present:
+                    del failed[path]
+            todo = [path for path, sig in ready if failed.get(path) != sig]
+
+            waiting = pending_apfeeds(apfeed_dir) if todo else []
+            if todo and waiting:
+                if status.data['state'] != 'waiting':
+                    logging.info("Waiting for %s to be uploaded or deleted",
+                                 ", ".join(waiting))
+                status.update(state='waiting', pending=waiting)
+            elif todo:
+                status.update(state='converting', files=todo, pending=[])
+                try:
+                    result = convert(todo)
+                except Exception as err:  # pylint: disable=broad-except
+                    logging.exception("Converting %s failed", ", ".join(todo))
+                    result = {'status': 'error', 'files': todo,
+                              'error': str(err)}
+                if result['status'] != 'converted':
+                    failed.update((path, sig) for path, sig in ready
+                                  if path in todo)
+                result['finished'] = datetime.datetime.now().strftime(
+                    '%Y-%m-%dT%H:%M:%S'
+                )
+                status.update(state='idle', last=result, files=[])
+                # Files may have arrived during the conversion
+                continue
+            elif status.data['state'] != 'idle':
+                status.update(state='idle', pending=[])
+
+            watcher.wait(min(settle, interval) if settling else interval)
+    finally:
+        watcher.close()
+        status.update(state='stopped')
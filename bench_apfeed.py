@@ -0,0 +1,314 @@
+#!/usr/bin/env python2.7
+
+"""
+Benchmarks the xml_to_apfeed.py conversion pipeline
+Inputs: Synthetic Alma exports from gen_alma_xml.py, generated on demand
+Output: Wall time, throughput and peak memory of each stage, appended to
+        a results csv tagged with the code version
+Each stage runs in its own process so its peak memory is not hidden by
+the stages before it. Results are compared to the last run of a
+different version, so regressions show up as a slower ratio.
+"""
+
+import argparse
+import csv
+import datetime
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+
+from multiprocessing import Process, Queue
+from timeit import default_timer
+
+import gen_alma_xml
+import xml_to_apfeed
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+RESULT_FIELDS = ('date', 'version', 'python', 'invoices', 'stage', 'seconds',
+                 'lines', 'lines_per_sec', 'peak_rss_kb', 'stage_rss_kb')
+
+
+def filled_apfeed(path, parser):
+    """Apfeed holding every invoice of an xml file"""
+    apf = xml_to_apfeed.Apfeed()
+    for inv in xml_to_apfeed.iter_invoices(path, parser):
+        apf.add_inv(inv)
+    return apf
+
+
+def count_lines(records):
+    """Number of invoice lines in extract_invoice records"""
+    return sum(len(rec['lines']) for rec in records)
+
+
+# Each stage is a (setup, run) pair. setup builds the stage's input and is
+# not timed, run does the timed work and returns the number of lines done.
+def setup_file(path, parser):
+    return path, parser
+
+
+def run_xml_to_invoices(state):
+    invs = xml_to_apfeed.xml_to_invoices(state[0])
+    return count_lines(xml_to_apfeed.extract_invoice(inv) for inv in invs)
+
+
+def run_iter_invoices(state):
+    return count_lines(xml_to_apfeed.extract_invoice(inv)
+                       for inv in xml_to_apfeed.iter_invoices(*state))
+
+
+def setup_invoices(path, parser):
+    return xml_to_apfeed.xml_to_invoices(path)
+
+
+def run_add_inv(invs):
+    apf = xml_to_apfeed.Apfeed()
+    for inv in invs:
+        apf.add_inv(inv)
+    return apf.count
+
+
+def setup_records(path, parser):
+    return xml_to_apfeed.extract_file(path, parser)
+
+
+def run_add_record(records):
+    apf = xml_to_apfeed.Apfeed()
+    for rec in records:
+        apf.add_record(rec)
+    return apf.count
+
+
+def setup_stream(path, parser):
+    return setup_records(path, parser), tempfile.mkdtemp()
+
+
+def run_stream(state):
+    records, out_dir = state
+    apf = xml_to_apfeed.Apfeed(os.path.join(out_dir, "apfeed.LG.bench"))
+    for rec in records:
+        apf.add_record(rec)
+    apf.close()
+    shutil.rmtree(out_dir)
+    return apf.count
+
+
+def run_str(apf):
+    str(apf)
+    return apf.count
+
+
+def setup_reports(path, parser):
+    return filled_apfeed(path, parser), tempfile.mkdtemp()
+
+
+def run_reports(state):
+    apf, out_dir = state
+    apf.write_eid_report(os.path.join(out_dir, "external_id.csv"))
+    apf.write_invoice_report(os.path.join(out_dir, "invoice_tax.csv"))
+    shutil.rmtree(out_dir)
+    return apf.count
+
+
+# name: (setup, run, description)
+STAGES = [
+    ('xml_to_invoices', setup_file, run_xml_to_invoices,
+     'parse the whole xml into ElementTrees and extract'),
+    ('iter_invoices', setup_file, run_iter_invoices,
+     'stream parse the xml and extract'),
+    ('add_inv', setup_invoices, run_add_inv,
+     'format parsed invoices as apfeed lines in memory'),
+    ('add_record', setup_records, run_add_record,
+     'format extracted records, Apfeed.line without the xml walk'),
+    ('stream', setup_stream, run_stream,
+     'format extracted records and stream them to an apfeed file'),
+    ('str', filled_apfeed, run_str,
+     'Apfeed.__str__ of a filled apfeed'),
+    ('reports', setup_reports, run_reports,
+     'write the external id and invoice tax csv reports'),
+]
+STAGE_NAMES = [stage[0] for stage in STAGES]
+
+
+def max_rss():
+    """Peak resident memory of this process in KB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(stage, path, parser):
+    """Runs a stage in this process.
+
+    Returns:
+        dict: seconds, lines, peak_rss_kb of the process and stage_rss_kb,
+            how much the stage itself raised the peak.
+    """
+    _, setup, run, _ = STAGES[STAGE_NAMES.index(stage)]
+    state = setup(path, parser)
+    before = max_rss()
+    start = default_timer()
+    lines = run(state)
+    seconds = default_timer() - start
+    peak = max_rss()
+    return {'seconds': seconds, 'lines': lines,
+            'peak_rss_kb': peak, 'stage_rss_kb': peak - before}
+
+
+def measure_child(queue, stage, path, parser):
+    """Process target, puts the result of measure on the queue"""
+    # Keep the per stage log messages, like the report totals, quiet
+    logging.disable(logging.INFO)
+    queue.put(measure(stage, path, parser))
+
+
+def measure_isolated(stage, path, parser):
+    """Runs a stage in a fresh process, see measure"""
+    queue = Queue()
+    proc = Process(target=measure_child, args=(queue, stage, path, parser))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    if proc.exitcode != 0:
+        raise RuntimeError("Stage %s exited with %d" % (stage, proc.exitcode))
+    return result
+
+
+def code_version():
+    """git describe of the checkout being benchmarked, unknown without git"""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=SCRIPT_DIR, stderr=open(os.devnull, 'w')
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def synthetic_xml(xml_dir, invoices, seed):
+    """Path of a generated export, generating it if it is not cached"""
+    path = os.path.join(xml_dir, "synthetic.%d.%d.xml" % (invoices, seed))
+    if not os.path.exists(path):
+        logging.info("Generating %s", path)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as xml_file:
+            gen_alma_xml.write_xml(xml_file, invoices, seed)
+        os.rename(tmp_path, path)
+    return path
+
+
+def read_results(path):
+    """Previous results as a list of dicts, empty if there are none"""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as results_file:
+        return list(csv.DictReader(results_file))
+
+
+def baseline(results, version, invoices, stage):
+    """Most recent result of the same run from a different version"""
+    for row in reversed(results):
+        if (row['version'] != version and row['stage'] == stage
+                and int(row['invoices']) == invoices):
+            return row
+    return None
+
+
+# pylint: disable=C0103
+if __name__ == "__main__":
+    cwd = os.getcwd()
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the xml_to_apfeed conversion stages.',
+        epilog='stages:\n' + "\n".join("  %-16s %s" % (name, desc)
+                                        for name, _, _, desc in STAGES),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        '-n', '--invoices',
+        type=int,
+        nargs='+',
+        default=[1000, 10000],
+        help='number of invoices of each synthetic export'
+        ' (default: 1000 10000)'
+    )
+    parser.add_argument(
+        '-s', '--stages',
+        nargs='+',
+        choices=STAGE_NAMES,
+        default=STAGE_NAMES,
+        help='stages to run (default: all)'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='random seed of the synthetic exports (default: 0)'
+    )
+    parser.add_argument(
+        '--parser',
+        choices=xml_to_apfeed.PARSERS,
+        default='auto',
+        help='XML parser backend (default: auto)'
+    )
+    parser.add_argument(
+        '--xml-dir',
+        default=os.path.join(cwd, "bench"),
+        help='Directory where synthetic exports are cached'
+        ' (default:<cwd>/bench)'
+    )
+    parser.add_argument(
+        '--results-file',
+        default=os.path.join(cwd, "bench", "results.csv"),
+        help='csv results are appended to (default:<cwd>/bench/results.csv)'
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if not os.path.isdir(args.xml_dir):
+        os.makedirs(args.xml_dir)
+    results_dir = os.path.dirname(os.path.abspath(args.results_file))
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+
+    backend = xml_to_apfeed.parser_backend(args.parser)
+    version = code_version()
+    previous = read_results(args.results_file)
+    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    logging.info("Version %s, %s parser", version, backend)
+    logging.info("%8s %-16s %9s %9s %12s %11s %8s", 'invoices', 'stage',
+                 'seconds', 'lines', 'lines/sec', 'peak KB', 'vs prev')
+
+    write_header = not previous
+    with open(args.results_file, 'ab') as results_file:
+        w = csv.DictWriter(results_file, RESULT_FIELDS)
+        if write_header:
+            w.writeheader()
+        for invoices in args.invoices:
+            path = synthetic_xml(args.xml_dir, invoices, args.seed)
+            for stage in args.stages:
+                result = measure_isolated(stage, path, backend)
+                result.update(
+                    date=now,
+                    version=version,
+                    python=platform.python_version(),
+                    invoices=invoices,
+                    stage=stage,
+                    lines_per_sec=result['lines'] / max(result['seconds'], 1e-9)
+                )
+                w.writerow(result)
+                results_file.flush()
+
+                # Ratio above 1 means this version is slower
+                base = baseline(previous, version, invoices, stage)
+                ratio = '-'
+                if base is not None and float(base['seconds']) > 0:
+                    ratio = "%.2fx" % (result['seconds'] / float(base['seconds']))
+                logging.info("%8d %-16s %9.3f %9d %12.0f %11d %8s", invoices,
+                             stage, result['seconds'], result['lines'],
+                             result['lines_per_sec'], result['peak_rss_kb'],
+                             ratio)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python2.7
+
+"""
+Compressed archive of the xml, apfeed and alma_input files
+Files are appended to one container as a series of independently
+compressed blocks, each a complete gzip member, so the container is
+still a valid .gz file (zcat prints every archived file in order). A
+sqlite sidecar index records each file's blocks, so a file, or a byte
+range of it such as one apfeed line, is read by seeking to its blocks
+and decompressing only those.
+By default the container of archive/xml is archive/xml.gz, with its
+index in archive/xml.gz.sqlite.
+"""
+
+import argparse
+import fnmatch
+import os
+import sqlite3
+import sys
+import time
+import zlib
+
+BLOCK_SIZE = 1 << 16
+ARCHIVE_SUFFIX = ".gz"
+INDEX_SUFFIX = ".sqlite"
+# zlib window bits for a gzip wrapped deflate stream
+GZIP_WBITS = 31
+
+SCHEMA = """
+    create table if not exists files (
+        name text primary key,
+        size integer,
+        added real,
+        block_size integer
+    );
+    create table if not exists blocks (
+        name text,
+        seq integer,
+        offset integer,
+        length integer,
+        primary key (name, seq)
+    );
+"""
+
+
+def archive_path(directory):
+    """Container used instead of directory"""
+    return directory.rstrip(os.sep) + ARCHIVE_SUFFIX
+
+
+def open_archive(directory):
+    """BlockArchive used instead of directory, or None if there is none"""
+    path = archive_path(directory)
+    if not os.path.exists(path + INDEX_SUFFIX):
+        return None
+    return BlockArchive(path)
+
+
+def compress_block(data, level):
+    """data as a single gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class BlockArchive(object):
+    """Append only container of block compressed files"""
+
+    def __init__(self, path, block_size=BLOCK_SIZE, level=6):
+        """
+        Args:
+            path (str): Container file, created with its index if missing.
+            block_size (int): Uncompressed size of the blocks of new files.
+            level (int): zlib compression level.
+        """
+        self.path = path
+        self.block_size = block_size
+        self.level = level
+        self.con = sqlite3.connect(path + INDEX_SUFFIX)
+        self.con.executescript(SCHEMA)
+        self._block = (None, None, None)
+
+    def add(self, src_path, name=None):
+        """Appends a file.
+
+        The blocks are written and synced before the index is updated, so
+        a crash leaves at worst unreferenced bytes at the end. Adding a name
+        again replaces it, e.g. an xml converted again after a fix.
+
+        Args:
+            src_path (str): File to archive.
+            name (str): Name in the archive (default: base name of src_path).
+
+        Returns:
+            int: Uncompressed size of the file.
+        """
+        if name is None:
+            name = os.path.basename(src_path)
+        blocks = []
+        size = 0
+        with open(src_path, 'rb') as src, open(self.path, 'ab') as out:
+            out.seek(0, os.SEEK_END)
+            offset = out.tell()
+            data = src.read(self.block_size)
+            while data:
+                block = compress_block(data, self.level)
+                out.write(block)
+                blocks.append((name, len(blocks), offset, len(block)))
+                offset += len(block)
+                size += len(data)
+                data = src.read(self.block_size)
+            out.flush()
+            os.fsync(out.fileno())
+        with self.con:
+            self.con.execute("delete from blocks where name = ?", (name,))
+            self.con.execute("insert or replace into files values (?, ?, ?, ?)",
+                             (name, size, time.time(), self.block_size))
+            self.con.executemany("insert into blocks values (?, ?, ?, ?)",
+                                 blocks)
+        self._block = (None, None, None)
+        return size
+
+    def entries(self, pattern=None):
+        """(name, size, added) of the archived files, sorted by name.
+
+        Args:
+            pattern (str): Only names matching this shell pattern.
+        """
+        rows = self.con.execute(
+            "select name, size, added from files order by name"
+        ).fetchall()
+        if pattern is not None:
+            rows = [row for row in rows if fnmatch.fnmatch(row[0], pattern)]
+        return rows
+
+    def __contains__(self, name):
+        return self.con.execute(
+            "select 1 from files where name = ?", (name,)
+        ).fetchone() is not None
+
+    def stat(self, name):
+        """(size, added) of an archived file.
+
+        Raises:
+            KeyError: name is not archived.
+        """
+        row = self.con.execute(
+            "select size, added from files where name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row
+
+    def _info(self, name):
+        """(size, block_size) of an archived file.
+
+        Raises:
+            KeyError: name is not archived.
+        """
+        row = self.con.execute(
+            "select size, block_size from files where name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row
+
+    def _read_blocks(self, name, first, last):
+        """Uncompressed blocks first to last of a file, joined"""
+        if first == last and self._block[:2] == (name, first):
+            return self._block[2]
+        rows = self.con.execute(
+            "select offset, length from blocks where name = ?"
+            " and seq between ? and ? order by seq", (name, first, last)
+        ).fetchall()
+        if not rows:
+            return ""
+        start = rows[0][0]
+        with open(self.path, 'rb') as container:
+            container.seek(start)
+            raw = container.read(rows[-1][0] + rows[-1][1] - start)
+        data = "".join(zlib.decompress(raw[offset - start:offset - start + length],
+                                       GZIP_WBITS)
+                       for offset, length in rows)
+        if first == last:
+            self._block = (name, first, data)
+        return data
+
+    def read_range(self, name, offset, size):
+        """size bytes of an archived file from offset, decompressing only
+        the blocks they are in"""
+        file_size, block_size = self._info(name)
+        size = min(size, file_size - offset)
+        if size <= 0:
+            return ""
+        first = offset // block_size
+        last = (offset + size - 1) // block_size
+        data = self._read_blocks(name, first, last)
+        start = offset - first * block_size
+        return data[start:start + size]
+
+    def read(self, name):
+        """Whole archived file"""
+        return self.read_range(name, 0, self._info(name)[0])
+
+    def read_line(self, name, offset):
+        """Line of an archived file starting at offset, with its newline"""
+        file_size, block_size = self._info(name)
+        line = ""
+        while offset < file_size:
+            chunk = self.read_range(name, offset,
+                                    block_size - offset % block_size)
+            end = chunk.find("\n")
+            if end >= 0:
+                return line + chunk[:end + 1]
+            line += chunk
+            offset += len(chunk)
+        return line
+
+    def extract(self, name, directory):
+        """Writes an archived file into directory.
+
+        Returns:
+            str: Path of the extracted file.
+        """
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as out:
+            out.write(self.read(name))
+        return path
+
+    def close(self):
+        """Closes the index"""
+        self.con.close()
+
+
+# pylint: disable=C0103
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Lists, adds to and extracts from a compressed archive,'
+        ' e.g. archive/xml.gz'
+    )
+    parser.add_argument('archive', help='Container file')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='List the archived files')
+    parser.add_argument('-a', '--add', nargs='+', metavar='FILE',
+                        help='Archive files, e.g. the contents of an archive'
+                        ' directory')
+    parser.add_argument('--remove', action='store_true',
+                        help='Delete files once added')
+    parser.add_argument('-x', '--extract', nargs='+', metavar='NAME',
+                        help='Extract archived files (shell patterns allowed)')
+    parser.add_argument('-C', '--directory', default=os.getcwd(),
+                        help='Directory to extract into (default: <cwd>)')
+    args = parser.parse_args()
+
+    archive = BlockArchive(args.archive)
+    if args.add:
+        for path in args.add:
+            archive.add(path)
+            if args.remove:
+                os.remove(path)
+            print "Added %s" % path
+    if args.extract:
+        for pattern in args.extract:
+            entries = archive.entries(pattern)
+            if not entries:
+                print >> sys.stderr, "Not in archive: %s" % pattern
+                sys.exit(1)
+            for name, _, _ in entries:
+                print "Extracted %s" % archive.extract(name, args.directory)
+    if args.list:
+        for name, size, added in archive.entries():
+            print "%s\t%d\t%s" % (name, size, time.strftime(
+                '%Y-%m-%dT%H:%M:%S', time.localtime(added)))
+    archive.close()
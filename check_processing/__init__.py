@@ -0,0 +1,10 @@
+"""
+Shared pieces of xml_to_apfeed.py, update_alma.py and upload_apfeed.py
+The typed config loader and the logging, directory and latest-log setup
+every script starts with. Only the standard library is imported here, so
+loading it costs nothing on top of the interpreter.
+"""
+
+from check_processing.config import CONFIG_PATH, Config, load_config
+from check_processing.runtime import (LOG_FORMAT, link_latest_log, make_dirs,
+                                      setup_logging)
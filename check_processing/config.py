@@ -0,0 +1,120 @@
+"""
+Typed, cached loader for config.ini
+Each section is read into a namedtuple with its values converted once,
+so callers get config.apfeed.org_doc_nbr as an int instead of calling
+ConfigParser.get and converting everywhere. Sections are only converted
+when first used, so a script does not need the sections of the others.
+load_config parses the file once per process and again only when it
+changes, so a long running process sees upload_apfeed.py's updates.
+"""
+
+import ConfigParser
+import os
+
+from collections import namedtuple
+
+CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    'config.ini'
+)
+
+ApfeedSettings = namedtuple('ApfeedSettings', [
+    'org_doc_nbr', 'emp_ind', 'org_shp_zip_cd', 'org_shp_state_cd',
+    'pmt_grp_cd', 'pmt_non_check_ind', 'fin_coa_cd', 'fin_object_cd',
+    'apply_disc_ind', 'eft_override_ind', 'tax_perc'
+])
+AlmaSettings = namedtuple('AlmaSettings', ['api_key', 'deadline'])
+OracleSettings = namedtuple('OracleSettings', ['username', 'password', 'server'])
+ScpSettings = namedtuple('ScpSettings', ['server', 'user', 'private_key', 'port'])
+
+# section: (settings type, converters of options that are not str)
+SECTIONS = {
+    'apfeed': (ApfeedSettings, {'org_doc_nbr': int, 'tax_perc': float}),
+    'alma': (AlmaSettings, {'deadline': float}),
+    'oracle': (OracleSettings, {}),
+    'apfeed_scp_out': (ScpSettings, {'port': int}),
+}
+# section: {option: value when config.ini leaves it out}
+OPTIONAL = {
+    'alma': {'deadline': None},
+}
+
+
+class Config(object):
+    """Parsed config.ini"""
+
+    def __init__(self, path=CONFIG_PATH):
+        """
+        Args:
+            path (str): Config file.
+
+        Raises:
+            IOError: The file cannot be read.
+        """
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        self.parser = ConfigParser.ConfigParser()
+        with open(path) as config_file:
+            self.parser.readfp(config_file)
+        self.sections = dict()
+
+    def section(self, name):
+        """Typed settings of a section, converted on first use.
+
+        Raises:
+            ConfigParser.Error: The section or one of its options is missing.
+            ValueError: An option does not convert to its type.
+        """
+        settings = self.sections.get(name)
+        if settings is None:
+            settings_type, converters = SECTIONS[name]
+            optional = OPTIONAL.get(name, {})
+            values = []
+            for option in settings_type._fields:
+                if option in optional and not self.parser.has_option(name, option):
+                    values.append(optional[option])
+                    continue
+                value = self.parser.get(name, option)
+                values.append(converters.get(option, str)(value))
+            settings = self.sections[name] = settings_type(*values)
+        return settings
+
+    @property
+    def apfeed(self):
+        """ApfeedSettings, the constant apfeed fields and use tax percentage"""
+        return self.section('apfeed')
+
+    @property
+    def alma(self):
+        """AlmaSettings, the api key and seconds a call may retry (None
+        for the client's default)"""
+        return self.section('alma')
+
+    @property
+    def oracle(self):
+        """OracleSettings of the KFS database"""
+        return self.section('oracle')
+
+    @property
+    def apfeed_scp_out(self):
+        """ScpSettings of the campus finance server"""
+        return self.section('apfeed_scp_out')
+
+    def set_org_doc_nbr(self, org_doc_nbr):
+        """Saves the last org_doc_nbr used, the next apfeed starts after it"""
+        self.parser.set('apfeed', 'org_doc_nbr', str(int(org_doc_nbr)))
+        with open(self.path, 'w') as config_file:
+            self.parser.write(config_file)
+        self.sections.pop('apfeed', None)
+        self.mtime = os.path.getmtime(self.path)
+
+
+_LOADED = dict()
+
+
+def load_config(path=CONFIG_PATH):
+    """Config of path, parsed again only if the file changed since last time"""
+    config = _LOADED.get(path)
+    if config is None or config.mtime != os.path.getmtime(path):
+        config = _LOADED[path] = Config(path)
+    return config
@@ -0,0 +1,55 @@
+"""
+Setup every script does before its real work
+Log file and console logging, the working directories and the
+<script>.latest.log link the front end reads.
+"""
+
+import logging
+import os
+
+LOG_FORMAT = "[%(levelname)-5.5s] %(message)s"
+
+
+def make_dirs(*paths):
+    """Creates each directory that does not exist yet, in order"""
+    for path in paths:
+        if not os.path.isdir(path):
+            os.mkdir(path)
+
+
+def setup_logging(log_dir, log_file, log_level, console_format=LOG_FORMAT):
+    """Logs to a file in log_dir and to the console.
+
+    Args:
+        log_dir (str): Directory of the log file, created if missing.
+        log_file (str): Log file name.
+        log_level (str): Level name of the written log, e.g. INFO.
+        console_format (str): Format of the console messages.
+
+    Returns:
+        str: Path of the log file.
+
+    Raises:
+        ValueError: log_level is not a level name.
+    """
+    numeric_level = getattr(logging, log_level.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % log_level)
+    make_dirs(log_dir)
+    log_file_path = os.path.join(log_dir, log_file)
+    logging.basicConfig(filename=log_file_path,
+                        level=numeric_level,
+                        format=LOG_FORMAT)
+    logger = logging.getLogger()
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(console_format))
+    logger.addHandler(console_handler)
+    logger.setLevel(numeric_level)
+    return log_file_path
+
+
+def link_latest_log(log_file_path, latest_log):
+    """Points the latest log link at log_file_path"""
+    if os.path.lexists(latest_log):
+        os.unlink(latest_log)
+    os.symlink(log_file_path, latest_log)
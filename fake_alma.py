@@ -0,0 +1,237 @@
+#!/usr/bin/env python2.7
+
+"""
+Local stand-in for the Alma acquisitions API
+Serves waiting invoice pages, single vendors and the vendor list in
+Alma's JSON, with a set latency, share of throttled (429) and failed
+(500) responses and calls a second over which it throttles like Alma.
+AlmaClient's retries, and update_alma.py's throughput under throttling,
+are tested and measured against it without calling production.
+Invoice n is 'INV<n>' for n % vendors + 1 of vendor 'V<k>', whose KFS
+vendor id is '<k>-0'. Vendors can be missing, as when deleted in Alma,
+so that looking them up is answered 400.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from timeit import default_timer
+from urlparse import urlparse, parse_qs
+
+INVOICES = 1234
+VENDORS = 7
+
+
+class AlmaHandler(BaseHTTPRequestHandler):
+    """Answers one Alma call, keeping the connection open"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status, body = self.server.answer(self.client_address, self.path)
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAlma(ThreadingMixIn, HTTPServer):
+    """Threaded Alma API server, counting the calls it answers"""
+    daemon_threads = True
+
+    def __init__(self, invoices=INVOICES, vendors=VENDORS, latency=0.0,
+                 error_rate=0.0, rate_limit=None, seed=None,
+                 address=('127.0.0.1', 0), missing=()):
+        """
+        Args:
+            invoices (int): Invoices waiting payment.
+            vendors (int): Vendors, in the vendor list and on the invoices.
+            latency (float): Seconds each call takes.
+            error_rate (float): Share of calls answered 429 or 500 at random.
+            rate_limit (int): Calls a second over which calls are answered
+                429, as Alma does (default: no limit).
+            seed: Seed of the random errors.
+            address (tuple): (host, port) to listen on, port 0 for any.
+            missing (iterable): k of the vendors 'V<k>' on invoices whose
+                lookup is answered 400, as not found.
+        """
+        HTTPServer.__init__(self, address, AlmaHandler)
+        self.invoices = invoices
+        self.vendors = vendors
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.missing = set(missing)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window = (0, 0)
+        self.connections = set()
+        self.calls = 0
+        self.throttled = 0
+        self.failed = 0
+        self.vendor_calls = 0
+        self.vendor_pages = 0
+        self.thread = None
+
+    @property
+    def base_url(self):
+        """Acquisitions API root, for AlmaClient"""
+        return 'http://%s:%d/almaws/v1/acq/' % self.server_address
+
+    def start(self):
+        """Serves on a daemon thread.
+
+        Returns:
+            FakeAlma: self.
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving and closes the socket"""
+        self.shutdown()
+        self.server_close()
+
+    def _admit(self, client_address):
+        """Counts a call, returning the error status it gets, if any"""
+        with self.lock:
+            self.connections.add(client_address)
+            self.calls += 1
+            second = int(default_timer())
+            start, count = self.window
+            count = count + 1 if start == second else 1
+            self.window = (second, count)
+            if self.rate_limit is not None and count > self.rate_limit:
+                self.throttled += 1
+                return 429
+            if self.random.random() < self.error_rate:
+                if self.random.random() < 0.5:
+                    self.throttled += 1
+                    return 429
+                self.failed += 1
+                return 500
+        return None
+
+    def invoice(self, n):
+        """Waiting invoice n"""
+        return {'number': 'INV%d ' % n, 'id': str(n),
+                'invoice_date': '2017-03-01Z', 'total_amount': n,
+                'payment': {'payment_status': {'value': 'NOT_PAID'}},
+                'vendor': {'value': 'V%d' % (n % self.vendors + 1)}}
+
+    @staticmethod
+    def vendor(k):
+        """Vendor k"""
+        return {'code': 'V%d' % k, 'additional_code': '%05d-0' % k}
+
+    def answer(self, client_address, path):
+        """(status, JSON body) of a GET of path"""
+        if self.latency:
+            time.sleep(self.latency)
+        status = self._admit(client_address)
+        if status == 429:
+            return status, {'errorsExist': True, 'errorList': {'error': [
+                {'errorCode': 'PER_SECOND_THRESHOLD'}]}}
+        if status is not None:
+            return status, {'errorsExist': True}
+        url = urlparse(path)
+        params = parse_qs(url.query)
+        offset = int(params.get('offset', ['0'])[0])
+        limit = int(params.get('limit', ['10'])[0])
+        if url.path.endswith('/invoices/'):
+            return 200, {'total_record_count': self.invoices, 'invoice': [
+                self.invoice(n)
+                for n in range(offset, min(offset + limit, self.invoices))
+            ]}
+        if url.path.endswith('/vendors'):
+            with self.lock:
+                self.vendor_pages += 1
+            return 200, {'total_record_count': self.vendors, 'vendor': [
+                self.vendor(k)
+                for k in range(offset + 1, min(offset + limit, self.vendors) + 1)
+            ]}
+        with self.lock:
+            self.vendor_calls += 1
+        code = url.path.rsplit('/', 1)[1]
+        if not (code[:1] == 'V' and code[1:].isdigit()
+                and 0 < int(code[1:]) <= self.vendors
+                and int(code[1:]) not in self.missing):
+            return 400, {'errorsExist': True, 'errorList': {'error': [
+                {'errorCode': '402880', 'errorMessage': 'Vendor not found'}]}}
+        return 200, self.vendor(int(code[1:]))
+
+
+def bench(server, workers, rate):
+    """Times get_waiting_invoices against server.
+
+    Returns:
+        dict: Seconds, calls made, retries and the server's counts.
+    """
+    from alma_client import AlmaClient
+    import update_alma
+
+    client = AlmaClient('fake', workers=workers, base_url=server.base_url,
+                        rate=rate)
+    start = default_timer()
+    invs, _, _ = update_alma.get_waiting_invoices(None, client=client)
+    seconds = default_timer() - start
+    client.close()
+    return {'seconds': seconds, 'invoices': len(invs), 'calls': client.calls,
+            'retries': client.retries, 'throttled': server.throttled,
+            'failed': server.failed,
+            'calls_per_sec': client.calls / seconds}
+
+
+# pylint: disable=C0103
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Serves a fake Alma acquisitions API, or times'
+        ' update_alma.py fetching from one'
+    )
+    parser.add_argument('-p', '--port', type=int, default=0,
+                        help='Port to listen on (default: any free port)')
+    parser.add_argument('--invoices', type=int, default=INVOICES,
+                        help='Invoices waiting payment (default: %d)' % INVOICES)
+    parser.add_argument('--vendors', type=int, default=VENDORS,
+                        help='Vendors (default: %d)' % VENDORS)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds each call takes (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of calls answered 429 or 500 (default: 0)')
+    parser.add_argument('--rate-limit', type=int,
+                        help='Calls a second over which calls are answered 429')
+    parser.add_argument('--seed', type=int, help='Seed of the random errors')
+    parser.add_argument('--bench', action='store_true',
+                        help='Time fetching the waiting invoices and vendors'
+                        ' instead of serving')
+    parser.add_argument('--workers', type=int, default=20,
+                        help='Client threads with --bench (default: 20)')
+    parser.add_argument('--client-rate', type=float, default=25,
+                        help='Client calls a second with --bench (default: 25)')
+    args = parser.parse_args()
+
+    fake = FakeAlma(args.invoices, args.vendors, args.latency, args.error_rate,
+                    args.rate_limit, args.seed, ('127.0.0.1', args.port))
+    if args.bench:
+        fake.start()
+        for key, value in sorted(bench(fake, args.workers,
+                                       args.client_rate).iteritems()):
+            print "%s\t%s" % (key, value)
+        fake.stop()
+    else:
+        print "Serving %s" % fake.base_url
+        try:
+            fake.serve_forever()
+        except KeyboardInterrupt:
+            fake.server_close()
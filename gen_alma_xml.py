@@ -0,0 +1,285 @@
+#!/usr/bin/env python2.7
+
+"""
+Generates synthetic Alma invoice export XML for benchmarking
+Inputs: Number of invoices and a random seed
+Output: XML in the same shape as the payment_data exports
+        xml_to_apfeed.py reads
+Covers the cases the converter branches on: invoices with several lines,
+lines split across funds, ATTACH/UTAX/ATAX invoice notes, UTAX/NUTAX line
+notes, VAT, and lines without PO line info. The same seed always produces
+the same file. Invoices are written as they are generated, so memory use
+does not grow with the number of invoices.
+"""
+
+import argparse
+import random
+import sys
+
+from xml.sax.saxutils import escape
+
+NS = "http://com/exlibris/repository/acq/invoice/xmlbeans"
+
+ACCOUNTS = ('MAINBKS', 'MAINSER', 'HSLBKS', 'LAWBKS', 'MAINDBS', 'SHLDAPR')
+INV_NOTES = ('ATTACH', 'UTAX', 'ATAX')
+LINE_NOTES = ('UTAX', 'NUTAX')
+
+# Shape of the generated invoices, mostly the chance of each case
+DEFAULTS = {
+    'max_lines': 8,
+    'multi_fund': 0.1,
+    'inv_note': 0.2,
+    'line_note': 0.1,
+    'vat': 0.05,
+    'no_po_line': 0.05,
+}
+HELP = {
+    'max_lines': 'maximum lines per invoice',
+    'multi_fund': 'chance a line is split across 2 or 3 funds',
+    'inv_note': 'chance an invoice has an ATTACH, UTAX or ATAX note',
+    'line_note': 'chance a line has a UTAX or NUTAX note',
+    'vat': 'chance an invoice has VAT',
+    'no_po_line': 'chance a line has no PO line info',
+}
+
+INVOICE = """\
+    <invoice>
+      <invoice_number>%(invoice_number)s</invoice_number>
+      <invoice_owner>University of California Davis</invoice_owner>
+      <approved_by>Synthetic Approver</approved_by>
+%(note_list)s\
+      <invoice_amount>
+        <currency>USD</currency>
+        <sum>%(total)s</sum>
+      </invoice_amount>
+      <vendor_code>%(vendor_code)s</vendor_code>
+      <vendor_name>%(vendor_name)s</vendor_name>
+      <vendor_additional_code>%(vendor_additional_code)s</vendor_additional_code>
+      <vendor_liable_for_vat>false</vendor_liable_for_vat>
+      <vendor_payment_address_list/>
+      <unique_identifier>%(unique_identifier)d</unique_identifier>
+      <invoice_date>%(invoice_date)s</invoice_date>
+      <payment_method>ACCOUNTINGDEPARTMENT</payment_method>
+      <invoice_ownered_entity>
+        <createdBy>SYNTHETIC</createdBy>
+        <creationDate>%(creation_date)s</creationDate>
+        <customerId>3125</customerId>
+        <institutionId>3126</institutionId>
+        <modifiedBy>SYNTHETIC</modifiedBy>
+      </invoice_ownered_entity>
+      <vat_info>
+        <expended_from_fund_ind>true</expended_from_fund_ind>
+        <inclusive_ind>true</inclusive_ind>
+        <vat_amount>%(vat_amount)s</vat_amount>
+        <vat_percentage>%(vat_percentage)s</vat_percentage>
+        <vat_type>INCLUSIVE</vat_type>
+        <vat_in_invoice_line_level>false</vat_in_invoice_line_level>
+      </vat_info>
+      <invoice_line_list>
+%(lines)s\
+      </invoice_line_list>
+    </invoice>
+"""
+
+NOTE_LIST = """\
+      <noteList>
+        <note>
+          <content>%(content)s</content>
+          <owneredEntity>
+            <createdBy>SYNTHETIC</createdBy>
+            <creationDate>%(creation_date)s</creationDate>
+            <customerId>3125</customerId>
+            <institutionId>3126</institutionId>
+            <modificationDate>%(creation_date)s</modificationDate>
+            <modifiedBy>SYNTHETIC</modifiedBy>
+          </owneredEntity>
+        </note>
+      </noteList>
+"""
+
+LINE = """\
+        <invoice_line>
+          <line_number>%(line_number)d</line_number>
+          <line_type>REGULAR</line_type>
+          <note>%(note)s</note>
+          <quantity>1</quantity>
+          <total_price>%(total)s</total_price>
+          <price>%(total)s</price>
+%(po_line_info)s\
+          <fund_info_list>
+%(funds)s\
+          </fund_info_list>
+        </invoice_line>
+"""
+
+PO_LINE_INFO = """\
+          <po_line_info>
+            <po_line_owner>Shields Library</po_line_owner>
+            <mms_record_id>%(mms_record_id)d</mms_record_id>
+            <po_line_number>%(po_line_number)s</po_line_number>
+            <po_line_price>%(total)s</po_line_price>
+            <po_line_title>%(title)s</po_line_title>
+          </po_line_info>
+"""
+
+FUND = """\
+            <fund_info>
+              <amount>
+                <currency>USD</currency>
+                <sum>%(sum)s</sum>
+              </amount>
+              <code>%(code)s</code>
+              <name>%(code)s FUND</name>
+              <fiscal_period>FY-2017</fiscal_period>
+              <external_id>%(external_id)s</external_id>
+              <type>ALLOCATED</type>
+              <fund_type>APPR</fund_type>
+              <fund_type_desc>Approval</fund_type_desc>
+            </fund_info>
+"""
+
+
+def dollars(cents):
+    """Formats cents the way Alma writes amounts, e.g. 29.5 or 120.0"""
+    return repr(cents / 100.0)
+
+
+def split_cents(rand, cents, parts):
+    """Splits an amount into parts that add back up to it exactly"""
+    cuts = sorted(rand.randint(0, cents) for _ in range(parts - 1))
+    bounds = [0] + cuts + [cents]
+    return [bounds[i + 1] - bounds[i] for i in range(parts)]
+
+
+def gen_line(rand, line_number, opts):
+    """Formats a random invoice line.
+
+    Returns:
+        tuple: (xml str, line total in cents)
+    """
+    total = rand.randint(100, 50000)
+    fields = {
+        'line_number': line_number,
+        'total': dollars(total),
+        'note': '',
+        'po_line_info': '',
+    }
+    if rand.random() < opts['line_note']:
+        fields['note'] = rand.choice(LINE_NOTES)
+    if rand.random() >= opts['no_po_line']:
+        fields['po_line_info'] = PO_LINE_INFO % {
+            'mms_record_id': rand.randint(10 ** 15, 10 ** 16 - 1),
+            'po_line_number': (rand.choice(("POL-%d", "O%07d"))
+                               % rand.randint(1, 999999)),
+            'total': dollars(total),
+            'title': escape("Synthetic title & subtitle %d" % line_number),
+        }
+    parts = 1
+    if rand.random() < opts['multi_fund']:
+        parts = rand.randint(2, 3)
+    fields['funds'] = "".join(
+        FUND % {
+            'sum': dollars(part),
+            'code': "FUND%02d" % i,
+            'external_id': rand.choice(ACCOUNTS),
+        }
+        for i, part in enumerate(split_cents(rand, total, parts))
+    )
+    return LINE % fields, total
+
+
+def gen_invoice(rand, index, opts):
+    """Formats a random invoice with a unique invoice number"""
+    vendor = rand.randint(1, 9999)
+    creation_date = "2017%02d%02d" % (rand.randint(1, 12), rand.randint(1, 28))
+    lines = []
+    total = 0
+    for line_number in range(1, rand.randint(1, opts['max_lines']) + 1):
+        line, amount = gen_line(rand, line_number, opts)
+        lines.append(line)
+        total += amount
+    fields = {
+        'invoice_number': "SYN%07d" % index,
+        'note_list': '',
+        'total': dollars(total),
+        'vendor_code': "VEND%04d" % vendor,
+        'vendor_name': escape("Synthetic Vendor %d & Sons" % vendor),
+        'vendor_additional_code': "%010d %04d" % (vendor, rand.randint(1, 9)),
+        'unique_identifier': 4917359470003126 + index,
+        'invoice_date': "%02d/%02d/2016" % (rand.randint(1, 12),
+                                            rand.randint(1, 28)),
+        'creation_date': creation_date,
+        'vat_amount': '0.0',
+        'vat_percentage': '0.0',
+        'lines': "".join(lines),
+    }
+    if rand.random() < opts['inv_note']:
+        fields['note_list'] = NOTE_LIST % {
+            'content': rand.choice(INV_NOTES),
+            'creation_date': creation_date,
+        }
+    if rand.random() < opts['vat']:
+        fields['vat_amount'] = dollars(total * 20 // 100)
+        fields['vat_percentage'] = '20.0'
+    return INVOICE % fields
+
+
+def write_xml(out, invoices, seed=0, **options):
+    """Writes a synthetic Alma export.
+
+    Args:
+        out (file): Open file to write the xml to.
+        invoices (int): Number of invoices.
+        seed (int): Random seed, the same seed gives the same file.
+        options: Overrides of DEFAULTS, max_lines per invoice and the
+            fraction of invoices or lines each case applies to.
+    """
+    opts = dict(DEFAULTS)
+    for key, value in options.iteritems():
+        if key not in opts:
+            raise ValueError("Unknown option: %s" % key)
+        opts[key] = value
+    rand = random.Random(seed)
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write('<payment_data xmlns="%s">\n  <invoice_list>\n' % NS)
+    for index in xrange(invoices):
+        out.write(gen_invoice(rand, index, opts))
+    out.write('  </invoice_list>\n</payment_data>\n')
+
+
+# pylint: disable=C0103
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic Alma invoice export.'
+    )
+    parser.add_argument(
+        '-n', '--invoices',
+        type=int,
+        default=1000,
+        help='number of invoices (default: 1000)'
+    )
+    parser.add_argument(
+        '-o', '--output-file',
+        help='xml file to write (default: stdout)'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='random seed (default: 0)'
+    )
+    for name, default in sorted(DEFAULTS.iteritems()):
+        parser.add_argument(
+            '--' + name.replace('_', '-'),
+            type=type(default),
+            default=default,
+            help='%s (default: %s)' % (HELP[name], default)
+        )
+    args = parser.parse_args()
+
+    options = dict((name, getattr(args, name)) for name in DEFAULTS)
+    if args.output_file is None:
+        write_xml(sys.stdout, args.invoices, args.seed, **options)
+    else:
+        with open(args.output_file, 'wb') as xml_file:
+            write_xml(xml_file, args.invoices, args.seed, **options)
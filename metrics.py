@@ -0,0 +1,124 @@
+"""
+Per-stage timings and counts of a script run
+Shared by xml_to_apfeed.py, update_alma.py and upload_apfeed.py for
+their --metrics-file option. A stage may be entered many times, once
+per invoice or line, and its times are summed, so the overhead is a
+pair of timer calls per entry. Written as one JSON document with the
+peak RSS of the run, for graphing run cost over time. Stages and counts
+may be added to from several threads.
+"""
+
+import atexit
+import datetime
+import json
+import os
+import resource
+import tempfile
+import threading
+
+from collections import OrderedDict
+from timeit import default_timer
+
+
+def write_json(path, data):
+    """Writes data as JSON, replacing path atomically so readers never
+    see a partial document"""
+    path = os.path.abspath(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=".%s." % os.path.basename(path),
+                                    dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as json_file:
+        json.dump(data, json_file, indent=2)
+        json_file.write("\n")
+    # mkstemp creates the file private, match a normally created file
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0o666 & ~umask)
+    os.rename(tmp_path, path)
+
+
+class Stage(object):
+    """Context manager adding the time spent inside it to a stage"""
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.name, default_timer() - self.start)
+        return False
+
+
+class Metrics(object):
+    """Timings in seconds and counts, each kept in first seen order"""
+
+    def __init__(self, script):
+        """
+        Args:
+            script (str): Name of the script the run belongs to.
+        """
+        self.script = script
+        self.started = datetime.datetime.now()
+        self.start = default_timer()
+        self.stages = OrderedDict()
+        self.counts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        """Times a with block as (part of) a stage"""
+        return Stage(self, name)
+
+    def iterate(self, name, iterable):
+        """Yields from iterable, timing each step as a stage.
+
+        For a parser or cursor, where the work is done while fetching the
+        next item and the caller's work on the item should not count.
+        """
+        items = iter(iterable)
+        while True:
+            start = default_timer()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.add_time(name, default_timer() - start)
+                return
+            self.add_time(name, default_timer() - start)
+            yield item
+
+    def add_time(self, name, seconds):
+        """Adds seconds to a stage"""
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        """Adds n to a count"""
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def as_dict(self):
+        """The metrics as a JSON serializable dict"""
+        self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return OrderedDict([
+            ('script', self.script),
+            ('started', self.started.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('seconds', default_timer() - self.start),
+            ('stages', self.stages),
+            ('counts', self.counts),
+            ('peak_rss_kb', self_rss),
+            ('peak_child_rss_kb', child_rss),
+        ])
+
+    def write(self, path):
+        """Writes the metrics as JSON, replacing path atomically"""
+        write_json(path, self.as_dict())
+
+    def write_at_exit(self, path):
+        """Writes the metrics when the script exits, even on sys.exit"""
+        atexit.register(self.write, path)
@@ -5,16 +5,151 @@ Author: Alexander Lin (alxlin@ucdavis.edu)
 Inputs: Apfeed file
 Output: Class dump of apfeed file
 So humans can read an apfeed file
+Feeds are memory mapped and the filter columns compared on the raw
+bytes, so only matching lines are decoded; with --json-lines records are
+printed as they are found, so many feeds can be searched in one pass.
 """
 
 import argparse
 import glob
 import json
+import mmap
 import os
+import sqlite3
 import sys
 
 from pprint import pprint
 
+from apfeed_index import ApfeedIndex, read_lines, scan_directory
+from apfeed_layout import LAYOUT
+from block_archive import open_archive
+
+# Fields printed for each line, in LAYOUT naming
+FIELDS = ['time', 'org_doc_nbr', 'emp_ind', 'vend_code', 'vend_assign_inv_nbr',
+          'vend_assign_inv_date', 'addr_select_vend_nbr', 'goods_received_dt',
+          'org_shp_zip_cd', 'org_shp_state_cd', 'pmt_grp_cd', 'scheduled_pmt_dt',
+          'pmt_non_check_ind', 'attachment_req_ind', 'pmt_line_nbr', 'account_nbr',
+          'fin_object_cd', 'org_reference_id', 'pmt_tax_cd', 'pmt_amt',
+          'apply_disc_ind', 'eft_override_ind']
+# Keys read_apfeed has always printed where they differ from LAYOUT
+KEYS = {'org_doc_nbr': 'org_doc_num', 'goods_received_dt': 'goods_recieved_dt'}
+
+
+def make_filters(inv_num=None, org_doc=None, vend_code=None):
+    """(slice, value) of each given filter, a line matches if any does"""
+    filters = []
+    if org_doc is not None:
+        # org_doc_nbr is written zero padded
+        field = LAYOUT.slices['org_doc_nbr']
+        org_doc = "%0*d" % (field.stop - field.start, int(org_doc))
+    for name, value in (('vend_assign_inv_nbr', inv_num),
+                        ('org_doc_nbr', org_doc),
+                        ('vend_code', vend_code)):
+        if value is not None:
+            filters.append((LAYOUT.slices[name], value))
+    return filters
+
+
+def matches(line, filters):
+    """True if no filters are given or a filter column of line matches"""
+    if not filters:
+        return True
+    for field, value in filters:
+        if line[field].rstrip() == value:
+            return True
+    return False
+
+
+def decode(line):
+    """Dict of the printed fields of an apfeed line"""
+    record = LAYOUT.unpack(line.rstrip("\r\n"))
+    return dict((KEYS.get(k, k), record[k]) for k in FIELDS)
+
+
+def find_lines(directory, index_file=None, archive=None, inv_num=None,
+               org_doc=None, vend_code=None):
+    """(path, offset) of the lines of an org_doc_nbr, invoice or vendor.
+
+    Looked up through the directory's index, brought up to date first. If
+    the index cannot be created or updated, e.g. the directory is read
+    only, every feed is read instead.
+
+    Args:
+        directory (str): Directory of the archived apfeeds.
+        index_file (str): Index of directory (default: in directory).
+        archive (BlockArchive): Compressed archive holding more feeds.
+        inv_num (str): Vendor invoice number, used if org_doc is not given.
+        org_doc (int): org_doc_nbr.
+        vend_code (str): Vendor code, used if neither other is given.
+    """
+    try:
+        index = ApfeedIndex(directory, index_file, archive)
+        try:
+            index.update()
+            if org_doc is not None:
+                return index.find_org_doc(org_doc)
+            elif inv_num is not None:
+                return index.find_invoice(inv_num)
+            return index.find_vendor(vend_code)
+        finally:
+            index.close()
+    except sqlite3.Error as error:
+        sys.stderr.write("Cannot use the index of %s (%s), reading every feed\n"
+                         % (directory, error))
+    if org_doc is not None:
+        column, value = 2, int(org_doc)
+    elif inv_num is not None:
+        column, value = 3, inv_num
+    else:
+        column, value = 4, vend_code
+    return [entry[:2] for entry in scan_directory(directory, archive)
+            if entry[column] == value]
+
+
+def expand_paths(patterns):
+    """Files matching each glob pattern, a pattern matching none kept as is"""
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+
+def scan(paths, filters=()):
+    """Yields the decoded lines of feeds matching the filters, in file order.
+
+    Each feed is memory mapped and the filter columns of each line are
+    compared before it is decoded. Header and trailer lines are skipped.
+
+    Args:
+        paths (list): Apfeed files.
+        filters (list): (slice, value) as made by make_filters.
+    """
+    for path in paths:
+        with open(path, 'rb') as feed:
+            size = os.fstat(feed.fileno()).st_size
+            if size == 0:
+                continue
+            data = mmap.mmap(feed.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            while start < size:
+                stop = data.find("\n", start)
+                if stop < 0:
+                    stop = size
+                if data[start:start + 2] != "**":
+                    found = not filters
+                    for field, value in filters:
+                        end = min(start + field.stop, stop)
+                        if data[start + field.start:end].rstrip() == value:
+                            found = True
+                            break
+                    if found:
+                        yield decode(data[start:stop])
+                start = stop + 1
+        finally:
+            data.close()
+
+
 # pylint: disable=C0103
 if __name__ == "__main__":
     cwd = os.getcwd()
@@ -24,72 +159,64 @@ if __name__ == "__main__":
     )
 
     parser.add_argument('-i', '--inv-num')
-    parser.add_argument('-o', '--org-doc')
+    parser.add_argument('-o', '--org-doc', type=int)
     parser.add_argument('-s', '--string')
-    parser.add_argument('-f', '--file')
-    parser.add_argument('-d', '--directory')
+    parser.add_argument(
+        '-f', '--file', nargs='+',
+        help='Apfeed files or glob patterns, e.g. "archive/apfeed/apfeed.LG.2017*"'
+    )
+    parser.add_argument('-v', '--vend-code')
+    parser.add_argument(
+        '-d', '--directory',
+        help='Search the apfeeds archived in a directory, and in its'
+        ' compressed archive <directory>.gz if any, through its index,'
+        ' which is brought up to date first; if the index cannot be'
+        ' written every feed is read instead'
+    )
+    parser.add_argument(
+        '--index-file',
+        help='Index of --directory (default: <directory>/apfeed.index.sqlite)'
+    )
     parser.add_argument('-j', '--json', action='store_true')
+    parser.add_argument(
+        '--json-lines', action='store_true',
+        help='Print each record as a line of JSON as soon as it is found,'
+        ' in file order rather than sorted by line number'
+    )
 
     args = parser.parse_args()
 
-    lines = []
+    filters = make_filters(args.inv_num, args.org_doc, args.vend_code)
+    records = []
 
     if args.file is not None:
-        with open(args.file, 'r') as apf:
-            lines = apf.readlines()
-            lines = lines[1:-1]
+        records = scan(expand_paths(args.file), filters)
     elif args.string is not None:
-        lines = args.string.splitlines()
+        records = (decode(line) for line in args.string.splitlines()
+                   if matches(line, filters))
     elif args.directory is not None:
-        if args.org_doc is None:
-            print "Error directory needs to be paired with --org-doc"
+        if args.org_doc is None and args.inv_num is None and args.vend_code is None:
+            print "Error directory needs to be paired with --org-doc, --inv-num or --vend-code"
             sys.exit(0)
-        files = glob.glob(os.path.join(args.directory, "apfeed.LG.*"))
-        files.sort(reverse=True)
-        for f in files:
-            with open(f, 'r') as apf:
-                lines = apf.readlines()
-                line = lines[1]
-                # get org_doc_num
-                if not line[29:36] or not line[29:36].isdigit():
-                    continue
-                elif int(line[29:36]) <= int(args.org_doc):
-                    print "Found in file: %s" % f
-                    break
-
-    out = []
-    for line in lines:
-        apfd = dict()
-        apfd['time'] = line[15:29]
-        apfd['org_doc_num'] = line[29:36]
-        apfd['emp_ind'] = line[36:37]
-        apfd['vend_code'] = line[37:47]
-        apfd['vend_assign_inv_nbr'] = line[47:62]
-        apfd['vend_assign_inv_date'] = line[62:70]
-        apfd['addr_select_vend_nbr'] = line[70:84]
-        apfd['goods_recieved_dt'] = line[308:316]
-        apfd['org_shp_zip_cd'] = line[316:327]
-        apfd['org_shp_state_cd'] = line[327:329]
-        apfd['pmt_grp_cd'] = line[329:330]
-        apfd['scheduled_pmt_dt'] = line[335:343]
-        apfd['pmt_non_check_ind'] = line[343:344]
-        apfd['attachment_req_ind'] = line[344:345]
-        apfd['pmt_line_nbr'] = line[345:350]
-        apfd['account_nbr'] = line[352:359]
-        apfd['fin_object_cd'] = line[364:368]
-        apfd['org_reference_id'] = line[381:389]
-        apfd['pmt_tax_cd'] = line[389:390]
-        apfd['pmt_amt'] = line[390:402]
-        apfd['apply_disc_ind'] = line[402:403]
-        apfd['eft_override_ind'] = line[403:404]
-
-        if args.inv_num is None and args.org_doc is None:
-            out.append(apfd)
-        if args.inv_num is not None and apfd['vend_assign_inv_nbr'].rstrip() == args.inv_num:
-            out.append(apfd)
-        elif args.org_doc is not None and apfd['org_doc_num'].rstrip() == args.org_doc:
-            out.append(apfd)
-    out = sorted(out, key=lambda k: k['pmt_line_nbr'])
+        archive = open_archive(args.directory)
+        locations = find_lines(args.directory, args.index_file, archive,
+                               args.inv_num, args.org_doc, args.vend_code)
+        for f in sorted(set(path for path, _ in locations), reverse=True):
+            print "Found in file: %s" % f
+        records = (decode(line) for line in read_lines(locations, archive)
+                   if matches(line, filters))
+
+    if args.json_lines:
+        found = 0
+        for record in records:
+            sys.stdout.write(json.dumps(record) + "\n")
+            found += 1
+        if not found:
+            print "Records not found"
+            sys.exit(1)
+        sys.exit(0)
+
+    out = sorted(records, key=lambda k: k['pmt_line_nbr'])
     if not out:
         print "Records not found"
         sys.exit(1)
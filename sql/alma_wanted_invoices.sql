@@ -0,0 +1,8 @@
+-- Temporary table of the invoice numbers update_alma.py --kfs-temp-table
+-- joins in its KFS query. Run once, by the DBA, as the KFS account
+-- update_alma.py connects as (config.ini [oracle] username); update_alma.py
+-- only checks that it exists. Rows are private to each session and deleted
+-- when its transaction ends.
+create global temporary table ALMA_WANTED_INVOICES (
+    inv_nbr varchar2(255) primary key
+) on commit delete rows;
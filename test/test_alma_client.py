@@ -0,0 +1,152 @@
+import sys
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from timeit import default_timer
+
+sys.path.append("./..")
+import alma_client
+import fake_alma
+import update_alma
+import vendor_cache
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+TOTAL = fake_alma.INVOICES
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_rate(self):
+        """Test that calls past the burst are spaced at the rate"""
+        limiter = alma_client.RateLimiter(100, burst=5)
+        start = default_timer()
+        for _ in range(15):
+            limiter.acquire()
+        self.assertTrue(default_timer() - start >= 0.09)
+
+    def test_backoff(self):
+        """Test that the delays grow, jittered, up to the cap"""
+        for attempt in range(1, 10):
+            delay = alma_client.backoff_delay(attempt, 0.5, 30)
+            self.assertTrue(0 <= delay <= min(30, 0.5 * 2 ** attempt))
+
+
+@unittest.skipIf(requests is None, "requests is not installed")
+class TestAlmaClient(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_alma.FakeAlma().start()
+        self.client = alma_client.AlmaClient(
+            'key', workers=4, base_url=self.server.base_url, rate=1000,
+            deadline=5, backoff=0.01
+        )
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_waiting_invoices(self):
+        """Test that every page and vendor is fetched over pooled connections"""
+        invs, nums, vendors = update_alma.get_waiting_invoices(None, client=self.client)
+        self.assertEquals(len(invs), TOTAL)
+        self.assertEquals(sorted(nums), sorted('INV%d' % n for n in range(TOTAL)))
+        self.assertEquals(vendors['INV15'], '2-0')
+        # 13 pages and 7 vendors over at most one connection per thread
+        self.assertTrue(len(self.server.connections) <= 4 + 1,
+                        "%d connections" % len(self.server.connections))
+
+    def test_retries(self):
+        """Test that throttled and failed calls are retried to a full result"""
+        self.server.error_rate = 0.3
+        self.server.random.seed(1)
+        invs, _, vendors = update_alma.get_waiting_invoices(None, client=self.client)
+        self.assertEquals(len(invs), TOTAL)
+        self.assertEquals(vendors['INV15'], '2-0')
+        self.assertTrue(self.server.throttled + self.server.failed > 0)
+        self.assertEquals(self.client.retries,
+                          self.server.throttled + self.server.failed)
+
+    def test_rate_limit(self):
+        """Test that calls throttled by the server's limit still succeed"""
+        self.server.rate_limit = 10
+        self.assertEquals(len(update_alma.get_waiting_invoices(
+            None, client=self.client)[0]), TOTAL)
+        self.assertTrue(self.server.throttled > 0)
+
+    def test_errors(self):
+        """Test that failures are raised, not returned as empty vendor ids,
+        and unknown vendors are not retried"""
+        self.assertRaises(alma_client.AlmaRequestError, self.client.vendor, 'NOPE')
+        self.assertEquals(self.client.retries, 0)
+        self.assertEquals(update_alma.fetch_vendor_code('NOPE', self.client),
+                          ('NOPE', None))
+        self.server.error_rate = 1
+        self.client.deadline = 0.2
+        self.assertRaises(IOError, update_alma.fetch_vendor_code, 'V1',
+                          self.client)
+
+    def test_unreachable(self):
+        """Test that a host refusing connections fails at once, not after
+        retrying until the deadline"""
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        base_url = 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+        sock.close()
+        client = alma_client.AlmaClient('key', base_url=base_url, deadline=30)
+        start = default_timer()
+        self.assertRaises(IOError, client.vendor, 'V1')
+        client.close()
+        self.assertEquals(client.retries, 0)
+        self.assertTrue(default_timer() - start < 5)
+
+    def test_missing_vendor(self):
+        """Test that the invoices of a vendor that cannot be looked up are
+        left out, and the run goes on"""
+        self.server.missing.add(2)
+        metrics = update_alma.Metrics('update_alma')
+        invs, nums, vendors = update_alma.get_waiting_invoices(
+            None, metrics, client=self.client)
+        left_out = [n for n in range(TOTAL) if n % fake_alma.VENDORS + 1 == 2]
+        self.assertEquals(len(invs), TOTAL - len(left_out))
+        self.assertEquals(sorted(nums), sorted(invs))
+        self.assertEquals(sorted(vendors), sorted(invs))
+        self.assertNotIn('INV%d' % left_out[0], invs)
+        self.assertEquals(metrics.counts['vendor_errors'], 1)
+        self.assertEquals(metrics.counts['skipped_invoices'], len(left_out))
+
+    def test_vendor_cache(self):
+        """Test that a second run takes every vendor from the cache"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "vendor_cache.sqlite")
+            for calls in (7, 7):
+                cache = vendor_cache.VendorCache(path)
+                _, _, vendors = update_alma.get_waiting_invoices(
+                    None, client=self.client, vendor_cache=cache)
+                cache.close()
+                self.assertEquals(self.server.vendor_calls, calls)
+                self.assertEquals(vendors['INV15'], '2-0')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_prefetch(self):
+        """Test that vendors are resolved from the paged vendor list"""
+        self.server.vendors = 250
+        _, _, vendors = update_alma.get_waiting_invoices(
+            None, client=self.client, prefetch=True)
+        self.assertEquals((self.server.vendor_pages, self.server.vendor_calls),
+                          (3, 0))
+        self.assertEquals(vendors['INV15'], '16-0')
+
+    def test_imap(self):
+        """Test that results are yielded as the calls complete"""
+        self.assertEquals(sorted(self.client.imap(abs, [-3, 1, -2])), [1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.append("./..")
+import apfeed_columns
+import xml_to_apfeed
+from apfeed_layout import LAYOUT
+
+cwd = os.getcwd()
+
+# Test files
+test_dir = os.path.join(cwd, "test")
+xml_dir = os.path.join(test_dir, "xml")
+test_xml = os.path.join(xml_dir, "test.xml")
+
+
+class TestColumns(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "apfeed.LG.1")
+        apf = xml_to_apfeed.Apfeed(self.path)
+        for inv in xml_to_apfeed.iter_invoices(test_xml):
+            apf.add_inv(inv)
+        apf.close()
+        with open(self.path) as feed:
+            self.data = feed.read()
+        self.lines = self.data.splitlines()[1:-1]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_decode(self):
+        """Test that the columns hold what LAYOUT unpacks from each line"""
+        columns = apfeed_columns.decode_feed(self.data, use_numpy=False)
+        for name in ('vend_code', 'account_nbr', 'pmt_tax_cd'):
+            self.assertEquals(list(columns[name]),
+                              [LAYOUT.unpack(l)[name] for l in self.lines])
+        for name in ('org_doc_nbr', 'pmt_amt', 'scheduled_pmt_dt'):
+            self.assertEquals(list(columns[name]),
+                              [int(LAYOUT.unpack(l)[name]) for l in self.lines])
+
+    @unittest.skipIf(apfeed_columns.numpy is None, "numpy is not installed")
+    def test_numpy(self):
+        """Test that the vectorized decode matches the line by line decode"""
+        expected = apfeed_columns.decode_feed(self.data, use_numpy=False)
+        for data in (self.data, self.data.replace(self.lines[0], self.lines[0].rstrip())):
+            columns = apfeed_columns.decode_feed(data, use_numpy=True)
+            for name, values in expected.iteritems():
+                self.assertEquals(columns[name].tolist(), list(values), name)
+
+    def test_totals(self):
+        """Test that totals by key add up to the total of all lines"""
+        shutil.copy(self.path, os.path.join(self.tmp_dir, "apfeed.LG.2"))
+        paths = [self.path, os.path.join(self.tmp_dir, "apfeed.LG.2")]
+        plain = apfeed_columns.load_feeds(paths, use_numpy=False)
+        self.assertEquals(len(plain), 2 * len(self.lines))
+        totals = plain.totals('account_nbr', 'fiscal_month')
+        self.assertEquals(sum(totals.values()), sum(plain['pmt_amt']))
+        if apfeed_columns.numpy is not None:
+            table = apfeed_columns.load_feeds(paths)
+            self.assertEquals(table.totals('account_nbr', 'fiscal_month'), totals)
+            self.assertEquals(table.totals('feed', 'vend_code'),
+                              plain.totals('feed', 'vend_code'))
+
+    def test_fiscal_month(self):
+        """Test that fiscal years start in July"""
+        self.assertEquals(apfeed_columns.fiscal_month(20170630), 201712)
+        self.assertEquals(apfeed_columns.fiscal_month(20170701), 201801)
+
+    @unittest.skipIf(apfeed_columns.numpy is None, "numpy is not installed")
+    def test_save(self):
+        """Test that saved columns load back unchanged"""
+        table = apfeed_columns.load_feeds([self.path])
+        path = os.path.join(self.tmp_dir, "columns.npz")
+        table.save(path)
+        loaded = apfeed_columns.load_columns(path)
+        self.assertEquals(loaded.feeds, ["apfeed.LG.1"])
+        for name, values in table.columns.iteritems():
+            self.assertEquals(loaded[name].tolist(), values.tolist(), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
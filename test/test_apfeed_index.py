@@ -0,0 +1,75 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.append("./..")
+import apfeed_index
+import xml_to_apfeed
+from apfeed_layout import LAYOUT
+
+cwd = os.getcwd()
+
+# Test files
+test_dir = os.path.join(cwd, "test")
+xml_dir = os.path.join(test_dir, "xml")
+test_xml = os.path.join(xml_dir, "test.xml")
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        apf = xml_to_apfeed.Apfeed(os.path.join(self.tmp_dir, "apfeed.LG.1"))
+        for inv in xml_to_apfeed.iter_invoices(test_xml):
+            apf.add_inv(inv)
+        apf.close()
+        self.last = apf.org_doc_nbr
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookups(self):
+        """Test that indexed lines are found by org_doc_nbr, invoice and vendor"""
+        index = apfeed_index.ApfeedIndex(self.tmp_dir)
+        self.assertEquals(index.update(), 1)
+        self.assertEquals(index.update(), 0, "Unchanged feed was indexed again")
+
+        with open(os.path.join(self.tmp_dir, "apfeed.LG.1")) as feed:
+            lines = feed.readlines()[1:-1]
+        org_doc_nbr = LAYOUT.get(lines[0], 'org_doc_nbr')
+        expected = [l for l in lines if LAYOUT.get(l, 'org_doc_nbr') == org_doc_nbr]
+        found = apfeed_index.read_lines(index.find_org_doc(org_doc_nbr))
+        self.assertEquals(found, expected)
+
+        inv_nbr = LAYOUT.get(lines[-1], 'vend_assign_inv_nbr').rstrip()
+        for line in apfeed_index.read_lines(index.find_invoice(inv_nbr)):
+            self.assertEquals(LAYOUT.get(line, 'vend_assign_inv_nbr').rstrip(), inv_nbr)
+        vend_code = LAYOUT.get(lines[0], 'vend_code').rstrip()
+        self.assertTrue(index.find_vendor(vend_code))
+        self.assertEquals(index.find_invoice("NOSUCHINVOICE"), [])
+        self.assertEquals(index.feeds_for_org_doc(org_doc_nbr),
+                          [os.path.join(self.tmp_dir, "apfeed.LG.1")])
+        index.close()
+
+    def test_update(self):
+        """Test that added feeds are indexed and removed feeds dropped"""
+        index = apfeed_index.ApfeedIndex(self.tmp_dir)
+        index.update()
+        shutil.copy(os.path.join(self.tmp_dir, "apfeed.LG.1"),
+                    os.path.join(self.tmp_dir, "apfeed.LG.2"))
+        self.assertEquals(index.add_feed("apfeed.LG.2"), index.add_feed("apfeed.LG.1"))
+        locations = index.find_org_doc(self.last)
+        self.assertEquals(sorted(set(os.path.basename(p) for p, _ in locations)),
+                          ["apfeed.LG.1", "apfeed.LG.2"])
+
+        os.remove(os.path.join(self.tmp_dir, "apfeed.LG.1"))
+        self.assertEquals(index.update(), 0)
+        locations = index.find_org_doc(self.last)
+        self.assertEquals(set(os.path.basename(p) for p, _ in locations),
+                          set(["apfeed.LG.2"]))
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import sys
+import os
+import unittest
+
+sys.path.append("./..")
+import apfeed_layout
+import xml_to_apfeed
+
+cwd = os.getcwd()
+
+# Test files
+test_dir = os.path.join(cwd, "test")
+xml_dir = os.path.join(test_dir, "xml")
+test_xml = os.path.join(xml_dir, "test.xml")
+
+
+class TestLayout(unittest.TestCase):
+    def test_positions(self):
+        """Test that the layout matches the documented apfeed positions"""
+        layout = apfeed_layout.LAYOUT
+        self.assertEquals(layout.width, 524)
+        for name, start, end in (('time', 15, 29),
+                                 ('org_doc_nbr', 29, 36),
+                                 ('vend_code', 37, 47),
+                                 ('addr_select_vend_nbr', 70, 84),
+                                 ('goods_received_dt', 308, 316),
+                                 ('org_shp_state_cd', 327, 329),
+                                 ('scheduled_pmt_dt', 335, 343),
+                                 ('pmt_line_nbr', 345, 350),
+                                 ('account_nbr', 352, 359),
+                                 ('fin_object_cd', 364, 368),
+                                 ('org_reference_id', 381, 389),
+                                 ('pmt_amt', 390, 402),
+                                 ('eft_override_ind', 403, 404)):
+            self.assertEquals(layout.slices[name], slice(start, end), "%s is not at %d-%d" % (name, start, end))
+
+    def test_round_trip(self):
+        """Test that unpacking what Apfeed writes gives back its values"""
+        apf = xml_to_apfeed.Apfeed()
+        for inv in xml_to_apfeed.iter_invoices(test_xml):
+            apf.add_inv(inv)
+        for line in apf.invoices:
+            self.assertEquals(len(line), apfeed_layout.LAYOUT.width)
+        rec = apfeed_layout.LAYOUT.unpack(apf.invoices[0])
+        self.assertEquals(rec['header'], 'GENERALLIBRARY ')
+        self.assertEquals(rec['vend_assign_inv_nbr'], '0201821        ')
+        self.assertEquals(rec['pmt_amt'], '000000002950')
+        self.assertEquals(rec['pmt_remit_nm'], ' ' * 40)
+        rec.update(org_doc_nbr=int(rec['org_doc_nbr']), pmt_line_nbr=18, pmt_amt=2950)
+        self.assertEquals(apfeed_layout.LAYOUT.pack(rec), apf.invoices[0])
+
+    def test_short_account(self):
+        """Test that an account shorter than 7 characters is padded so the
+        columns after it stay in place (the old writer shifted them)"""
+        apf = xml_to_apfeed.Apfeed()
+        inv = xml_to_apfeed.xml_to_invoices(test_xml)[0]
+        rec = xml_to_apfeed.extract_invoice(inv)
+        for line in rec['lines']:
+            line['external_ids'] = ['HSBOOK']
+        apf.add_record(rec)
+        line = apf.invoices[0]
+        self.assertEquals(len(line), apfeed_layout.LAYOUT.width)
+        self.assertEquals(line[352:359], 'HSBOOK ')
+        self.assertEquals(apfeed_layout.LAYOUT.unpack(line)['fin_object_cd'],
+                          apf.fin_object_cd)
+
+    def test_short_line(self):
+        """Test that short lines unpack padded instead of failing"""
+        rec = apfeed_layout.LAYOUT.unpack("GENERALLIBRARY 20170101000000")
+        self.assertEquals(rec['time'], '20170101000000')
+        self.assertEquals(rec['org_doc_nbr'], ' ' * 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.append("./..")
+import apfeed_ledger
+import xml_to_apfeed
+
+cwd = os.getcwd()
+
+# Test files
+test_dir = os.path.join(cwd, "test")
+xml_dir = os.path.join(test_dir, "xml")
+test_xml = os.path.join(xml_dir, "test.xml")
+
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "ledger.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_files(self):
+        """Test that file hashes are only kept once committed"""
+        digest = apfeed_ledger.file_hash(test_xml)
+        ledger = apfeed_ledger.Ledger(self.path, "apfeed.LG.1")
+        self.assertIsNone(ledger.add_file(digest, "test.xml"))
+        self.assertEquals(ledger.add_file(digest, "copy.xml"), "apfeed.LG.1", "Same content in one run not detected")
+        ledger.close()
+
+        ledger = apfeed_ledger.Ledger(self.path, "apfeed.LG.2")
+        self.assertIsNone(ledger.add_file(digest, "test.xml"), "Uncommitted file was kept")
+        ledger.commit()
+        ledger.close()
+
+        ledger = apfeed_ledger.Ledger(self.path, "apfeed.LG.3")
+        self.assertEquals(ledger.add_file(digest, "test.xml"), "apfeed.LG.2")
+        self.assertEquals(ledger.release("apfeed.LG.2"), 1)
+        self.assertIsNone(ledger.add_file(digest, "test.xml"), "Released file still detected")
+
+    def test_duplicate_invoices(self):
+        """Test that invoices converted before are validation errors"""
+        ledger = apfeed_ledger.Ledger(self.path, "apfeed.LG.1")
+        apf = xml_to_apfeed.Apfeed(ledger=ledger)
+        for inv in xml_to_apfeed.iter_invoices(test_xml):
+            apf.add_inv(inv)
+        self.assertEquals(apf.errors, 0, "A charge and its reversal in one export are not duplicates")
+        ledger.commit()
+        ledger.close()
+
+        ledger = apfeed_ledger.Ledger(self.path, "apfeed.LG.2")
+        apf = xml_to_apfeed.Apfeed(ledger=ledger)
+        for inv in xml_to_apfeed.iter_invoices(test_xml):
+            apf.add_inv(inv)
+        self.assertEquals(apf.errors, 4, "Each invoice already converted should be an error")
+        self.assertEquals(apf.count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
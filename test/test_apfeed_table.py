@@ -0,0 +1,55 @@
+import sys
+import os
+import unittest
+
+sys.path.append("./..")
+import apfeed_table
+import xml_to_apfeed
+
+cwd = os.getcwd()
+
+# Test files
+test_dir = os.path.join(cwd, "test")
+xml_dir = os.path.join(test_dir, "xml")
+test_xml = os.path.join(xml_dir, "test.xml")
+
+
+class TestLineTable(unittest.TestCase):
+    def test_totals(self):
+        """Test that totals group in integer cents by account and invoice"""
+        table = apfeed_table.LineTable()
+        a = table.add_invoice(3001258, 'A1', 'V1', 'V1-0', 20170101, '20170102', 'N')
+        b = table.add_invoice(3001259, 'B1', 'V2', 'V2-0', 20170101, '20170102', 'Y')
+        c = table.add_invoice(3001260, 'A1', 'V1', 'V1-0', 20170101, '20170102', 'N')
+        table.add_line(a, 1, 'MAINBKS', '', '0', 1001)
+        table.add_line(a, 2, 'MAINSER', '', 'B', 250)
+        table.add_line(b, 1, 'MAINBKS', '', 'C', 99)
+        table.add_line(c, 1, 'MAINBKS', '', '0', -1001)
+        self.assertEquals(len(table), 4)
+        self.assertEquals(table.accounts, ['MAINBKS', 'MAINSER'])
+        self.assertEquals(table.totals_by_account(10), {'MAINBKS': (99, 10), 'MAINSER': (250, 25)})
+        self.assertEquals(table.totals_by_invoice(10), {'A1': (250, 25), 'B1': (99, 10)})
+
+    def test_use_tax(self):
+        """Test that use tax rounds half a cent up, not by its float value"""
+        # 14.5 cents, which is 0.14499... as a float
+        self.assertEquals(apfeed_table.use_tax(200, 7.25), 15)
+        self.assertEquals(apfeed_table.use_tax(-200, 7.25), -15)
+        self.assertEquals(apfeed_table.use_tax(199, 7.25), 14)
+        self.assertEquals(apfeed_table.use_tax(0, 7.25), 0)
+
+    def test_apfeed_table(self):
+        """Test that Apfeed keeps one table row per apfeed line"""
+        apf = xml_to_apfeed.Apfeed()
+        for inv in xml_to_apfeed.iter_invoices(test_xml):
+            apf.add_inv(inv)
+        table = apf.table
+        self.assertEquals(len(table), apf.count)
+        for row, line in enumerate(apf.invoices):
+            self.assertEquals(int(line[390:402]), table.pmt_amt[row])
+            self.assertEquals(line[352:359].strip(), table.accounts[table.account[row]])
+            self.assertEquals(int(line[29:36]), table.org_doc_nbr[table.inv[row]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import sys
+import os
+import json
+import shutil
+import tempfile
+import time
+import unittest
+
+sys.path.append("./..")
+import apfeed_watch
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xml_dir = os.path.join(self.tmp_dir, "xml")
+        self.apfeed_dir = os.path.join(self.tmp_dir, "apfeed")
+        os.mkdir(self.xml_dir)
+        os.mkdir(self.apfeed_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def touch(self, path, age=0):
+        with open(path, 'w') as f:
+            f.write("<xml/>")
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def test_scan(self):
+        """Test that only settled xml files are ready"""
+        self.touch(os.path.join(self.xml_dir, "old.xml"), age=10)
+        self.touch(os.path.join(self.xml_dir, "new.xml"))
+        self.touch(os.path.join(self.xml_dir, "notes.txt"), age=10)
+        ready, settling = apfeed_watch.scan_xmls(self.xml_dir, 5)
+        self.assertEquals([path for path, _ in ready], [os.path.join(self.xml_dir, "old.xml")])
+        self.assertTrue(settling)
+
+        self.touch(os.path.join(self.apfeed_dir, ".apfeed.LG.1.tmp"))
+        self.assertEquals(apfeed_watch.pending_apfeeds(self.apfeed_dir), [])
+        self.touch(os.path.join(self.apfeed_dir, "apfeed.LG.1"))
+        self.assertEquals(apfeed_watch.pending_apfeeds(self.apfeed_dir), ["apfeed.LG.1"])
+
+    def test_watch(self):
+        """Test that ready files are converted once, and not while an apfeed is pending"""
+        xml = os.path.join(self.xml_dir, "a.xml")
+        self.touch(xml, age=10)
+        pending = os.path.join(self.apfeed_dir, "apfeed.LG.1")
+        self.touch(pending)
+        status_path = os.path.join(self.tmp_dir, "status.json")
+        calls = []
+        states = []
+
+        def convert(xmls):
+            calls.append(xmls)
+            return {'status': 'invalid', 'files': xmls}
+
+        def stop():
+            states.append(status.data['state'])
+            if len(states) == 2:
+                # Uploaded, the next scan may convert
+                os.unlink(pending)
+            return len(states) > 3
+
+        status = apfeed_watch.Status(status_path)
+        apfeed_watch.watch(self.xml_dir, self.apfeed_dir, convert, status,
+                           settle=0, interval=0.01, stop=stop)
+        self.assertEquals(calls, [[xml]], "Failed batch is not retried until it changes")
+        self.assertEquals(states[:2], ['idle', 'waiting'])
+        with open(status_path) as status_file:
+            data = json.load(status_file)
+        self.assertEquals(data['state'], 'stopped')
+        self.assertEquals(data['last']['status'], 'invalid')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import sys
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+sys.path.append("./..")
+import apfeed_index
+import block_archive
+import xml_to_apfeed
+
+cwd = os.getcwd()
+
+# Test files
+test_dir = os.path.join(cwd, "test")
+xml_dir = os.path.join(test_dir, "xml")
+test_xml = os.path.join(xml_dir, "test.xml")
+test_utax = os.path.join(xml_dir, "test_utax.xml")
+
+
+class TestBlockArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "xml.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_random_access(self):
+        """Test that files and ranges across blocks read back unchanged"""
+        archive = block_archive.BlockArchive(self.path, block_size=1000)
+        archive.add(test_xml)
+        archive.add(test_utax)
+        with open(test_utax) as xml:
+            expected = xml.read()
+        self.assertEquals(archive.read("test_utax.xml"), expected)
+        self.assertEquals(archive.read_range("test_utax.xml", 990, 1500), expected[990:2490])
+        self.assertEquals(archive.read_range("test_utax.xml", len(expected) - 5, 100), expected[-5:])
+        offset = expected.index("\n", 1500) + 1
+        self.assertEquals(archive.read_line("test_utax.xml", offset),
+                          expected[offset:expected.index("\n", offset) + 1])
+        self.assertEquals([e[0] for e in archive.entries("*utax*")], ["test_utax.xml"])
+        self.assertRaises(KeyError, archive.read, "missing.xml")
+        archive.close()
+
+        # Still a gzip file holding every archived file in order
+        with open(test_xml) as xml:
+            expected = xml.read() + expected
+        self.assertEquals(gzip.open(self.path).read(), expected)
+
+    def test_replace(self):
+        """Test that adding a name again replaces it and extract restores it"""
+        archive = block_archive.BlockArchive(self.path)
+        archive.add(test_xml, "same.xml")
+        archive.add(test_utax, "same.xml")
+        self.assertEquals(len(archive.entries()), 1)
+        path = archive.extract("same.xml", self.tmp_dir)
+        with open(path) as restored, open(test_utax) as xml:
+            self.assertEquals(restored.read(), xml.read())
+        self.assertTrue(block_archive.open_archive(os.path.join(self.tmp_dir, "xml")) is not None)
+        self.assertTrue(block_archive.open_archive(os.path.join(self.tmp_dir, "apfeed")) is None)
+
+    def test_indexed_feed(self):
+        """Test that apfeed lines are found and read from the archive"""
+        feed_dir = os.path.join(self.tmp_dir, "apfeed")
+        os.mkdir(feed_dir)
+        feed = os.path.join(self.tmp_dir, "apfeed.LG.1")
+        apf = xml_to_apfeed.Apfeed(feed)
+        for inv in xml_to_apfeed.iter_invoices(test_xml):
+            apf.add_inv(inv)
+        apf.close()
+        with open(feed) as feed_file:
+            lines = feed_file.readlines()[1:-1]
+
+        archive = block_archive.BlockArchive(block_archive.archive_path(feed_dir),
+                                             block_size=700)
+        archive.add(feed)
+        index = apfeed_index.ApfeedIndex(feed_dir, archive=archive)
+        self.assertEquals(index.update(), 1)
+        self.assertEquals(index.update(), 0)
+        locations = index.find_org_doc(apf.org_doc_nbr)
+        found = apfeed_index.read_lines(locations, archive)
+        self.assertEquals(found, [l for l in lines if l[29:36] == "%07d" % apf.org_doc_nbr])
+
+
+if __name__ == '__main__':
+    unittest.main()
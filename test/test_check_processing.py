@@ -0,0 +1,79 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.append("./..")
+import check_processing
+
+cwd = os.getcwd()
+
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "config.ini")
+        shutil.copy(os.path.join(cwd, "config.ini"), self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_typed(self):
+        """Test that options are converted to their types"""
+        config = check_processing.load_config(self.path)
+        self.assertTrue(isinstance(config.apfeed.org_doc_nbr, int))
+        self.assertTrue(isinstance(config.apfeed.tax_perc, float))
+        self.assertTrue(isinstance(config.apfeed.emp_ind, str))
+        self.assertEquals(config.apfeed.fin_coa_cd.strip(), config.apfeed.fin_coa_cd)
+
+    def test_optional(self):
+        """Test that a missing optional option takes its default"""
+        self.assertEquals(check_processing.Config(self.path).alma.deadline, None)
+        config = check_processing.Config(self.path)
+        config.parser.set('alma', 'deadline', '30')
+        self.assertEquals(config.alma.deadline, 30.0)
+
+    def test_cached(self):
+        """Test that the config is parsed again only when the file changes"""
+        config = check_processing.load_config(self.path)
+        self.assertTrue(check_processing.load_config(self.path) is config)
+        os.utime(self.path, (0, 0))
+        self.assertFalse(check_processing.load_config(self.path) is config)
+
+    def test_set_org_doc_nbr(self):
+        """Test that the org_doc_nbr is saved and seen by the next load"""
+        config = check_processing.load_config(self.path)
+        config.set_org_doc_nbr(config.apfeed.org_doc_nbr + 10)
+        self.assertEquals(config.apfeed.org_doc_nbr,
+                          check_processing.Config(self.path).apfeed.org_doc_nbr)
+        self.assertTrue(check_processing.load_config(self.path) is config)
+
+
+class TestRuntime(unittest.TestCase):
+    def test_dirs_and_latest_log(self):
+        """Test that directories are created and the latest log relinked"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            archive_dir = os.path.join(tmp_dir, "archive")
+            xml_arch_dir = os.path.join(archive_dir, "xml")
+            check_processing.make_dirs(archive_dir, xml_arch_dir)
+            check_processing.make_dirs(archive_dir, xml_arch_dir)
+            self.assertTrue(os.path.isdir(xml_arch_dir))
+
+            latest = os.path.join(tmp_dir, "script.latest.log")
+            for name in ("script.1.log", "script.2.log"):
+                log = os.path.join(tmp_dir, name)
+                check_processing.link_latest_log(log, latest)
+                self.assertEquals(os.readlink(latest), log)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_bad_level(self):
+        """Test that an unknown log level is refused"""
+        self.assertRaises(ValueError, check_processing.setup_logging,
+                          tempfile.gettempdir(), "x.log", "LOUD")
+
+
+if __name__ == '__main__':
+    unittest.main()
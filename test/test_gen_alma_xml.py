@@ -0,0 +1,64 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+sys.path.append("./..")
+import bench_apfeed
+import gen_alma_xml
+import xml_to_apfeed
+
+
+class TestGenAlmaXml(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_converts(self):
+        """Test that a synthetic export converts cleanly and covers each case"""
+        path = os.path.join(self.tmp_dir, "synthetic.xml")
+        with open(path, 'wb') as xml_file:
+            gen_alma_xml.write_xml(xml_file, 200, seed=1)
+        records = xml_to_apfeed.extract_file(path, 'etree')
+        self.assertEquals(len(records), 200)
+        self.assertEquals(len(set(rec['invoice_number'] for rec in records)), 200)
+
+        apf = xml_to_apfeed.Apfeed()
+        for rec in records:
+            apf.add_record(rec)
+        self.assertEquals(apf.errors, 0)
+        lines = sum(max(1, len(line['sums'])) for rec in records for line in rec['lines'])
+        self.assertEquals(apf.count, lines)
+
+        self.assertTrue(any(len(line['sums']) > 1 for rec in records for line in rec['lines']), "Multi fund lines")
+        self.assertTrue(any(line['po_line_number'] is None for rec in records for line in rec['lines']), "Missing PO lines")
+        self.assertTrue(any(float(rec['vat_amount']) > 0 for rec in records), "VAT")
+        self.assertEquals(set(line[389] for line in apf.invoices), set('0AC'))
+        self.assertEquals(set(line[344] for line in apf.invoices), set('NY'))
+
+    def test_seed(self):
+        """Test that the same seed gives the same export"""
+        first, second, other = StringIO(), StringIO(), StringIO()
+        gen_alma_xml.write_xml(first, 20, seed=3)
+        gen_alma_xml.write_xml(second, 20, seed=3)
+        gen_alma_xml.write_xml(other, 20, seed=4)
+        self.assertEquals(first.getvalue(), second.getvalue())
+        self.assertNotEquals(first.getvalue(), other.getvalue())
+        self.assertRaises(ValueError, gen_alma_xml.write_xml, first, 1, 0, no_such=1)
+
+    def test_bench_stages(self):
+        """Test that every benchmark stage runs and counts its lines"""
+        path = bench_apfeed.synthetic_xml(self.tmp_dir, 20, 0)
+        for stage in bench_apfeed.STAGE_NAMES:
+            result = bench_apfeed.measure(stage, path, 'etree')
+            self.assertTrue(result['lines'] > 0, stage)
+            self.assertTrue(result['seconds'] >= 0, stage)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import sys
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.append("./..")
+import metrics
+import xml_to_apfeed
+
+cwd = os.getcwd()
+
+# Test files
+test_dir = os.path.join(cwd, "test")
+xml_dir = os.path.join(test_dir, "xml")
+test_xml = os.path.join(xml_dir, "test.xml")
+
+
+class TestMetrics(unittest.TestCase):
+    def test_stages(self):
+        """Test that stage times add up and counts accumulate"""
+        m = metrics.Metrics('test')
+        for _ in range(3):
+            with m.stage('b'):
+                pass
+        with m.stage('a'):
+            pass
+        self.assertEquals(m.stages.keys(), ['b', 'a'])
+        self.assertEquals(list(m.iterate('c', [1, 2, 3])), [1, 2, 3])
+        self.assertTrue('c' in m.stages)
+        m.count('rows')
+        m.count('rows', 4)
+        self.assertEquals(m.counts, {'rows': 5})
+
+    def test_write(self):
+        """Test that the metrics are written as JSON"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "metrics.json")
+            m = metrics.Metrics('xml_to_apfeed')
+            apf = xml_to_apfeed.Apfeed(metrics=m)
+            for inv in xml_to_apfeed.iter_invoices(test_xml):
+                apf.add_inv(inv)
+            m.write(path)
+            self.assertEquals(os.listdir(tmp_dir), ["metrics.json"])
+            with open(path) as metrics_file:
+                data = json.load(metrics_file)
+            self.assertEquals(data['script'], 'xml_to_apfeed')
+            self.assertEquals(sorted(data['stages']), ['format', 'validate'])
+            self.assertTrue(data['peak_rss_kb'] > 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.append("./..")
+import read_apfeed
+import xml_to_apfeed
+
+cwd = os.getcwd()
+
+# Test files
+test_dir = os.path.join(cwd, "test")
+xml_dir = os.path.join(test_dir, "xml")
+test_xml = os.path.join(xml_dir, "test.xml")
+
+
+class TestScan(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "apfeed.LG.1")
+        apf = xml_to_apfeed.Apfeed(self.path)
+        for inv in xml_to_apfeed.iter_invoices(test_xml):
+            apf.add_inv(inv)
+        apf.close()
+        with open(self.path) as feed:
+            self.lines = feed.readlines()[1:-1]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_all(self):
+        """Test that every line but the header and trailer is decoded"""
+        records = list(read_apfeed.scan([self.path]))
+        self.assertEquals(records, [read_apfeed.decode(l) for l in self.lines])
+
+    def test_filters(self):
+        """Test that filters on the raw bytes match filters on decoded lines"""
+        first = read_apfeed.decode(self.lines[0])
+        for filters in (read_apfeed.make_filters(org_doc=first['org_doc_num']),
+                        read_apfeed.make_filters(inv_num=first['vend_assign_inv_nbr'].rstrip()),
+                        read_apfeed.make_filters(vend_code="0000000000",
+                                                 org_doc=first['org_doc_num']),
+                        read_apfeed.make_filters(org_doc="9999999")):
+            expected = [read_apfeed.decode(l) for l in self.lines
+                        if read_apfeed.matches(l, filters)]
+            self.assertEquals(list(read_apfeed.scan([self.path], filters)), expected)
+        self.assertTrue(expected == [], "Unknown org_doc_nbr matched")
+
+    def test_globs(self):
+        """Test that glob patterns expand to every matching feed"""
+        shutil.copy(self.path, os.path.join(self.tmp_dir, "apfeed.LG.2"))
+        paths = read_apfeed.expand_paths([os.path.join(self.tmp_dir, "apfeed.LG.*")])
+        self.assertEquals([os.path.basename(p) for p in paths], ["apfeed.LG.1", "apfeed.LG.2"])
+        self.assertEquals(len(list(read_apfeed.scan(paths))), 2 * len(self.lines))
+
+    def test_find_lines(self):
+        """Test that lines are found with or without a usable index"""
+        org_doc = int(read_apfeed.decode(self.lines[0])['org_doc_num'])
+        expected = [l for l in self.lines
+                    if read_apfeed.matches(l, read_apfeed.make_filters(org_doc=org_doc))]
+        self.assertTrue(expected)
+        indexed = read_apfeed.find_lines(self.tmp_dir, org_doc=org_doc)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, "apfeed.index.sqlite")))
+        self.assertEquals(read_apfeed.read_lines(indexed), expected)
+
+        # An index that cannot be opened falls back to reading every feed
+        missing = os.path.join(self.tmp_dir, "missing", "apfeed.index.sqlite")
+        scanned = read_apfeed.find_lines(self.tmp_dir, missing, org_doc=org_doc)
+        self.assertEquals(scanned, indexed)
+        inv_num = read_apfeed.decode(self.lines[-1])['vend_assign_inv_nbr'].rstrip()
+        self.assertEquals(read_apfeed.find_lines(self.tmp_dir, missing, inv_num=inv_num),
+                          read_apfeed.find_lines(self.tmp_dir, inv_num=inv_num))
+
+
+if __name__ == '__main__':
+    unittest.main()
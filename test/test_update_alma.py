@@ -1,11 +1,20 @@
 import sys
 import os
+import threading
+import time
 import unittest
 import xml.etree.ElementTree as ET
 
 sys.path.append("./..")
+import alma_client
+import fake_alma
 import update_alma
 
+try:
+    import requests
+except ImportError:
+    requests = None
+
 from pprint import pprint
 
 cwd = os.getcwd()
@@ -15,6 +24,242 @@ nse = "http://com/exlibris/repository/acq/xmlbeans"
 # Test files
 test_dir = os.path.join(cwd, "test")
 
+def pay_all(num):
+    """KFS row paying an invoice number to vendor 8563-0"""
+    return ['1', '8563-0', 'YANKEE', num, 'C1', 1, '20170321', 'DV']
+
+
+def pay_every_third(num):
+    """KFS row paying fake_alma's INV<n> when n is a multiple of 3, to its
+    vendor, None otherwise"""
+    n = int(num[3:])
+    if n % 3 == 0:
+        return [str(n), '%d-0' % (n % fake_alma.VENDORS + 1), 'VENDOR', num,
+                'C%d' % n, n, '20170321', 'DV']
+    return None
+
+
+class FakeCursor(object):
+    """Cursor answering the row its connection pays for each invoice
+    number bound"""
+
+    def __init__(self, kfs):
+        self.kfs = kfs
+        self.rows = []
+
+    def execute(self, query, params):
+        self.kfs.executed(query)
+        self.rows = [row for row in (self.kfs.pay(num) for num in params
+                                     if num is not None) if row]
+
+    def fetchmany(self):
+        rows = self.rows[:self.arraysize]
+        del self.rows[:self.arraysize]
+        return [self.rowfactory(*row) for row in rows]
+
+    def close(self):
+        pass
+
+
+class FakeKfs(object):
+    """KFS connection counting the queries and statements run on it"""
+
+    def __init__(self, pay=pay_all):
+        """
+        Args:
+            pay (callable): KFS row of an invoice number, None if unpaid.
+        """
+        self.pay = pay
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.statements = set()
+        self.closed = False
+
+    def executed(self, query):
+        with self.lock:
+            self.queries += 1
+            self.statements.add(query)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(object):
+    """Session pool handing out one FakeKfs, counting the sessions out"""
+
+    def __init__(self, kfs=None):
+        self.kfs = kfs or FakeKfs()
+        self.lock = threading.Lock()
+        self.out = 0
+        self.most_out = 0
+        self.closed = False
+
+    def acquire(self):
+        with self.lock:
+            self.out += 1
+            self.most_out = max(self.most_out, self.out)
+        time.sleep(0.01)
+        return self.kfs
+
+    def release(self, con):
+        with self.lock:
+            self.out -= 1
+
+    def close(self):
+        self.closed = True
+
+
+class TestKfsQuery(unittest.TestCase):
+    def test_chunks(self):
+        """Test that chunks share one statement and run on pooled sessions"""
+        nums = ['INV%d' % n for n in range(2345)]
+        pool = FakePool()
+        metrics = update_alma.Metrics('update_alma')
+        rows = update_alma.kfs_query(nums, pool=pool, sessions=3,
+                                     chunk_size=1000, metrics=metrics)
+        self.assertNotIn('kfs_query', metrics.stages, "Timed before running")
+        rows = list(rows)
+        self.assertTrue(metrics.stages['kfs_query'] > 0)
+        self.assertEquals(sorted(row.num for row in rows), sorted(nums))
+        self.assertTrue(all(isinstance(row, update_alma.KfsRow) for row in rows))
+        self.assertEquals(len(pool.kfs.statements), 1)
+        self.assertEquals(list(pool.kfs.statements)[0].count(':'), 1000)
+        self.assertEquals((pool.out, pool.closed), (0, False))
+        self.assertTrue(pool.most_out <= 3, pool.most_out)
+
+    def test_join_query(self):
+        """Test that the numbers are inserted once and joined, not listed"""
+        con = FakeConnection(True)
+        rows = list(update_alma.kfs_join_query(['B', 'A', 'B'], con))
+        self.assertEquals([row.num for row in rows], ['A', 'B'])
+        self.assertEquals(con.rolled_back, True)
+        self.assertEquals(con.wanted, [])
+        self.assertEquals(len([q for q in con.statements if 'insert' in q]), 1)
+        self.assertFalse(any(' IN (' in q for q in con.statements))
+
+    def test_join_query_without_table(self):
+        """Test that a missing temporary table fails instead of being created"""
+        con = FakeConnection(False)
+        self.assertRaises(IOError, list, update_alma.kfs_join_query(['A'], con))
+        self.assertFalse(any('create' in q or 'insert' in q for q in con.statements))
+        self.assertEquals(con.rolled_back, True)
+
+    def test_bind_chunks(self):
+        """Test that the last chunk is padded to the same size"""
+        chunks = list(update_alma.bind_chunks(['a', 'b', 'c'], 2))
+        self.assertEquals(chunks, [['a', 'b'], ['c', None]])
+
+
+class FakeConnection(object):
+    """Connection with a session temporary table of invoice numbers"""
+
+    def __init__(self, table_exists):
+        self.table_exists = table_exists
+        self.wanted = []
+        self.statements = []
+        self.rolled_back = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+        self.result = [(int(self.table_exists),)]
+        if update_alma.KFS_TEMP_TABLE + ' W' in query:
+            self.result = [['1', '8563-0', 'YANKEE', num, 'C1', 1, '20170321', 'DV']
+                           for num in self.wanted]
+
+    def executemany(self, query, rows):
+        self.statements.append(query)
+        self.wanted.extend(row[0] for row in rows)
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchmany(self):
+        rows = self.result[:self.arraysize]
+        del self.result[:self.arraysize]
+        return [self.rowfactory(*row) for row in rows]
+
+    def rollback(self):
+        self.wanted = []
+        self.rolled_back = True
+
+    def close(self):
+        pass
+
+
+@unittest.skipIf(requests is None, "requests is not installed")
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_alma.FakeAlma().start()
+        self.client = alma_client.AlmaClient(
+            'key', workers=4, base_url=self.server.base_url, rate=1000,
+            deadline=5, backoff=0.01
+        )
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_pipeline(self):
+        """Test that the pipeline pays the same invoices as the phases"""
+        kfs = FakeKfs(pay_every_third)
+        erp = update_alma.ErpXml()
+        metrics = update_alma.Metrics('update_alma')
+        update_alma.run_pipeline(None, erp, 1, False, metrics, self.client,
+                                 chunk_size=500, connect=lambda: kfs)
+        self.assertEquals((kfs.queries, len(kfs.statements)), (3, 1))
+        self.assertTrue(kfs.closed)
+        self.assertIn('kfs_query', metrics.stages)
+        self.assertEquals(metrics.counts['alma_invoices'], fake_alma.INVOICES)
+
+        invs, nums, vendors = update_alma.get_waiting_invoices(None, client=self.client)
+        kfs_hash = update_alma.process_query(
+            update_alma.kfs_query(nums, FakeKfs(pay_every_third)), vendors, False)
+        phases = update_alma.ErpXml()
+        update_alma.add_paid_invoices(phases, invs, kfs_hash, 1)
+        self.assertEquals(erp.count, (fake_alma.INVOICES + 2) // 3)
+        self.assertEquals(sorted(erp.invs), sorted(phases.invs))
+
+    def test_pipeline_sessions(self):
+        """Test that the pipeline queries chunks on pooled sessions, and
+        looks no vendor up once the vendor list is prefetched"""
+        pool = FakePool(FakeKfs(pay_every_third))
+        erp = update_alma.ErpXml()
+        metrics = update_alma.Metrics('update_alma')
+        update_alma.run_pipeline(None, erp, 1, False, metrics, self.client,
+                                 refresh_vendors=True, prefetch=True,
+                                 chunk_size=100, sessions=3, pool=pool)
+        chunks = (fake_alma.INVOICES + 99) // 100
+        self.assertEquals(self.server.vendor_calls, 0)
+        self.assertEquals(metrics.counts['kfs_queries'], chunks)
+        self.assertEquals(pool.kfs.queries, chunks)
+        self.assertEquals([s.count(':') for s in pool.kfs.statements], [100])
+        self.assertEquals((pool.out, pool.closed), (0, False))
+        self.assertTrue(pool.most_out <= 3, pool.most_out)
+        self.assertEquals(erp.count, (fake_alma.INVOICES + 2) // 3)
+
+    def test_missing_vendor(self):
+        """Test that the pipeline leaves out the invoices of a vendor that
+        cannot be looked up"""
+        self.server.missing.add(2)
+        metrics = update_alma.Metrics('update_alma')
+        erp = update_alma.ErpXml()
+        update_alma.run_pipeline(None, erp, 1, False, metrics, self.client,
+                                 chunk_size=500,
+                                 connect=lambda: FakeKfs(pay_every_third))
+        left_out = [n for n in range(fake_alma.INVOICES)
+                    if n % fake_alma.VENDORS + 1 == 2]
+        self.assertEquals(metrics.counts['vendor_errors'], 1)
+        self.assertEquals(metrics.counts['skipped_invoices'], len(left_out))
+        self.assertEquals(erp.count, len([n for n in range(0, fake_alma.INVOICES, 3)
+                                          if n not in left_out]))
+
+
 class Test_Update_Alma(unittest.TestCase):
     def test_get_waiting_invoices(self):
         invoices, nums, vendors = update_alma.get_waiting_invoices(None)
@@ -30,8 +275,8 @@ class Test_Update_Alma(unittest.TestCase):
         test_input = ET.parse(test_input_xml).getroot()
         invoice_list = test_input.find("./", ns)
         for inv in invoice_list.findall("./", ns):
-            self.assertEquals(float(inv.find("{%s}voucher_amount/{%s}sum" % (nse, nse)).text), float(kfs_hash['US10046263']['pay_amt']), "KFS query mismatched our own test xml in pay amount %f != %f" % (float(inv.find("{%s}voucher_amount/{%s}sum" % (nse, nse)).text), float(kfs_hash['US10046263']['pay_amt'])))
-            self.assertEquals(inv.find("{%s}payment_voucher_date" %nse).text, kfs_hash['US10046263']['pay_date'], "KFS query mismatched our own test xml in pay date %s != %s" % (inv.find("{%s}payment_voucher_date" %nse).text, kfs_hash['US10046263']['pay_date']))
+            self.assertEquals(float(inv.find("{%s}voucher_amount/{%s}sum" % (nse, nse)).text), float(kfs_hash['US10046263'].pay_amt), "KFS query mismatched our own test xml in pay amount %f != %f" % (float(inv.find("{%s}voucher_amount/{%s}sum" % (nse, nse)).text), float(kfs_hash['US10046263'].pay_amt)))
+            self.assertEquals(inv.find("{%s}payment_voucher_date" %nse).text, kfs_hash['US10046263'].pay_date, "KFS query mismatched our own test xml in pay date %s != %s" % (inv.find("{%s}payment_voucher_date" %nse).text, kfs_hash['US10046263'].pay_date))
 
     def test_vendor_query(self):
         code = update_alma.fetch_vendor_code('YANK')
@@ -49,10 +294,10 @@ class Test_Update_Alma(unittest.TestCase):
            'vendor_id': '8563-0',
            'vendor_name': 'YANKEE BOOK PEDDLER INC'}
         invs = update_alma.process_query(cur, vendors, 0)
-        self.assertEquals(invs['10076'], base , "process query should work even if vendor is not specified")
+        self.assertEquals(invs['10076']._asdict(), base , "process query should work even if vendor is not specified")
         cur = [['43529685','8563-0','YANKEE BOOK PEDDLER INC','10076','C10647617','295.74','20170321','DV'], ['43529685','8563-0','YANKEE BOOK PEDDLER INC','10076','C10647617','295.74','20170321','DV']]
         invs = update_alma.process_query(cur, vendors, 0)
-        self.assertEquals(invs['10076'], base , "process query should handle duplicates")
+        self.assertEquals(invs['10076']._asdict(), base , "process query should handle duplicates")
 
         cur = [['43529685','853-0','YANKEE BOOK PEDDLER INC','10076','C10647617','295.74','20170321','DV'], ['43529685','8563-0','YANKEE BOOK PEDDLER INC','10076','C10647617','295.74','20170321','DV']]
         invs = update_alma.process_query(cur, vendors, 0)
@@ -61,7 +306,7 @@ class Test_Update_Alma(unittest.TestCase):
         vendors = {'10076': '8563-0'}
         cur = [['43529685','853-0','YANKEE BOOK PEDDLER INC','10076','C10647617','295.74','20170321','DV'], ['43529685','8563-0','YANKEE BOOK PEDDLER INC','10076','C10647617','295.74','20170321','DV']]
         invs = update_alma.process_query(cur, vendors, 0)
-        self.assertEquals(invs['10076'], base , "process_query picks out the correct one because of vendor id")
+        self.assertEquals(invs['10076']._asdict(), base , "process_query picks out the correct one because of vendor id")
 
     def test_erp_xml(self):
         erp  = update_alma.ErpXml()
@@ -70,12 +315,14 @@ class Test_Update_Alma(unittest.TestCase):
         alma = {'id' : '4829238050003126',
                 'invoice_date' : '2016-12-05',
                 'vendor' : { 'value' : 'PRQST'}}
-        kfs = {'pay_date' : '20161220',
-               'check_num' : 'V40047088',
-               'pay_amt' : 3810,
-               'doc_num' : '42497084',
-               'vendor_id' : '122172-0',
-               'vendor_name' : 'PROQUEST LP'}
+        kfs = update_alma.KfsRow(pay_date='20161220',
+                                 check_num='V40047088',
+                                 pay_amt=3810,
+                                 doc_num='42497084',
+                                 vendor_id='122172-0',
+                                 vendor_name='PROQUEST LP',
+                                 num=inv_num,
+                                 doc_type='DV')
         erp.add_paid_invoice(inv_num, alma, kfs)
         self.assertEquals(erp.to_string(),'<?xml version="1.0" encoding="UTF-8"?>\n<payment_confirmation_data xmlns="http://com/exlibris/repository/acq/xmlbeans">\n   <invoice_list>\n      <invoice>\n         <invoice_number>US10046263</invoice_number>\n         <unique_identifier>4829238050003126</unique_identifier>\n         <invoice_date>20161205</invoice_date>\n         <vendor_code>PRQST</vendor_code>\n         <payment_status>PAID</payment_status>\n         <payment_voucher_date>20161220</payment_voucher_date>\n         <payment_voucher_number>V40047088</payment_voucher_number>\n         <voucher_amount>\n            <currency>USD</currency>\n            <sum>3810</sum>\n         </voucher_amount>\n      </invoice>\n   </invoice_list>\n</payment_confirmation_data>\n', "Added invoice to ERP XML failed")
 
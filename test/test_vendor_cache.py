@@ -0,0 +1,99 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+from multiprocessing.pool import ThreadPool
+
+sys.path.append("./..")
+import vendor_cache
+
+DAY = vendor_cache.DAY
+
+
+class TestVendorCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "vendor_cache.sqlite")
+        self.pool = ThreadPool(2)
+        self.calls = []
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def lookup(self, code):
+        self.calls.append(code)
+        if code == 'DOWN':
+            raise IOError("Alma is down")
+        if code == 'GONE':
+            return None
+        return {'YANK': '8563-0', 'PRQST': '122172-0'}.get(code, '')
+
+    def test_ttl(self):
+        """Test that entries go stale, unparsable ones sooner"""
+        cache = vendor_cache.VendorCache(self.path, ttl=7 * DAY, negative_ttl=DAY)
+        self.assertIsNone(cache.get('YANK'))
+        cache.put('YANK', '8563-0', now=0)
+        cache.put('BAD', '', now=0)
+        self.assertEquals(cache.get('YANK', now=2 * DAY), ('8563-0', True))
+        self.assertEquals(cache.get('BAD', now=2 * DAY), ('', False))
+        self.assertEquals(cache.get('YANK', now=8 * DAY), ('8563-0', False))
+        cache.close()
+
+    def test_resolve(self):
+        """Test that only missing vendors are fetched and failures raised"""
+        cache = vendor_cache.VendorCache(self.path)
+        codes = ['YANK', 'PRQST', 'BAD']
+        vendors, fetched = cache.resolve(codes, self.lookup, self.pool)
+        self.assertEquals(vendors, {'YANK': '8563-0', 'PRQST': '122172-0',
+                                    'BAD': ''})
+        self.assertEquals(fetched, 3)
+        self.assertRaises(IOError, cache.resolve, ['YANK', 'DOWN'], self.lookup,
+                          self.pool)
+        self.assertIsNone(cache.get('DOWN'), "A failed call should not be cached")
+        self.assertEquals(cache.resolve(['GONE'], self.lookup, self.pool),
+                          ({'GONE': None}, 1))
+        self.assertIsNone(cache.get('GONE'), "A refused lookup should not be cached")
+        cache.close()
+
+        self.calls = []
+        cache = vendor_cache.VendorCache(self.path)
+        vendors, fetched = cache.resolve(codes, self.lookup, self.pool)
+        self.assertEquals((self.calls, fetched), ([], 0))
+        self.assertEquals(vendors['YANK'], '8563-0')
+
+        self.calls = []
+        vendors, fetched = cache.resolve(codes, self.lookup, self.pool, refresh=True)
+        self.assertEquals(sorted(self.calls), sorted(codes))
+        cache.close()
+
+    def test_put_many(self):
+        """Test that a stored snapshot answers resolve without calls"""
+        cache = vendor_cache.VendorCache(self.path)
+        cache.put_many({'YANK': '8563-0', 'BAD': ''})
+        vendors, fetched = cache.resolve(['YANK', 'BAD'], self.lookup, self.pool)
+        self.assertEquals((vendors, fetched), ({'YANK': '8563-0', 'BAD': ''}, 0))
+        self.assertEquals(self.calls, [])
+        cache.close()
+
+    def test_background_refresh(self):
+        """Test that stale vendors are answered from the cache and refetched"""
+        cache = vendor_cache.VendorCache(self.path)
+        cache.put('YANK', 'old-0', now=0)
+        vendors, fetched = cache.resolve(['YANK'], self.lookup, self.pool)
+        self.assertEquals((vendors, fetched), ({'YANK': 'old-0'}, 0))
+        cache.wait()
+        self.assertEquals(cache.get('YANK'), ('8563-0', True))
+
+        cache.put('DOWN', 'old-0', now=0)
+        vendors, fetched = cache.resolve(['DOWN'], self.lookup, self.pool)
+        cache.wait()
+        self.assertEquals(cache.get('DOWN')[0], 'old-0',
+                          "A failed refresh should keep the stale id")
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
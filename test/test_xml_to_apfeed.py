@@ -3,9 +3,13 @@ import datetime
 import logging
 import sys
 import os
+import shutil
+import tempfile
 import unittest
 import xml.etree.ElementTree as ET
 
+from multiprocessing import Pool
+
 sys.path.append("./..")
 import xml_to_apfeed
 from pprint import pprint
@@ -29,6 +33,207 @@ class TestBase(unittest.TestCase):
         self.assertIs(len(invs), 4, "Incorrect number of invoices ingested: {0} Expecting 4".format(len(invs)))
         self.assertEquals(invs[0].find("exl:invoice_number", ns).text, "0201821", "Incorrect invoice number: got({0}), expecting '0201821'".format(invs[0].find("exl:invoice_number", ns).text))
 
+    def test_iter_invoices(self):
+        """Test that streaming ingestion matches whole-file parsing"""
+        nums = [inv.find("exl:invoice_number", ns).text
+                for inv in xml_to_apfeed.iter_invoices(test_xml)]
+        self.assertEquals(nums, [inv.find("exl:invoice_number", ns).text
+                                 for inv in xml_to_apfeed.xml_to_invoices(test_xml)])
+
+        apf = xml_to_apfeed.Apfeed()
+        stream = xml_to_apfeed.Apfeed()
+        stream.now = apf.now
+        for inv in xml_to_apfeed.xml_to_invoices(test_xml):
+            apf.add_inv(inv)
+        for inv in xml_to_apfeed.iter_invoices(test_xml):
+            stream.add_inv(inv)
+        self.assertEquals(str(stream), str(apf), "Streamed apfeed differs from parsed apfeed")
+
+    def test_extract_invoice(self):
+        """Test that the single pass extractor flattens an invoice"""
+        inv = xml_to_apfeed.xml_to_invoices(test_xml)[0]
+        rec = xml_to_apfeed.extract_invoice(inv)
+        self.assertEquals(rec['invoice_number'], '0201821')
+        self.assertEquals(rec['vendor_additional_code'], '0000002413 0002')
+        self.assertEquals(rec['invoice_date'], '11/25/2016')
+        self.assertEquals(rec['vat_amount'], '0.0')
+        self.assertEquals(rec['creation_date'], '20170104')
+        self.assertFalse(rec['has_note_list'])
+        self.assertEquals(len(rec['lines']), len(inv.findall("exl:invoice_line_list/exl:invoice_line", ns)))
+        line = rec['lines'][0]
+        self.assertEquals(line['line_number'], '18')
+        self.assertEquals(line['note'], 'UTAX')
+        self.assertEquals(line['po_line_number'], 'POL-12503')
+        self.assertEquals(line['external_ids'], ['MAINBKS'])
+        self.assertEquals(line['sums'], ['29.5'])
+
+    def test_split_funds(self):
+        """Test that a line split across funds outputs one line per fund, last fund first"""
+        inv = xml_to_apfeed.xml_to_invoices(test_xml)[1]
+        inv_line = inv.find("exl:invoice_line_list/exl:invoice_line", ns)
+        fund_list = inv_line.find("exl:fund_info_list", ns)
+        fund = ET.fromstring(ET.tostring(fund_list.find("exl:fund_info", ns)))
+        fund.find("exl:external_id", ns).text = 'HSBOOKS'
+        fund.find("exl:amount/exl:sum", ns).text = '1.25'
+        fund_list.append(fund)
+
+        apf = xml_to_apfeed.Apfeed()
+        apf.add_inv(inv)
+        self.inv_str(apf.invoices[0], 352, 359, 'HSBOOKS', 'ACCOUNT_NBR of last fund')
+        self.inv_str(apf.invoices[0], 390, 402, '000000000125', 'PMT_AMT of last fund')
+        self.inv_str(apf.invoices[1], 352, 359, 'MAINBKS', 'ACCOUNT_NBR of first fund')
+        self.inv_str(apf.invoices[1], 345, 350, apf.invoices[0][345:350], 'PMT_LINE_NBR shared by funds')
+
+    def test_parallel_extract(self):
+        """Test that records extracted in worker processes give the serial apfeed"""
+        xmls = [os.path.join(xml_dir, f) for f in ("test.xml", "test_utax.xml", "test_carry.xml")]
+        serial = xml_to_apfeed.Apfeed()
+        for xml in xmls:
+            for inv in xml_to_apfeed.iter_invoices(xml):
+                serial.add_inv(inv)
+
+        parallel = xml_to_apfeed.Apfeed()
+        parallel.now = serial.now
+        pool = Pool(processes=2)
+        for records in pool.imap(xml_to_apfeed.extract_file, xmls):
+            for record in records:
+                parallel.add_record(record)
+        pool.close()
+        pool.join()
+        self.assertEquals(str(parallel), str(serial), "Parallel apfeed differs from serial apfeed")
+        self.assertEquals(parallel.org_doc_nbr, serial.org_doc_nbr)
+
+    def test_stream_to_file(self):
+        """Test that a streamed apfeed only appears when closed and matches str()"""
+        out_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(out_dir, "apfeed.LG.test")
+            apf = xml_to_apfeed.Apfeed()
+            stream = xml_to_apfeed.Apfeed(path)
+            apf.now = stream.now
+            for inv in xml_to_apfeed.iter_invoices(test_xml):
+                apf.add_inv(inv)
+                stream.add_inv(inv)
+            self.assertEquals(stream.invoices, [], "Streamed lines should not be kept in memory")
+            self.assertFalse(os.path.exists(path), "Apfeed should not exist before close")
+            stream.close()
+            self.assertEquals(os.listdir(out_dir), ["apfeed.LG.test"])
+            with open(path) as apfeed_file:
+                self.assertEquals(apfeed_file.read(), str(apf))
+
+            discarded = xml_to_apfeed.Apfeed(os.path.join(out_dir, "apfeed.LG.bad"))
+            for inv in xml_to_apfeed.iter_invoices(test_xml):
+                discarded.add_inv(inv)
+            discarded.discard()
+            self.assertEquals(os.listdir(out_dir), ["apfeed.LG.test"], "Discarded apfeed left files behind")
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_convert(self):
+        """Test that convert writes the apfeed and reports and archives the xml"""
+        out_dir = tempfile.mkdtemp()
+        try:
+            staged = os.path.join(out_dir, "test.xml")
+            shutil.copy(test_xml, staged)
+            arch_dir = os.path.join(out_dir, "archive")
+            os.mkdir(arch_dir)
+            path = os.path.join(out_dir, "apfeed.LG.test")
+            result = xml_to_apfeed.convert([staged], path, out_dir, arch_dir, report_time=1)
+            self.assertEquals(result['status'], 'converted')
+            self.assertEquals(result['apfeed'], path)
+            self.assertEquals(sorted(os.listdir(out_dir)), ["apfeed.LG.test", "archive", "external_id.1.csv", "invoice_tax.1.csv"])
+            self.assertEquals(os.listdir(arch_dir), ["test.xml"])
+
+            result = xml_to_apfeed.convert([], path, out_dir, arch_dir)
+            self.assertEquals(result['status'], 'empty')
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_convert_failure(self):
+        """Test that a convert that fails keeps nothing in the ledger or apfeed directory"""
+        out_dir = tempfile.mkdtemp()
+        try:
+            ledger_path = os.path.join(out_dir, "ledger.sqlite")
+            ledger = xml_to_apfeed.Ledger(ledger_path, "apfeed.LG.test")
+            path = os.path.join(out_dir, "apfeed.LG.test")
+            # The report directory cannot be created over a file
+            report_dir = os.path.join(out_dir, "reports")
+            open(report_dir, 'w').close()
+            self.assertRaises(OSError, xml_to_apfeed.convert, [test_xml], path,
+                              report_dir, out_dir, ledger)
+            ledger.close()
+            self.assertEquals(sorted(os.listdir(out_dir)), ["ledger.sqlite", "reports"])
+
+            ledger = xml_to_apfeed.Ledger(ledger_path, "apfeed.LG.test")
+            self.assertIsNone(ledger.add_file(xml_to_apfeed.file_hash(test_xml), "test.xml"),
+                              "File of a failed convert was kept")
+            ledger.close()
+        finally:
+            shutil.rmtree(out_dir)
+
+    @unittest.skipIf(xml_to_apfeed.lxml_etree() is None, "lxml is not installed")
+    def test_lxml_parser(self):
+        """Test that the lxml backend gives the same apfeed as the standard library"""
+        for name in ("test.xml", "test_utax.xml", "test_carry.xml", "test_skip.xml"):
+            xml = os.path.join(xml_dir, name)
+            etree = xml_to_apfeed.Apfeed()
+            lxml = xml_to_apfeed.Apfeed()
+            lxml.now = etree.now
+            for inv in xml_to_apfeed.iter_invoices(xml, 'etree'):
+                etree.add_inv(inv)
+            for inv in xml_to_apfeed.iter_invoices(xml, 'lxml'):
+                lxml.add_inv(inv)
+            self.assertEquals(str(lxml), str(etree), "lxml apfeed differs for %s" % name)
+            self.assertEquals(lxml.invs, etree.invs)
+
+    def test_parser_backend(self):
+        """Test parser choice resolution"""
+        self.assertEquals(xml_to_apfeed.parser_backend('etree'), 'etree')
+        self.assertEquals(xml_to_apfeed.parser_backend('auto'),
+                          'etree' if xml_to_apfeed.lxml_etree() is None else 'lxml')
+        self.assertRaises(ValueError, xml_to_apfeed.parser_backend, 'sax')
+
+    def test_collect_violations(self):
+        """Test that every invoice and line is validated after the first error"""
+        apf = xml_to_apfeed.Apfeed()
+        invs = xml_to_apfeed.xml_to_invoices(os.path.join(xml_dir, "test_utax.xml"))
+        tomorrow = apf.now + datetime.timedelta(days=1)
+        invs[0].find("exl:invoice_date", ns).text = tomorrow.strftime("%m/%d/%Y")
+        apf.org_shp_state_cd = "  "
+        for inv in invs:
+            apf.add_inv(inv)
+        self.assertEquals(apf.invoices, [], "No lines should be formatted once there are errors")
+        self.assertEquals(apf.violations[0]['invoice'], '0201821')
+        self.assertEquals(apf.violations[0]['column'], 'vend_assign_inv_date')
+        self.assertIsNone(apf.violations[0]['line'])
+        state = [v for v in apf.violations if v['column'] == 'org_shp_state_cd']
+        self.assertEquals(len(state), 4,
+                          "Each use tax line, including those of the invoice that failed, should be validated")
+        self.assertEquals(set(v['invoice'] for v in state),
+                          set(['0201821', '0201822', '0201823', '0201824']))
+        self.assertEquals(apf.errors, len(apf.violations))
+
+        report_dir = tempfile.mkdtemp()
+        try:
+            report = os.path.join(report_dir, "validation.csv")
+            apf.write_violations(report)
+            with open(report) as report_file:
+                rows = report_file.read().splitlines()
+            self.assertEquals(rows[0], "Invoice,Line,Column,Position,Error")
+            self.assertTrue(rows[1].startswith("0201821,,VEND_ASSIGN_INV_DATE,62 - 70,"))
+            self.assertEquals(len(rows), apf.errors + 1)
+        finally:
+            shutil.rmtree(report_dir)
+
+    def test_validate_only(self):
+        """Test that validate only mode checks without formatting lines"""
+        apf = xml_to_apfeed.Apfeed(validate_only=True)
+        for inv in xml_to_apfeed.iter_invoices(test_xml):
+            apf.add_inv(inv)
+        self.assertEquals(apf.errors, 0)
+        self.assertEquals(apf.invoices, [])
+        self.assertEquals(apf.count, 0)
+
     def inv_str(self, s, start, end, val, tag):
         self.assertEquals(s[start:end], val, "Char %d-%d got '%s', expecting '%s', tag '%s'" % (start, end, s[start:end], val, tag))
 
@@ -145,9 +350,29 @@ class TestBase(unittest.TestCase):
         self.assertEquals(apf.invoices[7][389:390], 'C', "Just ATAX set in invoice");
 
 
-        self.assertEquals(apf.eids, {'MAINBKS': {'amt': 509.64, 'tax': 18.474449999999997}}, "External ID Total not calculated correctly")
+        self.assertEquals(apf.eids, {'MAINBKS': {'amt': 50964, 'tax': 1847}}, "External ID Total not calculated correctly")
+
+        self.assertEquals(apf.invs, {'0201821': {'tax': 710, 'total': 12741}, '0201822': {'tax': 214, 'total': 12741}, '0201823': {'tax': 214, 'total': 12741}, '0201824': {'tax': 710, 'total': 12741}}, "Use tax calucated per line is incorrect")
+        self.assertEquals([xml_to_apfeed.dollars(c) for c in (1847, 5, -5, 0)],
+                          ['18.47', '0.05', '-0.05', '0.00'])
 
-        self.assertEquals(apf.invs, {'0201821': {'tax': 7.098475, 'total': 127.41}, '0201822': {'tax': 2.13875, 'total': 127.41}, '0201823': {'tax': 2.13875, 'total': 127.41}, '0201824': {'tax': 7.098475, 'total': 127.41}}, "Use tax calucated per line is incorrect")
+    def test_note_without_creation_date(self):
+        """Test that a note without a creation date uses the invoice's"""
+        apf = xml_to_apfeed.Apfeed()
+        invs = xml_to_apfeed.xml_to_invoices(os.path.join(xml_dir, "test_utax.xml"))
+        owner = invs[1].find("exl:noteList/exl:note/exl:owneredEntity", ns)
+        owner.remove(owner.find("exl:creationDate", ns))
+        apf.add_inv(invs[1])
+        self.assertEquals(apf.errors, 0)
+        self.inv_str(apf.invoices[0], 308, 316, '20170104', 'GOODS_RECEIVED_DT')
+        self.assertNotIn('None', apf.invoices[0])
+
+        del invs[2].find("exl:invoice_ownered_entity", ns)[:]
+        owner = invs[2].find("exl:noteList/exl:note/exl:owneredEntity", ns)
+        owner.remove(owner.find("exl:creationDate", ns))
+        apf.add_inv(invs[2])
+        self.assertEquals([v['column'] for v in apf.violations], ['goods_received_dt'],
+                          "A missing date should be reported for a use tax line")
 
     def test_skip_lines(self):
         """Test that we skip empty lines"""
@@ -10,31 +10,131 @@ Queries KFS to determine if those invoices are paid
 """
 
 import argparse
-import ConfigParser
 import csv
-import json
+import itertools
 import logging
 import os
+import Queue
 import re
 import shutil
 import sys
-import traceback
+import threading
 import time
 import xml.dom.minidom
 import xml.etree.ElementTree as ET
 
+from collections import namedtuple
 from datetime import datetime
-from multiprocessing import Pool
-from urllib import quote_plus, quote
+from functools import partial
 
-import cx_Oracle
-import requests
+from alma_client import (PAGE_SIZE, VENDOR_PAGE_SIZE, AlmaRequestError,
+                         default_client)
+from block_archive import BlockArchive, archive_path
+from check_processing import (link_latest_log, load_config, make_dirs,
+                              setup_logging)
+from metrics import Metrics
+from vendor_cache import DAY, VendorCache
 
-# Read config from config.ini
-SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-CONFIG_PATH = os.path.join(SCRIPT_DIR, 'config.ini')
-CONFIG = ConfigParser.ConfigParser()
-CONFIG.readfp(open(CONFIG_PATH))
+KFS_CHUNK_SIZE = 500
+# rows fetched per round trip to KFS
+KFS_ARRAYSIZE = 1000
+KFS_SESSIONS = 4
+PIPELINE_DEPTH = 4
+
+KFS_QUERY = """
+        select * from (
+            select DV.fdoc_nbr AS doc_num
+                , PD.dv_payee_id_nbr               AS vendor_id
+                , PD.dv_payee_prsn_nm              AS vendor_name
+                , NVL(PPD.inv_nbr, 'MISSING INV#') AS vendor_invoice_num
+                , NVL(DV.dv_chk_nbr, ' ')          AS check_num
+                , DV.dv_chk_tot_amt                AS payment_total_amt
+                , to_char(DV.dv_pd_dt, 'YYYYMMDD') AS payment_entered_date
+                , DT.doc_typ_nm                    AS doc_type
+            from finance.fp_dv_doc_t DV
+                join finance.fp_dv_payee_dtl_t PD
+                    on PD.fdoc_nbr = DV.fdoc_nbr
+                join finance.rice_krew_doc_hdr_ext_t DHX
+                    on DHX.doc_hdr_id = DV.fdoc_nbr
+                join finance.rice_krew_doc_hdr_t DH
+                    on DH.doc_hdr_id = DV.fdoc_nbr
+                join finance.rice_krew_doc_typ_t DT
+                    on DT.doc_typ_id = DH.doc_typ_id
+                join finance.pdp_pmt_dtl_t PPD
+                    on ppd.cust_pmt_doc_nbr = DV.fdoc_nbr
+            UNION
+            select CM.fdoc_nbr                         AS doc_num
+                , CM.vndr_cust_nbr                     AS vendor_id
+                , CM.vndr_nm                           AS vendor_name
+                , CM.crdt_memo_nbr                     AS vendor_invoice_num
+                , nvl(CM.pmt_disb_nbr, ' ')            AS check_num
+                , CM.crdt_memo_amt                     AS payment_total_amt
+                , to_char(CM.ap_aprvl_dt, 'YYYYMMDD')  AS payment_entered_date
+                , DT.doc_typ_nm                        AS doc_type
+            from finance.ap_crdt_memo_t CM
+                join finance.rice_krew_doc_hdr_t DH
+                    on DH.doc_hdr_id = CM.fdoc_nbr
+                join finance.rice_krew_doc_typ_t DT
+                    on DT.doc_typ_id = DH.doc_typ_id
+                where cm_feed_cd = 'LG'
+            )
+            where vendor_invoice_num IN (%s)
+            order by doc_num
+    """
+
+# Created once by the DBA, with sql/alma_wanted_invoices.sql
+KFS_TEMP_TABLE = 'ALMA_WANTED_INVOICES'
+KFS_TEMP_SCRIPT = 'sql/alma_wanted_invoices.sql'
+# KFS_QUERY joining the wanted invoice numbers inside each branch, so
+# both are filtered before their other joins
+KFS_JOIN_QUERY = """
+        select * from (
+            select DV.fdoc_nbr AS doc_num
+                , PD.dv_payee_id_nbr               AS vendor_id
+                , PD.dv_payee_prsn_nm              AS vendor_name
+                , PPD.inv_nbr                      AS vendor_invoice_num
+                , NVL(DV.dv_chk_nbr, ' ')          AS check_num
+                , DV.dv_chk_tot_amt                AS payment_total_amt
+                , to_char(DV.dv_pd_dt, 'YYYYMMDD') AS payment_entered_date
+                , DT.doc_typ_nm                    AS doc_type
+            from %(wanted)s W
+                join finance.pdp_pmt_dtl_t PPD
+                    on PPD.inv_nbr = W.inv_nbr
+                join finance.fp_dv_doc_t DV
+                    on DV.fdoc_nbr = PPD.cust_pmt_doc_nbr
+                join finance.fp_dv_payee_dtl_t PD
+                    on PD.fdoc_nbr = DV.fdoc_nbr
+                join finance.rice_krew_doc_hdr_ext_t DHX
+                    on DHX.doc_hdr_id = DV.fdoc_nbr
+                join finance.rice_krew_doc_hdr_t DH
+                    on DH.doc_hdr_id = DV.fdoc_nbr
+                join finance.rice_krew_doc_typ_t DT
+                    on DT.doc_typ_id = DH.doc_typ_id
+            UNION
+            select CM.fdoc_nbr                         AS doc_num
+                , CM.vndr_cust_nbr                     AS vendor_id
+                , CM.vndr_nm                           AS vendor_name
+                , CM.crdt_memo_nbr                     AS vendor_invoice_num
+                , nvl(CM.pmt_disb_nbr, ' ')            AS check_num
+                , CM.crdt_memo_amt                     AS payment_total_amt
+                , to_char(CM.ap_aprvl_dt, 'YYYYMMDD')  AS payment_entered_date
+                , DT.doc_typ_nm                        AS doc_type
+            from %(wanted)s W
+                join finance.ap_crdt_memo_t CM
+                    on CM.crdt_memo_nbr = W.inv_nbr
+                join finance.rice_krew_doc_hdr_t DH
+                    on DH.doc_hdr_id = CM.fdoc_nbr
+                join finance.rice_krew_doc_typ_t DT
+                    on DT.doc_typ_id = DH.doc_typ_id
+                where cm_feed_cd = 'LG'
+            )
+            order by doc_num
+""" % {'wanted': KFS_TEMP_TABLE}
+
+
+# A KFS payment, in the column order of KFS_QUERY
+KfsRow = namedtuple('KfsRow', ['doc_num', 'vendor_id', 'vendor_name', 'num',
+                               'check_num', 'pay_amt', 'pay_date', 'doc_type'])
 
 
 def add_subele_text(parent, tag, text):
@@ -74,9 +174,9 @@ class ErpXml(object):
         Args:
             num (str): invoice number.
             alma (dict): Invoice from Alma.
-            kfs (dict) = Invoice with matching invoice ID from KFS.
+            kfs (KfsRow) = Invoice with matching invoice ID from KFS.
         """
-        logging.debug("kfs:[%s]", ','.join(map(str, kfs.values())))
+        logging.debug("kfs:[%s]", ','.join(map(str, kfs)))
         inv = ET.SubElement(self.inv_list, "invoice")
         add_subele_text(inv, "invoice_number", num)
         add_subele_text(inv, "unique_identifier", alma['id'])
@@ -87,71 +187,183 @@ class ErpXml(object):
         )
         add_subele_text(inv, "vendor_code", alma['vendor']['value'])
         add_subele_text(inv, "payment_status", "PAID")
-        add_subele_text(inv, "payment_voucher_date", kfs['pay_date'])
-        add_subele_text(inv, "payment_voucher_number", kfs['check_num'])
+        add_subele_text(inv, "payment_voucher_date", kfs.pay_date)
+        add_subele_text(inv, "payment_voucher_number", kfs.check_num)
         amt = ET.SubElement(inv, "voucher_amount")
         add_subele_text(amt, 'currency', "USD")
-        add_subele_text(amt, "sum", str(kfs['pay_amt']))
+        add_subele_text(amt, "sum", str(kfs.pay_amt))
         pay_date = ""
-        if kfs['pay_date']:
-            pay_date = datetime.strptime(kfs['pay_date'], "%Y%m%d")
+        if kfs.pay_date:
+            pay_date = datetime.strptime(kfs.pay_date, "%Y%m%d")
             pay_date = pay_date.strftime("%m/%d/%Y")
-        self.invs.append([kfs['doc_num'],
-                          kfs['vendor_id'],
-                          kfs['vendor_name'],
+        self.invs.append([kfs.doc_num,
+                          kfs.vendor_id,
+                          kfs.vendor_name,
                           num,
-                          kfs['check_num'],
-                          "%.2f" % float(kfs['pay_amt']),
+                          kfs.check_num,
+                          "%.2f" % float(kfs.pay_amt),
                           pay_date])
         self.count += 1
 
 
-def fetch_alma_json(offset, query=None):
+def fetch_alma_json(offset, query=None, client=None):
     """
     Queries alma using REST API
 
     Args:
         offset (int): Query offset parameter for accessing paginated results.
         query - string optional used if you want to modify the query
+        client (AlmaClient): Client to call through (default: the shared one).
 
     Returns:
         Two item tuple:
             0) Dict containing invoices (list of dicts)
                 and total number of invoices marked as waiting to be payed.
             1) None. Not sure why.
+
+    Raises:
+        IOError: The page could not be fetched, retries included.
     """
     if query is None:
         query = 'status~ready_to_be_paid'
-    url = 'https://api-na.hosted.exlibrisgroup.com/almaws/v1/acq/invoices/'
-    query_params = {
-        quote_plus('q'): query,
-        quote_plus('limit'): '100',
-        quote_plus('offset'): offset,
-        quote_plus('format'): 'json',
-        quote_plus('apikey'): CONFIG.get("alma", "api_key")
-    }
-    req = requests.get(url, params=query_params)
-    return json.loads(req.text), None
-
-
-def fetch_vendor_code(code):
-    """Uses Alma Web Api to get vendor id"""
-    url = "https://api-na.hosted.exlibrisgroup.com/almaws/v1/acq/vendors/%s" % quote(code)
-    query_params = {
-        quote_plus('format'): 'json',
-        quote_plus('apikey'): CONFIG.get("alma", "api_key")
-    }
+    if client is None:
+        client = default_client()
+    return client.invoices(offset, query), None
+
+
+def parse_vendor_id(vendor):
+    """KFS vendor id in the additional_code of an Alma vendor record,
+    '' if it has none that parses"""
     try:
-        session = requests.Session()
-        req = session.get(url, params=query_params)
-        data = json.loads(req.text)
-        first, second = re.split(r"\D+", data['additional_code'], 2)
-        return code, first.lstrip("0") + '-' + second[0]
-    except:
-        logging.warn("Trying to get json of vendor code: " + code)
-        logging.warn("Error: %s", sys.exc_info()[0])
-        traceback.print_exc()
-        return code, ""
+        first, second = re.split(r"\D+", vendor['additional_code'], 2)
+        return first.lstrip("0") + '-' + second[0]
+    except (KeyError, TypeError, ValueError, IndexError):
+        return ""
+
+
+def lookup_vendor(code, client=None):
+    """KFS vendor id of a vendor code, '' if it does not parse, or None if
+    Alma refused the lookup, e.g. for a vendor that no longer exists.
+
+    Raises:
+        IOError: The Alma call failed, retries included.
+    """
+    if client is None:
+        client = default_client()
+    try:
+        return parse_vendor_id(client.vendor(code))
+    except AlmaRequestError as error:
+        logging.error("Vendor %s could not be looked up: %s", code, error)
+        return None
+
+
+def fetch_vendor_code(code, client=None):
+    """Uses Alma Web Api to get vendor id
+
+    Returns:
+        tuple: (code, vendor id), the id None if Alma refused the lookup.
+
+    Raises:
+        IOError: The Alma call failed, retries included. An empty vendor id
+            would skip the vendor check of the vendor's invoices.
+    """
+    vendor_id = lookup_vendor(code, client)
+    if vendor_id == '':
+        logging.warn("Vendor %s has no KFS vendor id in additional_code", code)
+    return code, vendor_id
+
+
+def fetch_vendor_page(offset, client=None):
+    """KFS vendor ids of a page of the Alma vendor list.
+
+    Returns:
+        tuple: (total vendors in Alma, dict of code -> vendor id).
+    """
+    if client is None:
+        client = default_client()
+    page = client.vendors(offset)
+    vendors = dict((vendor['code'], parse_vendor_id(vendor))
+                   for vendor in page.get('vendor') or [])
+    return int(page['total_record_count']), vendors
+
+
+def prefetch_vendors(vendor_cache, client=None, metrics=None):
+    """Stores the KFS vendor id of every Alma vendor in vendor_cache.
+
+    Pages through the vendor list instead of calling Alma once per vendor,
+    which is far fewer calls when the waiting invoices cover most vendors.
+
+    Args:
+        vendor_cache (VendorCache): Where the snapshot is stored.
+        client (AlmaClient): Client whose threads fetch the pages.
+        metrics (Metrics): Where the vendor_prefetch timing and API call
+            count are added.
+
+    Returns:
+        int: Number of vendors stored.
+    """
+    if metrics is None:
+        metrics = Metrics('update_alma')
+    if client is None:
+        client = default_client()
+    logging.info("Prefetching all Alma vendors")
+    with metrics.stage('vendor_prefetch'):
+        total, vendors = fetch_vendor_page(0, client)
+        offsets = range(VENDOR_PAGE_SIZE, total, VENDOR_PAGE_SIZE)
+        for _, page in client.imap(partial(fetch_vendor_page, client=client),
+                                   offsets):
+            vendors.update(page)
+        vendor_cache.put_many(vendors)
+    metrics.count('api_calls', 1 + len(offsets))
+    metrics.count('vendors_prefetched', len(vendors))
+    logging.info("Prefetched %d vendors in %d calls", len(vendors),
+                 1 + len(offsets))
+    return len(vendors)
+
+
+def clean_invoice(invoice):
+    """Strips an Alma invoice's number, warning if it is not 'NOT_PAID'"""
+    invoice['number'] = invoice['number'].strip()
+    if invoice['payment']['payment_status']['value'] != "NOT_PAID":
+        logging.warn(
+            "Invoice %s payment status is not 'NOT_PAID'",
+            invoice['number']
+        )
+
+
+def resolve_vendors(codes, client, vendor_cache=None, refresh_vendors=False):
+    """KFS vendor ids of vendor codes, from vendor_cache or Alma.
+
+    Returns:
+        tuple: (dict of code -> vendor id or None if Alma refused the
+            lookup, number of codes fetched from Alma).
+    """
+    if vendor_cache is None:
+        results = client.imap(partial(fetch_vendor_code, client=client), codes)
+        return dict(results), len(codes)
+    return vendor_cache.resolve(codes, partial(lookup_vendor, client=client),
+                                client, refresh=refresh_vendors)
+
+
+def skip_failed_vendors(invs, vendors):
+    """Removes the invoices of vendors that could not be looked up.
+
+    Their vendor could not be checked against KFS, so they are left for a
+    later run rather than updated.
+
+    Args:
+        invs (dict): Invoices by number.
+        vendors (dict): Vendor ids by code, None for a failed lookup.
+
+    Returns:
+        list: Numbers of the invoices removed.
+    """
+    skipped = sorted(num for num, invoice in invs.iteritems()
+                     if vendors[invoice['vendor']['value']] is None)
+    for num in skipped:
+        logging.warn("Skipping invoice %s, its vendor %s could not be looked up",
+                     num, invs.pop(num)['vendor']['value'])
+    return skipped
 
 
 def list_to_dict(key_function, values):
@@ -161,7 +373,8 @@ def list_to_dict(key_function, values):
     return dict((key_function(v), v) for v in values)
 
 
-def get_waiting_invoices(query):
+def get_waiting_invoices(query, metrics=None, client=None, vendor_cache=None,
+                         refresh_vendors=False, prefetch=False):
     """ Gets invoices waiting payment in Alma.
 
     Wrapper function for making multiple Alma Api queries.
@@ -169,6 +382,17 @@ def get_waiting_invoices(query):
     Args:
         query (str): Alma query.
         If none, set to 'status~ready_to_be_paid'
+        metrics (Metrics): Where the alma_first_page, alma_pages and
+            vendor_lookups timings and API call counts are added.
+        client (AlmaClient): Client whose threads and pooled session make
+            the calls (default: the shared one).
+        vendor_cache (VendorCache): Where vendor ids are looked up before
+            calling Alma, and stored after.
+        refresh_vendors (bool): Fetch every vendor id again, ignoring the
+            vendor cache.
+        prefetch (bool): Page the whole vendor list into vendor_cache (an
+            in memory one if None) first, so only vendors missing from it
+            are fetched one by one.
 
     Returns:
         Three item tuple:
@@ -176,40 +400,46 @@ def get_waiting_invoices(query):
             1) invoice numbers (list),
             2) invoice vendor ids (list).
     """
-
+    if metrics is None:
+        metrics = Metrics('update_alma')
+    if client is None:
+        client = default_client()
+    if prefetch:
+        if vendor_cache is None:
+            vendor_cache = VendorCache(':memory:')
+        prefetch_vendors(vendor_cache, client, metrics)
+        refresh_vendors = False
     logging.info("Getting Waiting Invoices")
     # Do the initial query to find out how many records are necessary
-    request_json, error = fetch_alma_json(0, query)
+    with metrics.stage('alma_first_page'):
+        request_json, _ = fetch_alma_json(0, query, client)
+    metrics.count('api_calls')
     if request_json is None:
         logging.error("Unable to retrieve records from Alma")
-        return None, None
+        return None, None, None
     trc = int(request_json['total_record_count'])
     invs = request_json['invoice']
 
-    # do in parallel urlopens to Alma if there are more requests needed
-    if trc > 100:
-        offsets = range(100, trc, 100)
-        pool = Pool(processes=20)
-        results = pool.imap_unordered(fetch_alma_json, offsets)
-        pool.close()
-        pool.join()
-        for ret, error in results:
-            if error is None:
-                invs.extend(ret['invoice'])
-            else:
-                logging.error("error fetching: %s", error)
+    # fetch the remaining pages in parallel, using each as it arrives
+    if trc > PAGE_SIZE:
+        offsets = range(PAGE_SIZE, trc, PAGE_SIZE)
+        with metrics.stage('alma_pages'):
+            results = client.imap(
+                partial(fetch_alma_json, query=query, client=client), offsets
+            )
+            for ret, error in results:
+                if error is None:
+                    invs.extend(ret['invoice'])
+                else:
+                    logging.error("error fetching: %s", error)
+        metrics.count('api_calls', len(offsets))
 
     # Generates a list of inventory and vendor ids from api results.
     # warns if current payment status is not 'not paid'
     inv_nums = []
     vendor_codes = []
     for invoice in invs[:]:
-        invoice['number'] = invoice['number'].strip()
-        if invoice['payment']['payment_status']['value'] != "NOT_PAID":
-            logging.warn(
-                "Invoice %s payment status is not 'NOT_PAID'",
-                invoice['number']
-            )
+        clean_invoice(invoice)
         inv_nums.append(invoice['number'])
         if invoice['vendor']['value'] not in vendor_codes:
             vendor_codes.append(invoice['vendor']['value'])
@@ -218,43 +448,33 @@ def get_waiting_invoices(query):
     invs = list_to_dict(lambda a: a['number'], invs)
 
     # Get Vendors and their Vendor Ids
-    vendors = dict()
     inv_vend_ids = dict()
-    pool = Pool(processes=20)
-    results = pool.imap_unordered(fetch_vendor_code, vendor_codes)
-    pool.close()
-    pool.join()
-    for code, vend_id in results:
-        if error is None:
-            vendors[code] = vend_id
-        else:
-            logging.error("error fetching: %s", error)
+    with metrics.stage('vendor_lookups'):
+        vendors, fetched = resolve_vendors(vendor_codes, client, vendor_cache,
+                                           refresh_vendors)
+    metrics.count('api_calls', fetched)
+    metrics.count('vendor_cache_hits', len(vendor_codes) - fetched)
+    metrics.count('alma_invoices', len(inv_nums))
+    metrics.count('vendors', len(vendor_codes))
+    metrics.count('vendor_errors',
+                  sum(1 for vendor_id in vendors.itervalues() if vendor_id is None))
+    metrics.count('skipped_invoices', len(skip_failed_vendors(invs, vendors)))
+    inv_nums = [num for num in inv_nums if num in invs]
     for num in inv_nums:
         inv_vend_ids[num] = vendors[invs[num]['vendor']['value']]
     return invs, inv_nums, inv_vend_ids
 
 
-def kfs_query(ids):
-    """Queries Accounting KFS Database to see if the invoices are paid
-
-    Args:
-        ids (list): Invoice numbers.
-
-    Returns:
-        cursor, if query is successful.
-        an empty dict, if not.
-    """
-    kfs_invs = dict()
-    logging.info("Running KFS Query")
-    # If given empty set of ids
-    if ids is None:
-        return kfs_invs
+def kfs_connect():
+    """Connects to the Accounting KFS Database, exiting if it cannot"""
+    import cx_Oracle
 
+    oracle = load_config().oracle
     try:
-        con = cx_Oracle.connect(CONFIG.get("oracle", "username"),
-                                CONFIG.get("oracle", "password"),
+        con = cx_Oracle.connect(oracle.username,
+                                oracle.password,
                                 cx_Oracle.makedsn(
-                                    CONFIG.get("oracle", "server"),
+                                    oracle.server,
                                     1521,
                                     'dsprod'
         )
@@ -262,100 +482,251 @@ def kfs_query(ids):
     except cx_Oracle.DatabaseError:
         logging.error(
             'Failed to connect to %s\n',
-            CONFIG.get("oracle", "server")
+            oracle.server
         )
         exit(1)
+    return con
+
+
+def bind_chunks(ids, size=KFS_CHUNK_SIZE):
+    """Lists of size ids to bind to KFS_QUERY, the last padded with None
+    (NULL never matches) so every chunk uses the same statement"""
+    for start in range(0, len(ids), size):
+        chunk = list(ids[start:start + size])
+        yield chunk + [None] * (size - len(chunk))
+
+
+def kfs_statement(size=KFS_CHUNK_SIZE):
+    """KFS_QUERY with size positional bind variables"""
+    return KFS_QUERY % ','.join(':%d' % (i + 1) for i in range(size))
+
+
+def prepare_cursor(cur):
+    """Sets a cursor to fetch KFS_ARRAYSIZE rows per round trip, from the
+    first execute on"""
+    cur.arraysize = KFS_ARRAYSIZE
+    # cx_Oracle 8 also fetches the first rows with the execute
+    if hasattr(cur, 'prefetchrows'):
+        cur.prefetchrows = KFS_ARRAYSIZE + 1
+
+
+def fetch_rows(cur):
+    """Yields the KfsRows of an executed KFS_QUERY cursor, fetched in
+    batches of its arraysize"""
+    # set after execute, which resets it
+    cur.rowfactory = KfsRow
+    while True:
+        rows = cur.fetchmany()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def query_chunk(con, chunk, metrics=None):
+    """KFS rows of a chunk of invoice numbers from bind_chunks, the time
+    taken added to the kfs_query stage of metrics"""
+    if metrics is None:
+        metrics = Metrics('update_alma')
     cur = con.cursor()
-    q_str = ','.join("'" + item + "'" for item in ids)
-    query = """
-        select * from (
-            select DV.fdoc_nbr AS doc_num
-                , PD.dv_payee_id_nbr               AS vendor_id
-                , PD.dv_payee_prsn_nm              AS vendor_name
-                , NVL(PPD.inv_nbr, 'MISSING INV#') AS vendor_invoice_num
-                , NVL(DV.dv_chk_nbr, ' ')          AS check_num
-                , DV.dv_chk_tot_amt                AS payment_total_amt
-                , to_char(DV.dv_pd_dt, 'YYYYMMDD') AS payment_entered_date
-                , DT.doc_typ_nm                    AS doc_type
-            from finance.fp_dv_doc_t DV
-                join finance.fp_dv_payee_dtl_t PD
-                    on PD.fdoc_nbr = DV.fdoc_nbr
-                join finance.rice_krew_doc_hdr_ext_t DHX
-                    on DHX.doc_hdr_id = DV.fdoc_nbr
-                join finance.rice_krew_doc_hdr_t DH
-                    on DH.doc_hdr_id = DV.fdoc_nbr
-                join finance.rice_krew_doc_typ_t DT
-                    on DT.doc_typ_id = DH.doc_typ_id
-                join finance.pdp_pmt_dtl_t PPD
-                    on ppd.cust_pmt_doc_nbr = DV.fdoc_nbr
-            UNION
-            select CM.fdoc_nbr                         AS doc_num
-                , CM.vndr_cust_nbr                     AS vendor_id
-                , CM.vndr_nm                           AS vendor_name
-                , CM.crdt_memo_nbr                     AS vendor_invoice_num
-                , nvl(CM.pmt_disb_nbr, ' ')            AS check_num
-                , CM.crdt_memo_amt                     AS payment_total_amt
-                , to_char(CM.ap_aprvl_dt, 'YYYYMMDD')  AS payment_entered_date
-                , DT.doc_typ_nm                        AS doc_type
-            from finance.ap_crdt_memo_t CM
-                join finance.rice_krew_doc_hdr_t DH
-                    on DH.doc_hdr_id = CM.fdoc_nbr
-                join finance.rice_krew_doc_typ_t DT
-                    on DT.doc_typ_id = DH.doc_typ_id
-                where cm_feed_cd = 'LG'
-            )
-            where vendor_invoice_num IN (%s)
-            order by doc_num
-    """ % (q_str)
-    logging.debug("Querying invoices: %s", q_str)
+    try:
+        with metrics.stage('kfs_query'):
+            prepare_cursor(cur)
+            cur.execute(kfs_statement(len(chunk)), chunk)
+            return list(fetch_rows(cur))
+    finally:
+        cur.close()
 
-    if cur.execute(query):
-        return cur
-    else:
-        logging.error("KFS Query Failed")
-    con.close()
 
-    return kfs_invs
+def query_pooled_chunk(pool, chunk, metrics=None):
+    """query_chunk on a session of pool, released when done"""
+    con = pool.acquire()
+    try:
+        return query_chunk(con, chunk, metrics)
+    finally:
+        pool.release(con)
+
+
+def kfs_session_pool(sessions=KFS_SESSIONS):
+    """Pool of up to sessions KFS Database sessions, exiting if it cannot
+    connect"""
+    import cx_Oracle
+
+    oracle = load_config().oracle
+    try:
+        return cx_Oracle.SessionPool(
+            oracle.username, oracle.password,
+            cx_Oracle.makedsn(oracle.server, 1521, 'dsprod'),
+            min=1, max=sessions, increment=1, threaded=True
+        )
+    except cx_Oracle.DatabaseError:
+        logging.error(
+            'Failed to connect to %s\n',
+            oracle.server
+        )
+        exit(1)
+
+
+def stream_chunks(pool, chunks, sessions, close_pool, metrics=None):
+    """Yields the KFS rows of chunks queried concurrently on pool, each
+    chunk's rows as soon as it is done"""
+    from multiprocessing.pool import ThreadPool
+
+    workers = ThreadPool(max(1, min(sessions, len(chunks))))
+    try:
+        for rows in workers.imap_unordered(
+                partial(query_pooled_chunk, pool, metrics=metrics), chunks):
+            for row in rows:
+                yield row
+    finally:
+        workers.close()
+        workers.join()
+        if close_pool:
+            pool.close()
+
+
+def kfs_query(ids, con=None, pool=None, sessions=KFS_SESSIONS,
+              chunk_size=KFS_CHUNK_SIZE, metrics=None):
+    """Queries Accounting KFS Database to see if the invoices are paid
+
+    The invoice numbers are bound in chunks of chunk_size, under Oracle's
+    limit of 1000 items in an IN list, so the statement text is the same
+    for every chunk and run and is parsed once. Without con the chunks run
+    concurrently on a session pool.
+
+    Args:
+        ids (list): Invoice numbers.
+        con: Connection to query the chunks on one after the other.
+        pool: cx_Oracle SessionPool to query on (default: a new one of
+            sessions sessions, closed when the rows are read).
+        sessions (int): Chunks queried at once.
+        chunk_size (int): Invoice numbers per query.
+        metrics (Metrics): Where the kfs_query timing of each chunk is
+            added, as it runs, so with several sessions the times overlap.
+
+    Returns:
+        iterator: KFS rows of all the chunks, as process_query reads them.
+    """
+    logging.info("Running KFS Query")
+    # If given empty set of ids
+    if not ids:
+        return iter([])
+    logging.debug("Querying invoices: %s", ','.join(ids))
+    chunks = list(bind_chunks(ids, chunk_size))
+    if con is not None:
+        return itertools.chain.from_iterable(query_chunk(con, chunk, metrics)
+                                             for chunk in chunks)
+    close_pool = pool is None
+    if close_pool:
+        pool = kfs_session_pool(min(sessions, len(chunks)))
+    return stream_chunks(pool, chunks, sessions, close_pool, metrics)
+
+
+def check_temp_table(cur):
+    """Checks that the temporary table of wanted invoice numbers exists.
+
+    It is not created here: the KFS account update_alma.py runs as should
+    not need DDL rights.
+
+    Raises:
+        IOError: The table does not exist.
+    """
+    cur.execute("select count(*) from user_tables where table_name = :1",
+                [KFS_TEMP_TABLE])
+    if cur.fetchone()[0] == 0:
+        raise IOError("KFS table %s does not exist, it must be created once"
+                      " with %s before using --kfs-temp-table"
+                      % (KFS_TEMP_TABLE, KFS_TEMP_SCRIPT))
+
+
+def kfs_join_query(ids, con=None, metrics=None):
+    """Queries Accounting KFS Database for the invoices through a temporary
+    table, for very large runs.
+
+    The invoice numbers are loaded into a global temporary table with one
+    array insert and joined inside each branch of the query, so the work
+    grows with the number of invoices rather than the finance tables. The
+    rows are only visible to this session and are deleted when it ends
+    the transaction, after the rows are read.
+
+    Args:
+        ids (list): Invoice numbers.
+        con: Connection to query on (default: a new one, closed when the
+            rows are read).
+        metrics (Metrics): Where the kfs_query timing of the insert and
+            query is added. The rows are fetched as they are read.
+
+    Yields:
+        KFS rows, as process_query reads them.
+
+    Raises:
+        IOError: The temporary table has not been created.
+    """
+    logging.info("Running KFS Query through %s", KFS_TEMP_TABLE)
+    if not ids:
+        return
+    if metrics is None:
+        metrics = Metrics('update_alma')
+    close_con = con is None
+    if close_con:
+        con = kfs_connect()
+    cur = con.cursor()
+    try:
+        with metrics.stage('kfs_query'):
+            check_temp_table(cur)
+            cur.executemany("insert into %s values (:1)" % KFS_TEMP_TABLE,
+                            [(num,) for num in sorted(set(ids))])
+            prepare_cursor(cur)
+            cur.execute(KFS_JOIN_QUERY)
+        for row in fetch_rows(cur):
+            yield row
+    finally:
+        # ends the transaction, emptying the temporary table
+        con.rollback()
+        cur.close()
+        if close_con:
+            con.close()
 
 
-def process_query(cur, vendors, interactive):
+def process_query(cur, vendors, interactive, metrics=None):
     """
     Takes connection cursor and generates dictionary of query
     Handles records with matching invoice ids.
     Drops invoice record if vendor_id does not match whats in Alma record.
 
     Args:
-        cur: Cursor to KFS db (output of query_kfs function).
+        cur: Rows from KFS db (output of kfs_query function), KfsRows or
+            sequences in the same order.
             Aka records of invoice payment statuses.
         vendors (dict): key=invoice number, value=Vendor id.
         interactive (bool): Determines how to deal with rows with matching invoice ids
             If True, lets user decide which row to keep through input.
             If False, drops respective rows and logs action.
+        metrics (Metrics): Where the kfs_rows cursor iteration timing and
+            row count are added.
 
     Returns:
-        Matching invoice records from KFS db. dict[invoice_num]: {record}
+        Matching invoice records from KFS db. dict[invoice_num]: KfsRow
     """
+    if metrics is None:
+        metrics = Metrics('update_alma')
     kfs_invs = dict()
     out = dict()
-    for res in cur:
-        keys = ['doc_num', 'vendor_id', 'vendor_name', 'num',
-                'check_num', 'pay_amt', 'pay_date', 'doc_type']
-        kfs_d = dict(zip(keys, res))
-        num = kfs_d['num']
-        if vendors and num in vendors and vendors[num] != kfs_d['vendor_id'] and vendors[num]:
+    for res in metrics.iterate('kfs_rows', cur):
+        metrics.count('kfs_rows')
+        row = res if isinstance(res, KfsRow) else KfsRow._make(res)
+        num = row.num
+        if vendors and num in vendors and vendors[num] != row.vendor_id and vendors[num]:
             logging.debug("Invoice(%s) didn't have right vendor_id skipped"
-                          " Expected %s got: %s", num, vendors[num], kfs_d['vendor_id'])
+                          " Expected %s got: %s", num, vendors[num], row.vendor_id)
             continue
         if num in kfs_invs:
             logging.info("Multiple invoice numbers detected: ")
-            # check if the duplicate is the exact same
-            dup = False
-            for kin in kfs_invs[num]:
-                dup = dup or equal_dicts(kin, kfs_d, ['doc_num'])
-            if not dup:
-                kfs_invs[num].append(kfs_d)
+            # check if the duplicate is the exact same, doc_num aside
+            if not any(kin[1:] == row[1:] for kin in kfs_invs[num]):
+                kfs_invs[num].append(row)
         else:
-            kfs_invs[num] = [kfs_d]
+            kfs_invs[num] = [row]
 
     for key, kinv in kfs_invs.iteritems():
         if len(kinv) == 1:
@@ -365,7 +736,7 @@ def process_query(cur, vendors, interactive):
             logging.info("[0] None of the above")
             count = 1
             for opts in kinv:
-                logging.info("[%d] %s", count, "|".join(str(v) for v in opts.values()))
+                logging.info("[%d] %s", count, "|".join(str(v) for v in opts))
                 count += 1
             choice = 0
             while True:
@@ -386,20 +757,252 @@ def process_query(cur, vendors, interactive):
     return out
 
 
-def equal_dicts(dic1, dic2, ignore_keys):
-    """Runs equality check on two diciontaries ignoring specific keys.
+def add_paid_invoices(erp, invoices, kfs_hash, tolerance):
+    """Adds the KFS payments of Alma invoices to erp.
+
+    Args:
+        erp (ErpXml): Where the paid invoices are added.
+        invoices (dict): Alma invoices by invoice number.
+        kfs_hash (dict): KfsRows by invoice number (output of process_query).
+        tolerance: Percentage the paid amount may differ from Alma's
+            before it is logged as an error.
+    """
+    for inv_num, kfs_inv in sorted(kfs_hash.iteritems()):
+        if inv_num not in invoices:
+            logging.warn("%s not found in Alma but is in KFS: Skipping", inv_num)
+            continue
+        diff = abs(kfs_inv.pay_amt - invoices[inv_num]['total_amount'])
+        allowed = float(invoices[inv_num]['total_amount']) * float(tolerance) / 100
+        if diff > allowed:
+            logging.error(
+                "Invoice(%s) payment record doesn't match Alma"
+                " Outside tolerance of %s"
+                " (%s != %s)",
+                inv_num,
+                tolerance,
+                kfs_inv.pay_amt,
+                invoices[inv_num]['total_amount']
+            )
+        erp.add_paid_invoice(inv_num, invoices[inv_num], kfs_inv)
+
+
+_DONE = object()
+
+
+def run_stage(items, depth=PIPELINE_DEPTH):
+    """Iterates items on a thread of its own, at most depth items ahead.
+
+    Chained, each stage of a pipeline works on its next item while the
+    later stages work on the previous ones. An exception raised by items
+    is raised again in the caller.
+    """
+    queue = Queue.Queue(depth)
+
+    def run():
+        try:
+            for item in items:
+                queue.put((item, None))
+        except Exception:  # pylint: disable=broad-except
+            queue.put((_DONE, sys.exc_info()))
+            return
+        queue.put((_DONE, None))
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    while True:
+        item, exc_info = queue.get()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if item is _DONE:
+            return
+        yield item
+
+
+def waiting_invoice_pages(query, client, metrics):
+    """Yields the pages of invoices waiting payment in Alma, the first page
+    first and then the others as they arrive"""
+    first, _ = fetch_alma_json(0, query, client)
+    metrics.count('api_calls')
+    yield first['invoice']
+    offsets = range(PAGE_SIZE, int(first['total_record_count']), PAGE_SIZE)
+    pages = client.imap(partial(fetch_alma_json, query=query, client=client),
+                        offsets)
+    for page, _ in pages:
+        metrics.count('api_calls')
+        yield page['invoice']
+
+
+def resolve_page_vendors(pages, client, metrics, vendor_cache=None,
+                         refresh_vendors=False):
+    """Yields the invoices of each page with their KFS vendor ids, looking
+    up only the vendors not on earlier pages.
+
+    Yields:
+        tuple: (invoices by number, vendor ids by invoice number).
+    """
+    vendors = dict()
+    seen = set()
+    for page in pages:
+        invs = dict()
+        codes = []
+        for invoice in page:
+            clean_invoice(invoice)
+            if invoice['number'] in seen:
+                logging.warn("Invoice %s is waiting twice in Alma: Skipping"
+                             " the second", invoice['number'])
+                continue
+            seen.add(invoice['number'])
+            invs[invoice['number']] = invoice
+            code = invoice['vendor']['value']
+            if code not in vendors and code not in codes:
+                codes.append(code)
+        found, fetched = resolve_vendors(codes, client, vendor_cache,
+                                         refresh_vendors)
+        vendors.update(found)
+        metrics.count('api_calls', fetched)
+        metrics.count('vendor_cache_hits', len(codes) - fetched)
+        metrics.count('alma_invoices', len(invs))
+        metrics.count('vendors', len(codes))
+        metrics.count('vendor_errors',
+                      sum(1 for vendor_id in found.itervalues() if vendor_id is None))
+        metrics.count('skipped_invoices', len(skip_failed_vendors(invs, vendors)))
+        yield invs, dict((num, vendors[inv['vendor']['value']])
+                         for num, inv in invs.iteritems())
+
+
+def chunk_invoices(pages, size=KFS_CHUNK_SIZE):
+    """Regroups (invoices, vendor ids) pages into chunks of size invoices"""
+    invs = dict()
+    vend_ids = dict()
+    for page_invs, page_vend_ids in pages:
+        for num, invoice in page_invs.iteritems():
+            invs[num] = invoice
+            vend_ids[num] = page_vend_ids[num]
+            if len(invs) == size:
+                yield invs, vend_ids
+                invs = dict()
+                vend_ids = dict()
+    if invs:
+        yield invs, vend_ids
+
+
+def query_invoice_chunk(con, invs, chunk_size=KFS_CHUNK_SIZE,
+                        temp_table=False, metrics=None):
+    """KFS rows of a chunk of invoices, queried on con"""
+    if temp_table:
+        return list(kfs_join_query(sorted(invs), con, metrics))
+    return list(kfs_query(sorted(invs), con, chunk_size=chunk_size,
+                          metrics=metrics))
+
+
+def query_kfs_chunks(chunks, metrics, chunk_size=KFS_CHUNK_SIZE, sessions=1,
+                     pool=None, connect=kfs_connect, temp_table=False):
+    """Yields each chunk with its KFS rows, in chunk order.
+
+    With one session the chunks are queried one after the other on one
+    connection, otherwise up to sessions at once on sessions of pool.
 
     Args:
-        dic1 (dict): Dictionary to compare to dic2
-        dic2 (dict): Dictionary to compare to dic1
-        ignore_keys (list): List of keys to remove from dics before comparing
+        chunk_size (int): Invoice numbers bound per KFS query.
+        sessions (int): Chunks queried at once.
+        pool: cx_Oracle SessionPool to query on when sessions is above one
+            (default: a new one, closed when done).
+        connect (callable): Returns the connection used with one session.
+        temp_table (bool): Query through kfs_join_query.
 
-    Returns:
-        boolean.
+    Yields:
+        tuple: (invoices, vendor ids, list of KFS rows).
+    """
+    if sessions <= 1:
+        con = connect()
+        try:
+            for invs, vend_ids in chunks:
+                rows = query_invoice_chunk(con, invs, chunk_size, temp_table,
+                                           metrics)
+                metrics.count('kfs_queries')
+                yield invs, vend_ids, rows
+        finally:
+            con.close()
+        return
+
+    close_pool = pool is None
+    if close_pool:
+        pool = kfs_session_pool(sessions)
+
+    def query_pooled(chunk):
+        """The chunk with its rows, queried on a session of pool"""
+        invs, vend_ids = chunk
+        con = pool.acquire()
+        try:
+            return invs, vend_ids, query_invoice_chunk(con, invs, chunk_size,
+                                                       temp_table, metrics)
+        finally:
+            pool.release(con)
+
+    from multiprocessing.pool import ThreadPool
+
+    workers = ThreadPool(sessions)
+    try:
+        for result in workers.imap(query_pooled, chunks):
+            metrics.count('kfs_queries')
+            yield result
+    finally:
+        workers.close()
+        workers.join()
+        if close_pool:
+            pool.close()
+
+
+def run_pipeline(query, erp, tolerance, interactive, metrics=None, client=None,
+                 vendor_cache=None, refresh_vendors=False, prefetch=False,
+                 chunk_size=KFS_CHUNK_SIZE, sessions=1, pool=None,
+                 connect=kfs_connect, temp_table=False):
+    """Adds the paid waiting invoices to erp, overlapping the stages.
+
+    Each Alma page goes through its vendor lookups, then into chunks of
+    invoice numbers queried in KFS, while later pages still download.
+    Each chunk's rows are matched as they come back, so a run takes
+    about as long as its slowest stage instead of the sum of them all.
+    Bounded queues keep each stage at most a few items ahead.
+
+    Args:
+        query (str): Alma query (default: 'status~ready_to_be_paid').
+        erp (ErpXml): Where the paid invoices are added.
+        tolerance: As for add_paid_invoices.
+        interactive (bool): As for process_query.
+        metrics (Metrics): Where the pipeline_wait timing (the time spent
+            waiting on KFS results) and counts are added.
+        client (AlmaClient): Client making the Alma calls.
+        vendor_cache (VendorCache): As for get_waiting_invoices.
+        refresh_vendors (bool): As for get_waiting_invoices.
+        prefetch (bool): As for get_waiting_invoices.
+        chunk_size (int): Invoice numbers per KFS query.
+        sessions (int): Chunks queried in KFS at once.
+        pool: As for query_kfs_chunks.
+        connect (callable): Returns the KFS connection used with one session.
+        temp_table (bool): Query each chunk through a temporary table.
     """
-    d1_filtered = dict((k, v) for k, v in dic1.iteritems() if k not in ignore_keys)
-    d2_filtered = dict((k, v) for k, v in dic2.iteritems() if k not in ignore_keys)
-    return d1_filtered == d2_filtered
+    if metrics is None:
+        metrics = Metrics('update_alma')
+    if client is None:
+        client = default_client()
+    if prefetch:
+        if vendor_cache is None:
+            vendor_cache = VendorCache(':memory:')
+        prefetch_vendors(vendor_cache, client, metrics)
+        refresh_vendors = False
+    logging.info("Getting Waiting Invoices and querying KFS in chunks of %d",
+                 chunk_size)
+    pages = run_stage(waiting_invoice_pages(query, client, metrics))
+    resolved = run_stage(resolve_page_vendors(pages, client, metrics,
+                                              vendor_cache, refresh_vendors))
+    results = run_stage(query_kfs_chunks(chunk_invoices(resolved, chunk_size),
+                                         metrics, chunk_size, sessions, pool,
+                                         connect, temp_table))
+    for invs, vend_ids, rows in metrics.iterate('pipeline_wait', results):
+        kfs_hash = process_query(rows, vend_ids, interactive, metrics)
+        add_paid_invoices(erp, invs, kfs_hash, tolerance)
 
 
 # pylint: disable=C0103
@@ -449,6 +1052,13 @@ if __name__ == '__main__':
         default=os.path.join(cwd, "archive"),
         help='archive directory (default: <cwd>/archive)'
     )
+    parser.add_argument(
+        '--compress-archive',
+        action='store_true',
+        help='Archive the output xml compressed into'
+        ' <archive-dir>/alma_input.gz instead of copying it to'
+        ' <archive-dir>/alma_input'
+    )
     parser.add_argument(
         '-t', '--tolerance',
         default=1,
@@ -469,90 +1079,144 @@ if __name__ == '__main__':
         action='store_true',
         default=False
     )
+    parser.add_argument(
+        '--vendor-cache',
+        help='vendor code to KFS vendor id cache'
+        ' (default: <archive-dir>/vendor_cache.sqlite)'
+    )
+    parser.add_argument(
+        '--vendor-ttl',
+        type=float,
+        default=7,
+        help='days a cached vendor id is used before it is refreshed in'
+        ' the background (default: 7)'
+    )
+    parser.add_argument(
+        '--refresh-vendors',
+        action='store_true',
+        help='fetch every vendor id from Alma again, ignoring the cache'
+    )
+    parser.add_argument(
+        '--prefetch-vendors',
+        action='store_true',
+        help='page the whole Alma vendor list into the vendor cache first,'
+        ' instead of one call per vendor (e.g. at fiscal year end)'
+    )
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='query KFS for each chunk of invoices while later Alma pages'
+        ' and vendors are still being fetched'
+    )
+    parser.add_argument(
+        '--kfs-chunk-size',
+        type=int,
+        default=KFS_CHUNK_SIZE,
+        help='invoice numbers per KFS query, at most 1000'
+        ' (default: %d)' % KFS_CHUNK_SIZE
+    )
+    parser.add_argument(
+        '--kfs-sessions',
+        type=int,
+        default=KFS_SESSIONS,
+        help='KFS queries run at once, each on a session of a pool'
+        ' (default: %d)' % KFS_SESSIONS
+    )
+    parser.add_argument(
+        '--kfs-temp-table',
+        action='store_true',
+        help='load the invoice numbers into a temporary table joined inside'
+        ' the KFS query, instead of IN lists (for very large runs)'
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Write per stage timings (vendor_prefetch, alma_first_page,'
+        ' alma_pages, vendor_lookups, kfs_query, kfs_rows, pipeline_wait,'
+        ' xml, report),'
+        ' counts and peak memory of the run as JSON'
+    )
     args = parser.parse_args()
+    if not 0 < args.kfs_chunk_size <= 1000:
+        parser.error('--kfs-chunk-size must be between 1 and 1000')
 
-    tolerance = float(args.tolerance) / 100
+    metrics = Metrics('update_alma')
+    if args.metrics_file is not None:
+        metrics.write_at_exit(args.metrics_file)
 
     # Create and setup logging
     latest_log = os.path.join(args.log_dir, "update_alma.latest.log")
-    if not os.path.isdir(args.log_dir):
-        os.mkdir(args.log_dir)
-    log_file_path = os.path.join(args.log_dir, args.log_file)
-
-    numeric_level = getattr(logging, args.log_level.upper(), None)
-    if not isinstance(numeric_level, int):
-        raise ValueError('Invalid log level: %s' % args.log_level)
-    logging.basicConfig(
-        filename=log_file_path,
-        level=numeric_level,
-        format="[%(levelname)-5.5s] %(message)s"
-    )
-    logger = logging.getLogger()
-    consoleHandler = logging.StreamHandler()
-    stream_format = logging.Formatter("[%(levelname)-5.5s] %(message)s")
-    consoleHandler.setFormatter(stream_format)
-    logger.addHandler(consoleHandler)
-    logger.setLevel(numeric_level)
+    log_file_path = setup_logging(args.log_dir, args.log_file, args.log_level)
 
     # Setup archive
-    if not os.path.isdir(args.archive_dir):
-        os.mkdir(args.archive_dir)
     input_archive = os.path.join(args.archive_dir, "alma_input")
-    if not os.path.isdir(input_archive):
-        os.mkdir(input_archive)
+    make_dirs(args.archive_dir, input_archive)
 
-    # Get Alma invoices
-    invoices, nums, inv_vendids = get_waiting_invoices(args.query)
+    vendor_cache = VendorCache(
+        args.vendor_cache or os.path.join(args.archive_dir, "vendor_cache.sqlite"),
+        ttl=args.vendor_ttl * DAY
+    )
 
-    # Query KFS Oracle DB
-    cursor = kfs_query(nums)
-    kfs_hash = process_query(cursor, inv_vendids, args.interactive)
-    for inv_num, kfs_inv in sorted(kfs_hash.iteritems()):
-        if inv_num not in invoices:
-            logging.warn("%s not found in Alma but is in KFS: Skipping", inv_num)
-            continue
-        diff = abs(kfs_inv['pay_amt'] - invoices[inv_num]['total_amount'])
-        if diff > float(invoices[inv_num]['total_amount']) * tolerance:
-            logging.error(
-                "Invoice(%s) payment record doesn't match Alma"
-                " Outside tolerance of %d"
-                " (%s != %s)",
-                inv_num,
-                args.tolerance,
-                kfs_inv['pay_amt'],
-                invoices[inv_num]['total_amount']
-            )
-        erp.add_paid_invoice(inv_num, invoices[inv_num], kfs_inv)
+    if args.pipeline:
+        run_pipeline(args.query, erp, args.tolerance, args.interactive,
+                     metrics, vendor_cache=vendor_cache,
+                     refresh_vendors=args.refresh_vendors,
+                     prefetch=args.prefetch_vendors,
+                     chunk_size=args.kfs_chunk_size,
+                     sessions=args.kfs_sessions,
+                     temp_table=args.kfs_temp_table)
+    else:
+        # Get Alma invoices
+        invoices, nums, inv_vendids = get_waiting_invoices(
+            args.query, metrics, vendor_cache=vendor_cache,
+            refresh_vendors=args.refresh_vendors, prefetch=args.prefetch_vendors
+        )
+
+        # Query KFS Oracle DB
+        # Lazy, the queries run as process_query reads the rows
+        if args.kfs_temp_table:
+            cursor = kfs_join_query(nums, metrics=metrics)
+        else:
+            cursor = kfs_query(nums, sessions=args.kfs_sessions,
+                               chunk_size=args.kfs_chunk_size, metrics=metrics)
+        kfs_hash = process_query(cursor, inv_vendids, args.interactive, metrics)
+        add_paid_invoices(erp, invoices, kfs_hash, args.tolerance)
+    metrics.count('paid_invoices', erp.count)
 
     if erp.count > 0:
         output_file_path = os.path.join(args.output_dir, args.output_file)
-        with open(output_file_path, 'w') as xml_file:
-            xml_file.write(erp.to_string())
-        shutil.copy(output_file_path, input_archive)
+        with metrics.stage('xml'):
+            with open(output_file_path, 'w') as xml_file:
+                xml_file.write(erp.to_string())
+        if args.compress_archive:
+            BlockArchive(archive_path(input_archive)).add(output_file_path)
+        else:
+            shutil.copy(output_file_path, input_archive)
         logging.info("Output XML created: %s", output_file_path)
         # Generate report
-        if not os.path.isdir(args.report_dir):
-            os.mkdir(args.report_dir)
+        make_dirs(args.report_dir)
         report_file = os.path.join(args.report_dir, args.report_file)
         logging.info("Creating Check Information File: %s", report_file)
-        with open(report_file, 'wb') as report_file:
-            w = csv.writer(report_file)
-            w.writerow(('Doc #',
-                        'Vender #',
-                        'Vender Name',
-                        'Invoice #',
-                        'Check #',
-                        'Amount',
-                        'Date'))
-            for r in erp.invs:
-                w.writerow(r)
+        with metrics.stage('report'):
+            with open(report_file, 'wb') as report_file:
+                w = csv.writer(report_file)
+                w.writerow(('Doc #',
+                            'Vender #',
+                            'Vender Name',
+                            'Invoice #',
+                            'Check #',
+                            'Amount',
+                            'Date'))
+                for r in erp.invs:
+                    w.writerow(r)
 
     else:
         logging.info("Nothing to update from ERP!")
 
+    # keep the vendor ids refreshed in the background
+    vendor_cache.close()
+    metrics.count('api_retries', default_client().retries)
+
     # set current log as latest log
-    if os.path.lexists(latest_log):
-        os.unlink(latest_log)
-    os.symlink(log_file_path, latest_log)
+    link_latest_log(log_file_path, latest_log)
     logging.info("Log file: %s", log_file_path)
     logging.info("Done")
@@ -9,32 +9,31 @@ Uploads apfeed to KFS
 Also can be used to delete apfeeds and decrement org_doc_nbr
 """
 import argparse
-import ConfigParser
 import logging
 import os
 import shutil
 import sys
 import time
 
-import paramiko
+from apfeed_index import ApfeedIndex
+from apfeed_layout import LAYOUT
+from block_archive import BlockArchive, archive_path
+from check_processing import (link_latest_log, load_config, make_dirs,
+                              setup_logging)
+from metrics import Metrics
 
-from scp import SCPClient
 
-# Read config from config.ini
-SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-CONFIG_PATH = os.path.join(SCRIPT_DIR, 'config.ini')
-CONFIG = ConfigParser.ConfigParser()
-CONFIG.readfp(open(CONFIG_PATH))
-
-
-def create_ssh_client(scp_server, scp_user, scp_key_file):
+def create_ssh_client(scp_server, scp_user, scp_key_file, scp_port=22):
     """
     Creates SSH Client for SCP
     """
+    import paramiko
+
     client = paramiko.SSHClient()
     client.load_system_host_keys()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(scp_server, username=scp_user, key_filename=scp_key_file)
+    client.connect(scp_server, port=int(scp_port), username=scp_user,
+                   key_filename=scp_key_file)
     return client
 
 
@@ -72,36 +71,31 @@ if __name__ == "__main__":
         help='Directory where xml_to_apfeed will'
         ' archive xmls and apfeed (default:<cwd>/archive)'
     )
+    parser.add_argument(
+        '--compress-archive',
+        action='store_true',
+        help='Archive the apfeed compressed into <archive-dir>/apfeed.gz'
+        ' instead of moving it to <archive-dir>/apfeed'
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Write per stage timings (read, connect, upload, config,'
+        ' archive, index), counts and peak memory of the run as JSON'
+    )
     args = parser.parse_args()
 
+    metrics = Metrics('upload_apfeed')
+    if args.metrics_file is not None:
+        metrics.write_at_exit(args.metrics_file)
+
     # Create and setup logging
     latest_log = os.path.join(args.log_dir, "upload_apfeed.latest.log")
-    if not os.path.isdir(args.log_dir):
-        os.mkdir(args.log_dir)
-    log_file_path = os.path.join(args.log_dir, args.log_file)
-
-    numeric_level = getattr(logging, args.log_level.upper(), None)
-    if not isinstance(numeric_level, int):
-        raise ValueError('Invalid log level: %s' % args.log_level)
-    logging.basicConfig(
-        filename=log_file_path,
-        level=numeric_level,
-        format="[%(levelname)-5.5s] %(message)s"
-    )
-    logger = logging.getLogger()
-    consoleHandler = logging.StreamHandler()
-    stream_format = logging.Formatter("[%(levelname)-5.5s] %(message)s")
-    consoleHandler.setFormatter(stream_format)
-    logger.addHandler(consoleHandler)
-    logger.setLevel(numeric_level)
+    log_file_path = setup_logging(args.log_dir, args.log_file, args.log_level)
 
     # Create and setup archive
     archive_dir = args.archive_dir
-    if not os.path.isdir(archive_dir):
-        os.mkdir(archive_dir)
     apfeed_arch_dir = os.path.join(archive_dir, "apfeed")
-    if not os.path.isdir(apfeed_arch_dir):
-        os.mkdir(apfeed_arch_dir)
+    make_dirs(archive_dir, apfeed_arch_dir)
 
     apfeed_file_path = args.apfeed_file
 
@@ -113,49 +107,53 @@ if __name__ == "__main__":
         logging.error("Cannot find file: %s", apfeed_file_path)
         sys.exit(1)
 
-    # Create and setup logging
-    latest_log = os.path.join(args.log_dir, "upload_apfeed.latest.log")
-    if not os.path.isdir(args.log_dir):
-        os.mkdir(args.log_dir)
-    log_file_path = os.path.join(args.log_dir, args.log_file)
-    numeric_level = getattr(logging, args.log_level.upper(), None)
-
-    if not isinstance(numeric_level, int):
-        raise ValueError('Invalid log level: %s' % args.log_level)
-    logging.basicConfig(filename=log_file_path,
-                        level=numeric_level,
-                        format="[%(levelname)-5.5s] %(message)s")
-    logging.getLogger().addHandler(logging.StreamHandler())
-
-    org_doc_nbr = CONFIG.get("apfeed", "org_doc_nbr")
-    with open(apfeed_file_path) as f:
-        content = f.readlines()
-        org_doc_nbr = content[-2][29:36]
+    config = load_config()
+    with metrics.stage('read'):
+        with open(apfeed_file_path) as f:
+            content = f.readlines()
+            org_doc_nbr = LAYOUT.get(content[-2], 'org_doc_nbr')
+    metrics.count('apfeed_lines', len(content) - 2)
+    metrics.count('bytes', os.path.getsize(apfeed_file_path))
 
     # Get finance server connection settings
-    server = CONFIG.get("apfeed_scp_out", "server")
-    user = CONFIG.get("apfeed_scp_out", "user")
-    private_key = CONFIG.get("apfeed_scp_out", "private_key")
-    port = CONFIG.get("apfeed_scp_out", "port")
+    scp_out = config.apfeed_scp_out
 
     # Upload to server
     logging.info("Uploading via SCP")
-    ssh = create_ssh_client(server, user, private_key, port)
-    scp = SCPClient(ssh.get_transport())
-    scp.put(apfeed_file_path)
+    with metrics.stage('connect'):
+        from scp import SCPClient
+        ssh = create_ssh_client(scp_out.server, scp_out.user,
+                                scp_out.private_key, scp_out.port)
+        scp = SCPClient(ssh.get_transport())
+    with metrics.stage('upload'):
+        scp.put(apfeed_file_path)
     logging.info("Uploaded: %s", apfeed_file_path)
-    shutil.move(apfeed_file_path, apfeed_arch_dir)
-    logging.info("Moved %s to %s", apfeed_file_path, apfeed_arch_dir)
 
-    # Update config.ini for org_doc_nbr
+    # Update config.ini for org_doc_nbr before the apfeed leaves its
+    # directory, which is what lets the next conversion start
     logging.info("Updating config org_doc_nbr to %d", org_doc_nbr)
-    CONFIG.set("apfeed", "org_doc_nbr", org_doc_nbr)
-    with open(CONFIG_PATH, 'w') as config_file:
-        CONFIG.write(config_file)
+    with metrics.stage('config'):
+        config.set_org_doc_nbr(org_doc_nbr)
+
+    archive = None
+    with metrics.stage('archive'):
+        if args.compress_archive:
+            archive = BlockArchive(archive_path(apfeed_arch_dir))
+            archive.add(apfeed_file_path)
+            os.remove(apfeed_file_path)
+            logging.info("Archived %s in %s", apfeed_file_path, archive.path)
+        else:
+            shutil.move(apfeed_file_path, apfeed_arch_dir)
+            logging.info("Moved %s to %s", apfeed_file_path, apfeed_arch_dir)
+    with metrics.stage('index'):
+        index = ApfeedIndex(apfeed_arch_dir, archive=archive)
+        indexed = index.add_feed(os.path.basename(apfeed_file_path))
+        index.close()
+        if archive is not None:
+            archive.close()
+    logging.info("Indexed %d lines of %s", indexed, apfeed_file_path)
 
     # set current log as latest log
-    if os.path.lexists(latest_log):
-        os.unlink(latest_log)
-    os.symlink(log_file_path, latest_log)
+    link_latest_log(log_file_path, latest_log)
     logging.info("Log file: %s", log_file_path)
     logging.info("Done")
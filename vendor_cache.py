@@ -0,0 +1,173 @@
+"""
+Persistent cache of Alma vendor code -> KFS vendor id for update_alma.py
+A vendor's KFS id almost never changes, so it is kept in sqlite with the
+time it was fetched. Fresh entries are used without calling Alma. Stale
+ones are used too, while they are fetched again in the background.
+Vendors whose additional_code does not parse are cached as '' for a
+shorter time, so a broken vendor is not fetched on every run. Failed
+calls are never cached: a failed lookup is raised to the caller, a
+refused one (None) is returned uncached, and a failed background
+refresh keeps the stale id.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+DAY = 24 * 60 * 60
+TTL = 7 * DAY
+NEGATIVE_TTL = DAY
+
+SCHEMA = """
+    create table if not exists vendors (
+        code text primary key,
+        vendor_id text,
+        fetched real
+    );
+"""
+
+
+class VendorCache(object):
+    """Vendor ids by vendor code, safe to update from worker threads"""
+
+    def __init__(self, path, ttl=TTL, negative_ttl=NEGATIVE_TTL):
+        """
+        Args:
+            path (str): sqlite file, created if missing.
+            ttl (float): Seconds a vendor id stays fresh.
+            negative_ttl (float): Seconds an unparsable vendor stays fresh.
+        """
+        self.ttl = ttl
+        self.negative_ttl = min(negative_ttl, ttl)
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.executescript(SCHEMA)
+        self.pending = []
+
+    def get(self, code, now=None):
+        """Cached vendor id of a code.
+
+        Returns:
+            tuple: (vendor_id, fresh), or None if the code is not cached.
+                vendor_id is '' for a vendor that did not parse.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            row = self.con.execute(
+                "select vendor_id, fetched from vendors where code = ?", (code,)
+            ).fetchone()
+        if row is None:
+            return None
+        vendor_id, fetched = row
+        ttl = self.ttl if vendor_id else self.negative_ttl
+        return vendor_id, now - fetched < ttl
+
+    def put(self, code, vendor_id, now=None):
+        """Stores the vendor id of a code, '' if it did not parse"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            with self.con:
+                self.con.execute(
+                    "insert or replace into vendors values (?, ?, ?)",
+                    (code, vendor_id, now)
+                )
+
+    def put_many(self, vendors, now=None):
+        """Stores vendor ids of many codes in one transaction.
+
+        Args:
+            vendors (dict): code -> vendor id, '' if it did not parse.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            with self.con:
+                self.con.executemany(
+                    "insert or replace into vendors values (?, ?, ?)",
+                    ((code, vendor_id, now)
+                     for code, vendor_id in vendors.iteritems())
+                )
+
+    def fetch(self, lookup, code):
+        """Looks a code up and caches the result.
+
+        Args:
+            lookup (callable): Returns the vendor id of a code, '' if it
+                does not parse, None if it could not be looked up (not
+                cached), raises if the call fails.
+
+        Returns:
+            tuple: (code, vendor_id).
+
+        Raises:
+            Exception: What lookup raised. Nothing is cached.
+        """
+        vendor_id = lookup(code)
+        if vendor_id is not None:
+            self.put(code, vendor_id)
+        return code, vendor_id
+
+    def refresh(self, lookup, code):
+        """fetch for a background refresh, keeping the cached id if the
+        call fails"""
+        try:
+            return self.fetch(lookup, code)
+        except Exception:  # pylint: disable=broad-except
+            logging.warn("Refreshing vendor %s failed, keeping the cached id",
+                         code, exc_info=True)
+            return code, None
+
+    def resolve(self, codes, lookup, client, refresh=False):
+        """Vendor ids of codes, calling Alma only for those not fresh.
+
+        Missing codes are fetched now on the client's threads. Stale ones
+        are answered from the cache and refetched in the background; call
+        wait or close before exiting to keep the refreshed ids.
+
+        Args:
+            codes (list): Vendor codes.
+            lookup (callable): As for fetch.
+            client (AlmaClient): Client whose threads make the calls.
+            refresh (bool): Fetch every code again, ignoring the cache.
+
+        Returns:
+            tuple: (dict of code -> vendor id, number of codes fetched now).
+
+        Raises:
+            Exception: What lookup raised for a missing code.
+        """
+        vendors = dict()
+        missing = []
+        stale = []
+        now = time.time()
+        for code in codes:
+            cached = None if refresh else self.get(code, now)
+            if cached is None:
+                missing.append(code)
+            else:
+                vendors[code], fresh = cached
+                if not fresh:
+                    stale.append(code)
+        for code, vendor_id in client.imap(lambda c: self.fetch(lookup, c),
+                                           missing):
+            vendors[code] = vendor_id
+        if stale:
+            logging.info("Refreshing %d stale vendors in the background",
+                         len(stale))
+            self.pending.append(
+                client.map_async(lambda c: self.refresh(lookup, c), stale)
+            )
+        return vendors, len(missing)
+
+    def wait(self):
+        """Waits for the background refreshes"""
+        while self.pending:
+            self.pending.pop().wait()
+
+    def close(self):
+        """Waits for the background refreshes and closes the cache"""
+        self.wait()
+        self.con.close()
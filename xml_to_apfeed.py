@@ -10,25 +10,44 @@ Creates an apfeed file, which is a flat text file
 """
 
 import argparse
-import ConfigParser
 import csv
 import datetime
 import logging
 import os
 import shutil
 import re
+import signal
 import sys
+import tempfile
 import time
 import xml.etree.ElementTree as ET
 
-# Read config from config.ini
-SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-CONFIG_PATH = os.path.join(SCRIPT_DIR, 'config.ini')
-CONFIG = ConfigParser.ConfigParser()
-CONFIG.readfp(open(CONFIG_PATH))
-UTAX = float(CONFIG.get('apfeed', 'tax_perc'))
-
+from functools import partial
+from itertools import izip
+
+from apfeed_layout import HEADER, LAYOUT, TRAILER
+from apfeed_ledger import Ledger, file_hash
+from apfeed_table import LineTable
+from apfeed_watch import Status, watch
+from block_archive import BlockArchive, archive_path
+from check_processing import (LOG_FORMAT, link_latest_log, load_config,
+                              make_dirs, setup_logging)
+from metrics import Metrics
+
+# C accelerated ElementTree with the same API, for streaming
+try:
+    import xml.etree.cElementTree as CET
+except ImportError:
+    CET = ET
+
+# Alma invoice export namespace, and the parsers iter_invoices can use
 NSP = {'exl': 'http://com/exlibris/repository/acq/invoice/xmlbeans'}
+PARSERS = ('auto', 'etree', 'lxml')
+
+
+def dollars(cents):
+    """Formats integer cents as dollars with two decimals, e.g. -0.05"""
+    return "%s%d.%02d" % (("-" if cents < 0 else "",) + divmod(abs(cents), 100))
 
 
 def strstr(haystack, needle):
@@ -42,19 +61,220 @@ def strstr(haystack, needle):
         return haystack[:pos] + "}"
 
 
+# Fully qualified tag names, resolved once so extraction can compare
+# element tags directly instead of evaluating ElementPath per lookup.
+EXL = "{%s}" % NSP['exl']
+T_INVOICE_NUMBER = EXL + "invoice_number"
+T_INVOICE_DATE = EXL + "invoice_date"
+T_VENDOR_CODE = EXL + "vendor_additional_code"
+T_VAT_INFO = EXL + "vat_info"
+T_VAT_AMOUNT = EXL + "vat_amount"
+T_OWNERED_ENTITY = EXL + "invoice_ownered_entity"
+T_CREATION_DATE = EXL + "creationDate"
+T_NOTE_LIST = EXL + "noteList"
+T_NOTE = EXL + "note"
+T_NOTE_OWNERED_ENTITY = EXL + "owneredEntity"
+T_CONTENT = EXL + "content"
+T_LINE_LIST = EXL + "invoice_line_list"
+T_LINE = EXL + "invoice_line"
+T_LINE_NUMBER = EXL + "line_number"
+T_PO_LINE_INFO = EXL + "po_line_info"
+T_PO_LINE_NUMBER = EXL + "po_line_number"
+T_FUND_INFO_LIST = EXL + "fund_info_list"
+T_FUND_INFO = EXL + "fund_info"
+T_EXTERNAL_ID = EXL + "external_id"
+T_AMOUNT = EXL + "amount"
+T_SUM = EXL + "sum"
+
+
+def first_text(elem, *tags):
+    """
+    Text of the first descendant reached by following tags child by child.
+    Same result as elem.find("a/b/c").text, None when there is no match.
+    """
+    found = find_path(elem, tags)
+    if found is None:
+        return None
+    return found.text
+
+
+def find_path(elem, tags):
+    """
+    First descendant reached by following tags child by child, or None.
+    """
+    if not tags:
+        return elem
+    for child in elem:
+        if child.tag == tags[0]:
+            found = find_path(child, tags[1:])
+            if found is not None:
+                return found
+    return None
+
+
+def extract_line(inv_line):
+    """Walks an invoice line element once, collecting the fields apfeed needs.
+
+    Args:
+        inv_line (ElementTree): A single parsed line item from an invoice.
+
+    Returns:
+        dict: line_number, note, po_line_number (str or None) and the
+            per-fund external_ids and sums (lists of str) in document order.
+    """
+    rec = {'line_number': None, 'note': None, 'po_line_number': None,
+           'external_ids': [], 'sums': []}
+    note_seen = False
+    for child in inv_line:
+        tag = child.tag
+        if tag == T_LINE_NUMBER:
+            if rec['line_number'] is None:
+                rec['line_number'] = child.text
+        elif tag == T_NOTE:
+            if not note_seen:
+                note_seen = True
+                rec['note'] = child.text
+        elif tag == T_PO_LINE_INFO:
+            if rec['po_line_number'] is None:
+                rec['po_line_number'] = first_text(child, T_PO_LINE_NUMBER)
+        elif tag == T_FUND_INFO_LIST:
+            for fund in child:
+                if fund.tag != T_FUND_INFO:
+                    continue
+                for field in fund:
+                    if field.tag == T_EXTERNAL_ID:
+                        rec['external_ids'].append(field.text)
+                    elif field.tag == T_AMOUNT:
+                        for amt in field:
+                            if amt.tag == T_SUM:
+                                rec['sums'].append(amt.text)
+    return rec
+
+
+def extract_invoice(inv):
+    """Walks an invoice element once and flattens it into a record.
+
+    Replaces the repeated namespace find/findall calls Apfeed used to make
+    on every invoice and line. The record holds plain strings so it can be
+    built and consumed independently of the parsed tree.
+
+    Args:
+        inv (ElementTree): A single parsed invoice ElementTree.
+
+    Returns:
+        dict: vendor_additional_code, invoice_number, invoice_date,
+            vat_amount, creation_date, has_note_list, note_creation_date,
+            note_content and lines (list of extract_line records).
+    """
+    rec = {'vendor_additional_code': None, 'invoice_number': None,
+           'invoice_date': None, 'vat_amount': None, 'creation_date': None,
+           'has_note_list': False, 'note_creation_date': None,
+           'note_content': None, 'lines': []}
+    for child in inv:
+        tag = child.tag
+        if tag == T_LINE_LIST:
+            for inv_line in child:
+                if inv_line.tag == T_LINE:
+                    rec['lines'].append(extract_line(inv_line))
+        elif tag == T_INVOICE_NUMBER:
+            if rec['invoice_number'] is None:
+                rec['invoice_number'] = child.text
+        elif tag == T_INVOICE_DATE:
+            if rec['invoice_date'] is None:
+                rec['invoice_date'] = child.text
+        elif tag == T_VENDOR_CODE:
+            if rec['vendor_additional_code'] is None:
+                rec['vendor_additional_code'] = child.text
+        elif tag == T_VAT_INFO:
+            if rec['vat_amount'] is None:
+                rec['vat_amount'] = first_text(child, T_VAT_AMOUNT)
+        elif tag == T_OWNERED_ENTITY:
+            if rec['creation_date'] is None:
+                rec['creation_date'] = first_text(child, T_CREATION_DATE)
+        elif tag == T_NOTE_LIST:
+            if not rec['has_note_list']:
+                rec['has_note_list'] = True
+                rec['note_creation_date'] = first_text(
+                    child, T_NOTE, T_NOTE_OWNERED_ENTITY, T_CREATION_DATE
+                )
+                rec['note_content'] = first_text(child, T_NOTE, T_CONTENT)
+    return rec
+
+
+class ApfeedWriter(object):
+    """Streams an apfeed to a temporary file in the destination directory.
+
+    The file only appears under its real name, via an atomic rename, once
+    close is called, so a failed or crashed run never leaves a partial
+    apfeed behind for upload.
+    """
+
+    def __init__(self, path, now):
+        self.path = path
+        directory, name = os.path.split(path)
+        fd, self.tmp_path = tempfile.mkstemp(prefix=".%s." % name,
+                                             dir=directory or ".")
+        self.file = os.fdopen(fd, 'w')
+        self.file.write(HEADER % now.strftime("%Y%m%d%H%M%S"))
+
+    def write(self, line):
+        """Appends a formatted apfeed line"""
+        self.file.write("\n")
+        self.file.write(line)
+
+    def close(self, count):
+        """Writes the trailer with the final line count and moves into place"""
+        self.file.write("\n")
+        self.file.write(TRAILER % count)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        # mkstemp creates the file private, match a normally created file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.tmp_path, 0o666 & ~umask)
+        os.rename(self.tmp_path, self.path)
+
+    def discard(self):
+        """Removes the temporary file without creating the apfeed"""
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+
+
 class Apfeed(object):
     """Class to model what apfeed should be generated"""
 
-    def __init__(self):
-        """Initialization"""
+    def __init__(self, apfeed_file_path=None, ledger=None, validate_only=False,
+                 metrics=None):
+        """Initialization
+
+        Args:
+            apfeed_file_path (str): If given, lines are streamed to this file
+                through an ApfeedWriter instead of kept in invoices.
+            ledger (Ledger): If given, invoices already converted into a
+                previous apfeed are errors, and new ones are recorded.
+            validate_only (bool): Only run validations, no line is formatted.
+            metrics (Metrics): Where the validate, format and write stage
+                timings are added, a new one if not given.
+        """
         self.now = datetime.datetime.now()
         self.count = 0
         self.invoices = []
-        self.org_doc_nbr = int(CONFIG.get("apfeed", "org_doc_nbr"))
-        self.emp_ind = CONFIG.get('apfeed', 'emp_ind')
+        self.ledger = ledger
+        self.validate_only = validate_only
+        self.metrics = metrics if metrics is not None else Metrics('xml_to_apfeed')
+        self.violations = []
+        self.writer = None
+        if apfeed_file_path is not None:
+            self.writer = ApfeedWriter(apfeed_file_path, self.now)
+        config = load_config().apfeed
+        self.org_doc_nbr = config.org_doc_nbr
+        self.emp_ind = config.emp_ind
+        self.utax = config.tax_perc
         self.errors = 0
-        self.eids = dict()
-        self.invs = dict()
+        self.table = LineTable()
+        self.inv_row = None
 
         # will be set later
         self.goods_received_dt = " " * 8
@@ -64,84 +284,63 @@ class Apfeed(object):
         self.vend_nbr = None
         self.addr_select_vend_nbr = None
         self.vend_assign_inv_date = None
-        self.inv_header = ""
-
-        # Constants
-        self.pmt_remit_nm = " " * 40
-        self.pmt_remit_line_1_addr = " " * 40
-        self.pmt_remit_line_2_addr = " " * 40
-        self.pmt_remit_line_3_addr = " " * 40
-        self.pmt_remit_city_nm = " " * 40
-        self.pmt_remit_st_cd = " " * 2
-        self.pmt_remit_zip_cd = " " * 11
-        self.pmt_remit_cntry_cd = " " * 2
-        self.vend_st_res_ind = " "
-        self.inv_received_dt = " " * 8
-        self.org_shp_zip_cd = CONFIG.get("apfeed", "org_shp_zip_cd")
-        self.org_shp_state_cd = CONFIG.get("apfeed", "org_shp_state_cd")
-        self.pmt_grp_cd = CONFIG.get("apfeed", "pmt_grp_cd")
-        self.inv_fob_cd = " " * 2
-        self.disc_term_cd = " " * 2
-        self.scheduled_pmt_dt = self.now.strftime("%Y%m%d")
-        self.pmt_non_check_ind = CONFIG.get("apfeed", "pmt_non_check_ind")
-        self.fin_coa_cd = CONFIG.get("apfeed", "fin_coa_cd")
-        self.sub_acct_nbr = " " * 5
-        self.fin_object_cd = CONFIG.get('apfeed', 'fin_object_cd')
-        self.fin_sub_obj_cd = " " * 3
-        self.project_cd = " " * 10
-        self.apply_disc_ind = CONFIG.get('apfeed', 'apply_disc_ind')
-        self.eft_override_ind = CONFIG.get('apfeed', 'eft_override_ind')
-        self.ap_pmt_purpose_desc = " " * 120
-
-    def report_line(self, eid, amt, utax):
-        """Calculates total charges by external ids (eids) and invoice id.
+        self.inv_values = dict()
 
-        For reporting. Stores data in dictionary.
+        # Constants, fields always left blank are defaults in LAYOUT
+        self.org_shp_zip_cd = config.org_shp_zip_cd
+        self.org_shp_state_cd = config.org_shp_state_cd
+        self.pmt_grp_cd = config.pmt_grp_cd
+        self.scheduled_pmt_dt = self.now.strftime("%Y%m%d")
+        self.pmt_non_check_ind = config.pmt_non_check_ind
+        self.fin_coa_cd = config.fin_coa_cd
+        self.fin_object_cd = config.fin_object_cd
+        self.apply_disc_ind = config.apply_disc_ind
+        self.eft_override_ind = config.eft_override_ind
+
+    @property
+    def eids(self):
+        """Total charges and use tax by external id (eid) of account.
+
+        For reporting, grouped from the line table.
+        dict[eid]: {'amt': cents, 'tax': cents}
+        """
+        return dict((eid, {'amt': amt, 'tax': tax})
+                    for eid, (amt, tax)
+                    in self.table.totals_by_account(self.utax).iteritems())
 
-        Args:
-            eid (str): External id number of account. e.g. MAINBKS, HSBOOKS
-            amt: Base amount eid will be charged. Should match line item price.
-            utax: Tax code of line item.
+    @property
+    def invs(self):
+        """Total charges and use tax by invoice number.
 
+        For reporting, grouped from the line table.
+        dict[inv_num]: {'total': cents, 'tax': cents}
         """
-        amt = float(amt) / 100
-        if eid not in self.eids:
-            self.eids[eid] = {'amt': 0, 'tax': 0}
-        self.eids[eid]['amt'] += amt
-        inv_num = self.vend_assign_inv_nbr
-        if inv_num not in self.invs:
-            self.invs[inv_num] = {'total': 0, 'tax': 0}
-
-        self.invs[inv_num]['total'] += amt
-
-        # calculate tax based on rate in config file.
-        if utax != '0':
-            tax = amt * UTAX / 100
-            self.eids[eid]['tax'] += tax
-            self.invs[inv_num]['tax'] += tax
-
-    def note_list(self, inv):
+        return dict((inv, {'total': amt, 'tax': tax})
+                    for inv, (amt, tax)
+                    in self.table.totals_by_invoice(self.utax).iteritems())
+
+    def note_list(self, rec):
         """Handles the notes field flags
 
         ATTACH - Attachment
         UTAX - use tax both for inv and inv_line
         ATAX - Both
-        Called from add_inv.
+        Called from add_record.
+        A note without a creation date falls back to the invoice's, and is
+        left blank if that is missing too, for validate_line to flag when
+        the line's tax code requires it.
 
         Args:
-            inv (ElementTree): A single parsed invoice ElementTree.
+            rec (dict): A single invoice record from extract_invoice.
 
         """
-        note_list = inv.find("exl:noteList", NSP)
-        if note_list is None:
-            create_dt = inv.find("exl:invoice_ownered_entity/exl:creationDate", NSP)
-            if create_dt is not None:
-                self.goods_received_dt = create_dt.text
+        if not rec['has_note_list']:
+            if rec['creation_date'] is not None:
+                self.goods_received_dt = rec['creation_date']
         else:
-            self.goods_received_dt = note_list.find(
-                "exl:note/exl:owneredEntity/exl:creationDate", NSP
-            ).text
-            content = note_list.find("exl:note/exl:content", NSP).text
+            self.goods_received_dt = (rec['note_creation_date']
+                                      or rec['creation_date'] or " " * 8)
+            content = rec['note_content']
             if content == "ATTACH" or content == "ATAX":
                 self.attachment_req_ind = 'Y'
             if content == "UTAX" or content == "ATAX":
@@ -181,13 +380,24 @@ class Apfeed(object):
         V       | 402 - 403  | APPLY_DISC_IND
         W       | 403 - 404  | EFT_OVERRIDE_IND
 
-        Constructs inv_header string, which contains data specific to invoice.
-        Then line method is called, which appends data specific to a line.
+        Positions are declared in apfeed_layout.LAYOUT.
+        Collects inv_values, the fields specific to the invoice.
+        Then line method is called, which packs them with the line fields.
 
         Args:
             inv (ElementTree): A single parsed invoice ElementTree.
                 Often contains multiple line items.
         """
+        self.add_record(extract_invoice(inv))
+
+    def add_record(self, rec):
+        """Formats an invoice record from extract_invoice as apfeed lines.
+
+        Does the work described in add_inv without touching the XML tree.
+
+        Args:
+            rec (dict): A single invoice record from extract_invoice.
+        """
 
         # defaults per line
         self.attachment_req_ind = 'N'
@@ -195,109 +405,95 @@ class Apfeed(object):
 
         self.org_doc_nbr += 1
         # Foreach of the invoice lines
-        self.vend_nbr = inv.find("exl:vendor_additional_code", NSP).text
-        self.vend_assign_inv_nbr = inv.find("exl:invoice_number", NSP).text
+        self.vend_nbr = rec['vendor_additional_code']
+        self.vend_assign_inv_nbr = rec['invoice_number']
         logging.debug("Invoice Number: %s", self.vend_assign_inv_nbr)
         self.vend_assign_inv_date = datetime.datetime.strptime(
-            inv.find("exl:invoice_date", NSP).text,
+            rec['invoice_date'],
             "%m/%d/%Y"
         )
-        self.addr_select_vend_nbr = inv.find(
-            "exl:vendor_additional_code", NSP
-        ).text.replace(" ", "")
+        self.addr_select_vend_nbr = self.vend_nbr.replace(" ", "")
 
-        vat_amt = float(
-            inv.find("exl:vat_info/exl:vat_amount", NSP).text
-        )
+        vat_amt = float(rec['vat_amount'])
         if vat_amt > 0:
             self.pmt_tax_cd_inv = 'A'
 
-        self.note_list(inv)
-
-        if self.validate() > 0:
-            return
+        self.note_list(rec)
+
+        table = self.table
+        row = self.inv_row = table.add_invoice(
+            self.org_doc_nbr,
+            self.vend_assign_inv_nbr,
+            self.vend_nbr,
+            self.addr_select_vend_nbr,
+            int(self.vend_assign_inv_date.strftime("%Y%m%d")),
+            self.goods_received_dt,
+            self.attachment_req_ind
+        )
 
-        istr = "GENERALLIBRARY "
-        istr += self.now.strftime("%Y%m%d%H%M%S")
-        istr += "{:07d}".format(self.org_doc_nbr)
-        istr += self.emp_ind
-        istr += self.vend_nbr[0:10]
-        istr += "{:15}".format(self.vend_assign_inv_nbr[0:15])
-        istr += self.vend_assign_inv_date.strftime("%Y%m%d")
-        istr += self.addr_select_vend_nbr[0:14]
-        istr += self.pmt_remit_nm
-        istr += self.pmt_remit_line_1_addr
-        istr += self.pmt_remit_line_2_addr
-        istr += self.pmt_remit_line_3_addr
-        istr += self.pmt_remit_city_nm
-        istr += self.pmt_remit_st_cd
-        istr += self.pmt_remit_zip_cd
-        istr += self.pmt_remit_cntry_cd
-        istr += self.vend_st_res_ind
-        istr += self.inv_received_dt
-        istr += self.goods_received_dt[0:8]
-        istr += self.org_shp_zip_cd[0:11]
-        istr += " "
-        istr += self.org_shp_state_cd[0:2]
-        istr += self.pmt_grp_cd
-        istr += self.inv_fob_cd
-        istr += self.disc_term_cd
-        istr += " "
-        istr += self.scheduled_pmt_dt
-        istr += self.pmt_non_check_ind
-        istr += self.attachment_req_ind
-        self.inv_header = istr
+        # An invoice that fails still has its lines validated, so a run
+        # reports every violation; line skips formatting once there are any
+        with self.metrics.stage('validate'):
+            self.validate()
+            if self.ledger is not None:
+                self.check_ledger(rec)
+
+        self.inv_values = {
+            'time': self.now.strftime("%Y%m%d%H%M%S"),
+            'org_doc_nbr': table.org_doc_nbr[row],
+            'emp_ind': self.emp_ind,
+            'vend_code': table.vend_code[row],
+            'vend_assign_inv_nbr': table.inv_nbr[row],
+            'vend_assign_inv_date': "%08d" % table.inv_date[row],
+            'addr_select_vend_nbr': table.addr_select_vend_nbr[row],
+            'goods_received_dt': table.goods_received_dt[row],
+            'org_shp_zip_cd': self.org_shp_zip_cd,
+            'org_shp_state_cd': self.org_shp_state_cd,
+            'pmt_grp_cd': self.pmt_grp_cd,
+            'scheduled_pmt_dt': self.scheduled_pmt_dt,
+            'pmt_non_check_ind': self.pmt_non_check_ind,
+            'attachment_req_ind': table.attachment_req_ind[row],
+            'fin_coa_cd': self.fin_coa_cd,
+            'fin_object_cd': self.fin_object_cd,
+            'apply_disc_ind': self.apply_disc_ind,
+            'eft_override_ind': self.eft_override_ind,
+        }
 
         # Per line creation
-        inv_list = inv.findall("./exl:invoice_line_list/exl:invoice_line", NSP)
-        for inv_line in inv_list:
-            self.line(inv_line)
+        for inv_line in rec['lines']:
+            # A line split across multiple funds is output one line per
+            # fund, last fund first.
+            funds = len(inv_line['external_ids'])
+            if funds > 1:
+                logging.debug("Line has multiple funds")
+                for fund_index in range(funds - 1, -1, -1):
+                    self.line(inv_line, fund_index)
+            else:
+                self.line(inv_line)
 
     def line(self, inv_line, fund_index=0):
-        """Adds line-specific data to invoice fixed-width string.
+        """Adds a line of the current invoice to the line table.
 
-        Appends formatted string to invoices instance attribute.
+        The line is then validated and formatted from the table.
 
         Args:
-            inv_line (ElementTree): A single parsed line item from an invoice
+            inv_line (dict): A single line record from extract_line
+            fund_index (int): Which of the line's funds to output
 
         """
-        pmt_line_nbr = int(inv_line.find("exl:line_number", NSP).text)
+        pmt_line_nbr = int(inv_line['line_number'])
         logging.debug("- Line Number: %s", pmt_line_nbr)
-        ext_id = inv_line.findall(
-            "exl:fund_info_list/exl:fund_info/exl:external_id",
-            NSP
-        )
-
-        # check if an invoice line is split across multiple funds
-        if len(ext_id) == 1:
-            ext_id = ext_id[0]
-        elif len(ext_id) > 1:
-            logging.debug("Line has multiple funds")
-            next_fund = fund_index + 1
-            if next_fund < len(ext_id):
-                self.line(inv_line, next_fund)
-            ext_id = ext_id[fund_index]
-        else:
-            ext_id = None
+        ext_ids = inv_line['external_ids']
+        ext_id = ext_ids[fund_index] if ext_ids else None
 
-        po_line_nbr = inv_line.find(
-            "exl:po_line_info/exl:po_line_number",
-            NSP
-        )
+        po_line_nbr = inv_line['po_line_number']
         if po_line_nbr is None:
             org_reference_id = " " * 8
         else:
-            org_reference_id = strstr(po_line_nbr.text, '-')
+            org_reference_id = strstr(po_line_nbr, '-')
 
-        amt_sum = inv_line.findall(
-            "exl:fund_info_list/exl:fund_info/exl:amount/exl:sum",
-            NSP
-        )
-        if len(amt_sum) > 0:
-            amt_sum = amt_sum[fund_index]
-        else:
-            amt_sum = None
+        amt_sums = inv_line['sums']
+        amt_sum = amt_sums[fund_index] if amt_sums else None
 
         # Probably a empty line
         if ext_id is None and amt_sum is None:
@@ -308,92 +504,189 @@ class Apfeed(object):
             )
             return
 
-        pmt_amt = int(float(amt_sum.text) * 100)
-        account_nbr = ext_id.text
+        pmt_amt = int(float(amt_sum) * 100)
+        account_nbr = ext_id
 
-        note = inv_line.find("exl:note", NSP)
+        note = inv_line['note']
         pmt_tax_cd = self.pmt_tax_cd_inv
-        if note is not None:
-            if self.pmt_tax_cd_inv == 'C' and note.text and re.match(r"\bNUTAX\b", note.text):
+        if note:
+            if self.pmt_tax_cd_inv == 'C' and re.match(r"\bNUTAX\b", note):
                 pmt_tax_cd = '0'
-            elif note.text and re.match(r"\bUTAX\b", note.text):
+            elif re.match(r"\bUTAX\b", note):
                 pmt_tax_cd = 'C'
 
-        # report
-        self.report_line(account_nbr, pmt_amt, pmt_tax_cd)
+        row = self.table.add_line(self.inv_row, pmt_line_nbr, account_nbr,
+                                  org_reference_id, pmt_tax_cd, pmt_amt)
 
-        if self.validate_line(pmt_tax_cd) > 0:
+        # Once there is an error no apfeed is written, keep validating only
+        with self.metrics.stage('validate'):
+            errors = self.validate_line(row)
+        if errors > 0:
             return
+        if self.errors > 0 or self.validate_only:
+            return
+        self.format_line(row)
+
+    def format_line(self, row):
+        """Formats a line table row with its invoice's values as apfeed.
 
-        istr = self.inv_header
-        istr += "{:05d}".format(pmt_line_nbr)
-        istr += self.fin_coa_cd
-        istr += " "
-        istr += account_nbr[0:7]
-        istr += self.sub_acct_nbr
-        istr += self.fin_object_cd
-        istr += self.fin_sub_obj_cd
-        istr += self.project_cd
-        istr += "{:8}".format(org_reference_id[0:8])
-        istr += pmt_tax_cd
-        istr += "{:012d}".format(pmt_amt)
-        istr += self.apply_disc_ind
-        istr += self.eft_override_ind
-        istr += self.ap_pmt_purpose_desc
-
-        self.invoices.append(istr)
+        Appends formatted string to invoices instance attribute,
+        or the writer when streaming.
+        """
+        with self.metrics.stage('format'):
+            table = self.table
+            values = self.inv_values
+            values['pmt_line_nbr'] = table.pmt_line_nbr[row]
+            values['account_nbr'] = table.accounts[table.account[row]]
+            values['org_reference_id'] = table.org_reference_id[row]
+            values['pmt_tax_cd'] = table.pmt_tax_cd[row]
+            values['pmt_amt'] = table.pmt_amt[row]
+            line = LAYOUT.pack(values)
+        if self.writer is None:
+            self.invoices.append(line)
+        else:
+            with self.metrics.stage('write'):
+                self.writer.write(line)
         self.count += 1
 
+    def violation(self, column, message, line_nbr=None):
+        """Records a failed validation against an apfeed column.
+
+        Args:
+            column (str): LAYOUT field name of the offending column.
+            message (str): Description of the problem.
+            line_nbr (int): Invoice line number, None for invoice level.
+        """
+        logging.error("Skipping(%s) %s", self.vend_assign_inv_nbr, message)
+        self.violations.append({'invoice': self.vend_assign_inv_nbr,
+                                'line': line_nbr,
+                                'column': column,
+                                'message': message})
+        self.errors += 1
+
+    def check_ledger(self, rec):
+        """
+        Records the invoice's lines in the ledger.
+        Returns the number of errors found, 1 if any were already converted.
+        """
+        apfeed = self.ledger.add_invoice(
+            self.vend_assign_inv_nbr,
+            self.vend_nbr,
+            [line['line_number'] for line in rec['lines']]
+        )
+        if apfeed is None:
+            return 0
+        self.violation('vend_assign_inv_nbr',
+                       "Invoice was already converted into %s" % apfeed)
+        return 1
+
     def validate(self):
         """
         Runs validations on an invoice ElementTree
         before its lines are staged for output.
         Will update the number of errors.
         For non-line item invoice data.
+        Returns the number of errors found in this invoice.
         """
+        errors = self.errors
+        table = self.table
+        row = self.inv_row
 
         # Cannot have invoice date in the future
-        if self.vend_assign_inv_date.date() > self.now.date():
-            logging.error("Skipping(%s) Invoice date(%s) is in the future",
-                          self.vend_assign_inv_nbr,
-                          self.vend_assign_inv_date)
-            self.errors += 1
-
-        if len(self.addr_select_vend_nbr) < 14:
-            logging.error("Skipping(%s) addr_select_vend_nbr(%s) is less than 14 characters",
-                          self.vend_assign_inv_nbr,
-                          self.addr_select_vend_nbr)
-            self.errors += 1
-        return self.errors
-
-    def validate_line(self, pmt_tax_cd):
+        inv_date = table.inv_date[row]
+        if inv_date > int(self.now.strftime("%Y%m%d")):
+            self.violation('vend_assign_inv_date',
+                           "Invoice date(%d) is in the future" % inv_date)
+
+        addr_select_vend_nbr = table.addr_select_vend_nbr[row]
+        if len(addr_select_vend_nbr) < 14:
+            self.violation('addr_select_vend_nbr',
+                           "addr_select_vend_nbr(%s) is less than 14 characters"
+                           % addr_select_vend_nbr)
+        return self.errors - errors
+
+    def validate_line(self, row):
         """
-        Do checks on apfeed before generating by line
+        Do checks on a line table row before generating by line
         Will update the number of errors
+        Returns the number of errors found in this line.
         """
+        errors = self.errors
+        table = self.table
 
         # Tax code has requirements if it is not 0
+        pmt_tax_cd = table.pmt_tax_cd[row]
         if pmt_tax_cd == 'B' or pmt_tax_cd == 'C':
-            if (not self.goods_received_dt.strip()
-                    or not self.org_shp_zip_cd.strip()
-                    or not self.org_shp_state_cd.strip()):
-                logging.error("Conditionally required field is empty:"
-                              "GOODS_RECEIVED_DT, ORG_SHP_ZIP_CD and "
-                              "ORG_SHP_STATE_CD required when PMT_TAX_CD"
-                              " is B or C - for invoice: %s", self.vend_assign_inv_nbr)
-                self.errors += 1
-        return self.errors
+            goods_received_dt = table.goods_received_dt[table.inv[row]]
+            for column, value in (('goods_received_dt', goods_received_dt),
+                                  ('org_shp_zip_cd', self.org_shp_zip_cd),
+                                  ('org_shp_state_cd', self.org_shp_state_cd)):
+                if not value.strip():
+                    self.violation(column,
+                                   "Conditionally required field %s is empty:"
+                                   " GOODS_RECEIVED_DT, ORG_SHP_ZIP_CD and"
+                                   " ORG_SHP_STATE_CD required when PMT_TAX_CD"
+                                   " is B or C" % column.upper(),
+                                   table.pmt_line_nbr[row])
+        return self.errors - errors
+
+    def write_violations(self, path):
+        """Writes every recorded violation to a csv report.
+
+        Columns are invoice number, line number (empty for invoice level
+        problems), apfeed column name, its position and the problem.
+        """
+        with open(path, 'wb') as report_file:
+            w = csv.writer(report_file)
+            w.writerow(('Invoice', 'Line', 'Column', 'Position', 'Error'))
+            for vio in self.violations:
+                pos = LAYOUT.slices[vio['column']]
+                w.writerow((vio['invoice'],
+                            '' if vio['line'] is None else vio['line'],
+                            vio['column'].upper(),
+                            "%d - %d" % (pos.start, pos.stop),
+                            vio['message']))
+
+    def write_eid_report(self, path):
+        """Writes use tax and total charges by external id to a csv report"""
+        eids = self.eids
+        with open(path, 'wb') as report_file:
+            w = csv.writer(report_file)
+            w.writerow(('External ID', 'Use Tax', 'Total'))
+            logging.info("External ID : Use Tax | Total")
+            for k in eids:
+                logging.info("%s: $%s | $%s", k, dollars(eids[k]['tax']),
+                             dollars(eids[k]['amt']))
+                w.writerow((k, dollars(eids[k]['tax']), dollars(eids[k]['amt'])))
+
+    def write_invoice_report(self, path):
+        """Writes use tax and total charges by invoice to a csv report"""
+        invs = self.invs
+        with open(path, 'wb') as report_file:
+            w = csv.writer(report_file)
+            w.writerow(('Invoice', 'Use Tax Total', 'Amount Total'))
+            for k in sorted(invs):
+                w.writerow((k, dollars(invs[k]['tax']), dollars(invs[k]['total'])))
+
+    def close(self):
+        """Finishes a streamed apfeed, moving it into place"""
+        with self.metrics.stage('write'):
+            self.writer.close(self.count)
+
+    def discard(self):
+        """Abandons a streamed apfeed"""
+        if self.writer is not None:
+            self.writer.discard()
 
     def __str__(self):
         """To string format which can be printed
 
         Called after all of the invoices have been successfully formatted as str
+        Not available when streaming to a file
         """
-        out = "**HEADERLGGENERALLIBRARY %s\n" % self.now.strftime(
-            "%Y%m%d%H%M%S"
-        )
+        out = HEADER % self.now.strftime("%Y%m%d%H%M%S") + "\n"
         out += "\n".join(self.invoices)
-        out += "\n**TRAILERGENERALLIBRARY %06d" % self.count
+        out += "\n" + TRAILER % self.count
         return out
 
 
@@ -418,6 +711,308 @@ def xml_to_invoices(input_file):
     return out
 
 
+def lxml_etree():
+    """lxml.etree, or None if lxml is not installed.
+
+    lxml is optional, it parses faster but the standard library is
+    enough. It is imported on first use rather than with this module, so
+    runs that do not parse (e.g. --release) do not pay for loading it.
+    """
+    try:
+        from lxml import etree
+    except ImportError:
+        return None
+    return etree
+
+
+def parser_backend(parser):
+    """Resolves a --parser choice to the backend that will be used.
+
+    Args:
+        parser (str): One of PARSERS. 'auto' picks lxml when installed.
+
+    Returns:
+        str: 'etree' or 'lxml'.
+    """
+    if parser not in PARSERS:
+        raise ValueError('Invalid parser: %s' % parser)
+    if parser == 'auto':
+        return 'etree' if lxml_etree() is None else 'lxml'
+    if parser == 'lxml' and lxml_etree() is None:
+        raise ValueError('Parser lxml requested but lxml is not installed')
+    return parser
+
+
+def iter_invoices(input_file, parser='auto'):
+    """Incrementally parses input xml, yielding one invoice at a time.
+
+    Streaming alternative to xml_to_invoices for large Alma exports.
+    Each invoice is cleared and detached from its parent once the caller
+    moves on to the next, so memory stays flat regardless of file size.
+    Callers must finish with an invoice before advancing the generator.
+    Both backends yield elements extract_invoice handles identically.
+
+    Args:
+        input_file (str): File path of XML output file from Alma.
+        parser (str): One of PARSERS, see parser_backend.
+
+    Returns:
+        Generator of invoices, each a single parsed invoice element.
+
+    """
+    if parser_backend(parser) == 'lxml':
+        return iter_invoices_lxml(input_file)
+    return iter_invoices_etree(input_file)
+
+
+def iter_invoices_etree(input_file):
+    """iter_invoices using the standard library (c)ElementTree"""
+    inv_tag = "{%s}invoice" % NSP['exl']
+    with open(input_file, 'r') as xfh:
+        parents = []
+        for event, elem in CET.iterparse(xfh, events=('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                continue
+            parents.pop()
+            if elem.tag != inv_tag:
+                continue
+            yield elem
+            elem.clear()
+            if parents:
+                parents[-1].remove(elem)
+
+
+def iter_invoices_lxml(input_file):
+    """iter_invoices using lxml, which only reports invoice elements"""
+    inv_tag = "{%s}invoice" % NSP['exl']
+    etree = lxml_etree()
+    with open(input_file, 'rb') as xfh:
+        for _, elem in etree.iterparse(xfh, events=('end',), tag=inv_tag):
+            yield elem
+            elem.clear()
+            # lxml keeps parent links, drop the invoices already handled
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+def extract_file(input_file, parser='auto'):
+    """Parses an xml file and extracts every invoice to a record.
+
+    Unit of work for --workers: records are plain dicts, so they can be
+    returned from a worker process and fed to Apfeed.add_record in order
+    by the parent, which keeps org_doc_nbr sequential.
+
+    Args:
+        input_file (str): File path of XML output file from Alma.
+        parser (str): One of PARSERS, see parser_backend.
+
+    Returns:
+        List: extract_invoice records in document order.
+
+    """
+    return [extract_invoice(inv) for inv in iter_invoices(input_file, parser)]
+
+
+def convert(xmls, apfeed_file_path, report_dir, xml_arch_dir, ledger=None,
+            parser='auto', workers=1, validate_only=False,
+            validation_file=None, report_time=None, metrics=None,
+            archive=None):
+    """Converts xml files into one apfeed, its reports, and archives them.
+
+    Files already in the ledger are skipped. If any validation fails no
+    apfeed is created, the validation report is written and the xml files
+    are left in place.
+
+    Args:
+        xmls (list): Paths of the xml files, converted in order.
+        apfeed_file_path (str): Apfeed to create.
+        report_dir (str): Directory for the csv reports.
+        xml_arch_dir (str): Directory the xml files are moved to.
+        ledger (Ledger): Ledger to check and record in, committed on success
+            and rolled back otherwise.
+        parser (str): One of PARSERS.
+        workers (int): Processes used to parse several xml files.
+        validate_only (bool): Only validate and write the validation report.
+        validation_file (str): Validation report name in report_dir
+            (default: validation.<report_time>.csv).
+        report_time (int): Time in the report names (default: now).
+        metrics (Metrics): Where stage timings and counts are added.
+        archive (BlockArchive): Compressed archive the xml files are added
+            to instead of being moved to xml_arch_dir.
+
+    Returns:
+        dict: status ('empty', 'invalid', 'validated' or 'converted'),
+            files converted, apfeed path (None unless converted), errors
+            and reports written.
+    """
+    if report_time is None:
+        report_time = int(time.time())
+    if validation_file is None:
+        validation_file = "validation.%d.csv" % report_time
+    if metrics is None:
+        metrics = Metrics('xml_to_apfeed')
+    xmls = list(xmls)
+    result = {'status': 'empty', 'files': xmls, 'apfeed': None,
+              'errors': 0, 'reports': []}
+
+    apf = None
+    committed = False
+    try:
+        # Skip files whose exact content was already converted
+        if ledger is not None:
+            for xml in xmls[:]:
+                apfeed = ledger.add_file(file_hash(xml), os.path.basename(xml))
+                if apfeed is not None:
+                    logging.warn("Skipping %s, already converted into %s", xml, apfeed)
+                    xmls.remove(xml)
+                    metrics.count('skipped_files')
+
+        if not xmls:
+            logging.info("No XMLs Dectected")
+            return result
+
+        # Start building Apfeed file, streamed to a temporary file until validated
+        if validate_only:
+            apf = Apfeed(ledger=ledger, validate_only=True, metrics=metrics)
+        else:
+            apf = Apfeed(apfeed_file_path, ledger, metrics=metrics)
+
+        if workers > 1 and len(xmls) > 1:
+            # Parse in worker processes, but add records here in file order
+            # so org_doc_nbr is assigned exactly as in a serial run
+            from multiprocessing import Pool
+            pool = Pool(processes=min(workers, len(xmls)))
+            results = pool.imap(partial(extract_file, parser=parser), xmls)
+            pool.close()
+            for xml, records in izip(xmls, metrics.iterate('parse', results)):
+                logging.info("Processing %s", xml)
+                for record in records:
+                    apf.add_record(record)
+            pool.join()
+        else:
+            for xml in xmls:
+                logging.info("Processing %s", xml)
+                # Stream invoices from the xml file into the apfeed
+                invoices = iter_invoices(xml, parser)
+                for invoice in metrics.iterate('parse', invoices):
+                    with metrics.stage('extract'):
+                        record = extract_invoice(invoice)
+                    apf.add_record(record)
+        metrics.count('files', len(xmls))
+        metrics.count('invoices', len(apf.table.inv_nbr))
+        metrics.count('lines', len(apf.table))
+        metrics.count('apfeed_lines', apf.count)
+        metrics.count('errors', apf.errors)
+        result['errors'] = apf.errors
+
+        if not os.path.isdir(report_dir):
+            os.mkdir(report_dir)
+        if apf.errors > 0 or validate_only:
+            validation_path = os.path.join(report_dir, validation_file)
+            logging.info("Creating CSV %s", validation_path)
+            with metrics.stage('report'):
+                apf.write_violations(validation_path)
+            result['reports'].append(validation_path)
+
+        if validate_only or apf.errors > 0:
+            if validate_only:
+                logging.info("Validation found %d errors", apf.errors)
+            else:
+                logging.info("Not creating apfeed because there were %d errors", apf.errors)
+            result['status'] = 'invalid' if apf.errors > 0 else 'validated'
+            return result
+
+        # Write the file
+        logging.info("Writing %s", apfeed_file_path)
+        apf.close()
+        if ledger is not None:
+            ledger.commit()
+        committed = True
+    finally:
+        # Nothing is recorded or left behind unless the apfeed was written
+        if not committed:
+            if apf is not None:
+                apf.discard()
+            if ledger is not None:
+                ledger.rollback()
+    result['apfeed'] = apfeed_file_path
+
+    # Generate report
+    export_id_file = os.path.join(report_dir, "external_id.%d.csv" % report_time)
+    logging.info("Creating CSV %s", export_id_file)
+    logging.info("External ID Totals")
+    with metrics.stage('report'):
+        apf.write_eid_report(export_id_file)
+
+    invoice_tax_file = os.path.join(report_dir, "invoice_tax.%d.csv" % report_time)
+    logging.info("Creating CSV %s", invoice_tax_file)
+    with metrics.stage('report'):
+        apf.write_invoice_report(invoice_tax_file)
+    result['reports'].extend([export_id_file, invoice_tax_file])
+
+    # move XML to archive
+    for xml in xmls:
+        logging.info("Moving %s to archive", xml)
+        if archive is None:
+            shutil.move(xml, xml_arch_dir)
+        else:
+            archive.add(xml)
+            os.remove(xml)
+    result['status'] = 'converted'
+    return result
+
+
+def convert_batch(xmls, args, ledger, parser, xml_arch_dir, archive=None):
+    """Converts a batch of xml files found by --watch as its own run.
+
+    Each batch gets a fresh apfeed name, log file, report time and
+    metrics, as if xml_to_apfeed.py had been started for it. The config
+    is reloaded when changed, since upload_apfeed.py moves org_doc_nbr on
+    after every upload.
+
+    Returns:
+        dict: The convert result, with the batch log file added.
+    """
+    now = datetime.datetime.now()
+    batch_time = int(time.mktime(now.timetuple()))
+    apfeed_file = "apfeed.LG.%s" % now.strftime('%Y%m%d%H%M%S')
+    log_file_path = os.path.join(args.log_dir, "xml_to_apfeed.%d.log" % batch_time)
+
+    handler = logging.FileHandler(log_file_path)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.getLogger().addHandler(handler)
+    try:
+        if ledger is not None:
+            ledger.apfeed = apfeed_file
+        metrics = Metrics('xml_to_apfeed')
+        result = convert(
+            xmls,
+            os.path.join(args.apfeed_dir, apfeed_file),
+            args.report_dir,
+            xml_arch_dir,
+            ledger=ledger,
+            parser=parser,
+            workers=args.workers,
+            validation_file="validation.%d.csv" % batch_time,
+            report_time=batch_time,
+            metrics=metrics,
+            archive=archive
+        )
+        if args.metrics_file is not None:
+            metrics.write(args.metrics_file)
+    finally:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+
+    # set batch log as latest log
+    if result['status'] == 'converted':
+        link_latest_log(log_file_path,
+                        os.path.join(args.log_dir, "xml_to_apfeed.latest.log"))
+    result['log'] = log_file_path
+    return result
+
+
 # pylint: disable=C0103
 if __name__ == "__main__":
     # Constants
@@ -464,6 +1059,12 @@ if __name__ == "__main__":
         help='Directory where xml_to_apfeed will'
         ' archive xmls and apfeed (default:<cwd>/archive)'
     )
+    parser.add_argument(
+        '--compress-archive',
+        action='store_true',
+        help='Archive xmls compressed into <archive-dir>/xml.gz instead of'
+        ' moving them to <archive-dir>/xml'
+    )
     parser.add_argument(
         '--apfeed-dir',
         default=os.path.join(cwd, "apfeed"),
@@ -476,35 +1077,131 @@ if __name__ == "__main__":
         help='Directory where xml_to_apfeed will'
         ' create a report csv for External IDs(default:<cwd>/reports)'
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='Number of processes used to parse xml files in parallel.'
+        ' Output matches a serial run (default: 1)'
+    )
+    parser.add_argument(
+        '--parser',
+        choices=PARSERS,
+        default='auto',
+        help='XML parser backend, auto uses lxml when installed and the'
+        ' standard library otherwise (default: auto)'
+    )
+    parser.add_argument(
+        '--ledger',
+        action='store_true',
+        default=False,
+        help='Check and update the ledger of converted xml files and'
+        ' invoices; an apfeed deleted instead of uploaded must then be'
+        ' released with --release before its xml is converted again'
+    )
+    parser.add_argument(
+        '--ledger-file',
+        help='Ledger of converted xml files and invoices'
+        ' (default:<archive-dir>/ledger.sqlite)'
+    )
+    parser.add_argument(
+        '--release',
+        metavar='APFEED_FILE',
+        help='Forget the ledger entries of an apfeed that was deleted'
+        ' instead of uploaded, so its xml can be converted again, and exit'
+    )
+    parser.add_argument(
+        '--validate-only',
+        action='store_true',
+        default=False,
+        help='Check every invoice and line and write the validation report'
+        ' without creating an apfeed or moving the xml'
+    )
+    parser.add_argument(
+        '--validation-file',
+        default="validation.%d.csv" % mytime,
+        help='validation report file name, written to --report-dir when'
+        ' there are errors or with --validate-only'
+        ' (default: validation.<time>.csv)'
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Write per stage timings (parse, extract, validate, format,'
+        ' write, report), counts and peak memory of the run as JSON.'
+        ' With --workers, parse includes extract.'
+        ' With --watch, rewritten after every conversion'
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        default=False,
+        help='Keep running and convert xml files as soon as they are fully'
+        ' written to --xml-dir, each batch with its own apfeed, reports'
+        ' and log. Waits while an apfeed is still in --apfeed-dir'
+    )
+    parser.add_argument(
+        '--status-file',
+        help='JSON file --watch keeps its state and last conversion in'
+    )
+    parser.add_argument(
+        '--settle',
+        type=float,
+        default=2.0,
+        help='Seconds an xml file must be unchanged before --watch'
+        ' converts it (default: 2)'
+    )
     args = parser.parse_args()
 
+    if args.watch and (args.input_file or args.validate_only):
+        parser.error("--watch cannot be used with -i or --validate-only")
+
+    metrics = Metrics('xml_to_apfeed')
+    if args.metrics_file is not None and not args.watch:
+        metrics.write_at_exit(args.metrics_file)
+
     # Create and setup logging
     latest_log = os.path.join(args.log_dir, "xml_to_apfeed.latest.log")
-    if not os.path.isdir(args.log_dir):
-        os.mkdir(args.log_dir)
-    log_file_path = os.path.join(args.log_dir, args.log_file)
+    log_file_path = setup_logging(args.log_dir, args.log_file, args.log_level,
+                                  console_format="%(message)s")
 
-    # Create and setup apfeed dir
+    # Create and setup apfeed dir and archive
     apfeed_dir = args.apfeed_dir
-    if not os.path.isdir(apfeed_dir):
-        os.mkdir(apfeed_dir)
     apfeed_file_path = os.path.join(apfeed_dir, args.apfeed_file)
-
-    # Create and setup archive
     archive_dir = args.archive_dir
-    if not os.path.isdir(archive_dir):
-        os.mkdir(archive_dir)
     xml_arch_dir = os.path.join(archive_dir, "xml")
-    if not os.path.isdir(xml_arch_dir):
-        os.mkdir(xml_arch_dir)
+    make_dirs(apfeed_dir, archive_dir, xml_arch_dir)
+    archive = None
+    if args.compress_archive:
+        archive = BlockArchive(archive_path(xml_arch_dir))
+
+    ledger = None
+    if args.ledger or args.release is not None:
+        ledger_path = args.ledger_file or os.path.join(archive_dir, "ledger.sqlite")
+        ledger = Ledger(ledger_path, args.apfeed_file)
+
+    if args.release is not None:
+        removed = ledger.release(os.path.basename(args.release))
+        logging.info("Released %d ledger entries for %s", removed, args.release)
+        sys.exit(0)
 
-    numeric_level = getattr(logging, args.log_level.upper(), None)
-    if not isinstance(numeric_level, int):
-        raise ValueError('Invalid log level: %s' % args.log_level)
-    logging.basicConfig(filename=log_file_path,
-                        level=numeric_level,
-                        format="[%(levelname)-5.5s] %(message)s")
-    logging.getLogger().addHandler(logging.StreamHandler())
+    if args.watch:
+        backend = parser_backend(args.parser)
+        logging.info("Using %s parser", backend)
+        # Stop cleanly on a service stop, so the status file says so
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            watch(
+                args.xml_dir,
+                apfeed_dir,
+                partial(convert_batch, args=args, ledger=ledger,
+                        parser=backend, xml_arch_dir=xml_arch_dir,
+                        archive=archive),
+                status=Status(args.status_file),
+                settle=args.settle
+            )
+        except KeyboardInterrupt:
+            logging.info("Stopped watching %s", args.xml_dir)
+        sys.exit(0)
 
     # If input file is not selected we check all files in xml/
     xmls = []
@@ -516,59 +1213,27 @@ if __name__ == "__main__":
     else:
         xmls = [args.input_file]
 
-    if not xmls:
-        logging.info("No XMLs Dectected")
-        sys.exit(0)
-
-    # Start building Apfeed file
-    apf = Apfeed()
-
-    for xml in xmls:
-        logging.info("Processing %s", xml)
-        # Start reading tpyhe xml file for invoices
-        invoices = xml_to_invoices(xml)
-
-        # Add invoices to apfeed file
-        for invoice in invoices:
-            apf.add_inv(invoice)
-
-    if apf.errors > 0:
-        logging.info("Not creating apfeed because there were %d errors", apf.errors)
+    backend = parser_backend(args.parser)
+    logging.info("Using %s parser", backend)
+
+    result = convert(
+        xmls,
+        apfeed_file_path,
+        args.report_dir,
+        xml_arch_dir,
+        ledger=ledger,
+        parser=backend,
+        workers=args.workers,
+        validate_only=args.validate_only,
+        validation_file=args.validation_file,
+        report_time=mytime,
+        metrics=metrics,
+        archive=archive
+    )
+    if result['status'] == 'invalid':
         sys.exit(1)
-    else:
-        # Write the file
-        logging.info("Writing %s", apfeed_file_path)
-        with open(apfeed_file_path, 'w') as apfeed_file:
-            apfeed_file.write(str(apf))
-
-    # Generate report
-    if not os.path.isdir(args.report_dir):
-        os.mkdir(args.report_dir)
-    export_id_file = os.path.join(args.report_dir, "external_id.%d.csv" % mytime)
-    logging.info("Creating CSV %s", export_id_file)
-    logging.info("External ID Totals")
-    with open(export_id_file, 'wb') as report_file:
-        w = csv.writer(report_file)
-        w.writerow(('External ID', 'Use Tax', 'Total'))
-        logging.info("External ID : Use Tax | Total")
-        for k in apf.eids:
-            logging.info("%s: $%.2f | $%.2f", k, apf.eids[k]['tax'], apf.eids[k]['amt'])
-            w.writerow((k, "%.2f" % apf.eids[k]['tax'], "%.2f" % apf.eids[k]['amt']))
-
-    invoice_tax_file = os.path.join(args.report_dir, "invoice_tax.%d.csv" % mytime)
-    logging.info("Creating CSV %s", invoice_tax_file)
-    with open(invoice_tax_file, 'wb') as report_file:
-        w = csv.writer(report_file)
-        w.writerow(('Invoice', 'Use Tax Total', 'Amount Total'))
-        for k in sorted(apf.invs):
-            w.writerow((k, "%.2f" % apf.invs[k]['tax'], "%.2f" % apf.invs[k]['total']))
-
-    # move XML to archive
-    for xml in xmls:
-        logging.info("Moving %s to archive", xml)
-        shutil.move(xml, xml_arch_dir)
+    elif result['status'] != 'converted':
+        sys.exit(0)
 
     # set current log as latest log
-    if os.path.lexists(latest_log):
-        os.unlink(latest_log)
-    os.symlink(log_file_path, latest_log)
+    link_latest_log(log_file_path, latest_log)